@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+
+"""Semantic analysis of rule sets.
+Rules are compared as regions of packet space: address prefixes and port
+ranges are intervals, so -s 10.0.0.0/8 covers -s 10.1.2.0/24 and dport 1:1024
+covers dport 22."""
+
+import bisect
+import ipaddress
+
+
+class Region:
+    """ The packets a rule matches, as intervals per field.
+
+    src, dst, sport and dport are lists of (low, high) intervals, or None for
+    any value. protocol and the interfaces are strings, or None for any.
+    Other matches are kept as a set of (match, option, value) restrictions,
+    compared by equality.
+    """
+
+    PORTS = 65535
+
+    def __init__(self, rule):
+        """Arguments:
+        rule -- a baleful Rule or FrozenRule
+        """
+        ipv, table, chain, target, params, kwargs = rule.key()
+        self.ipv = ipv
+        self.target = target
+        self.src = None
+        self.dst = None
+        self.sport = None
+        self.dport = None
+        self.protocol = None
+        self.in_interface = None
+        self.out_interface = None
+        self.other = set()
+
+        for param, value in params:
+            neg = value.startswith('!')
+            if param in ['src', 'dst']:
+                net = ipaddress.ip_network(value.lstrip('!'), strict=False)
+                ranges = [(int(net.network_address),
+                           int(net.broadcast_address))]
+                if neg:
+                    ranges = self.complement(
+                        ranges, (1 << net.max_prefixlen) - 1)
+                setattr(self, param, ranges)
+            elif param in ['protocol', 'in_interface', 'out_interface'] and (
+                    not neg):
+                setattr(self, param, value)
+            else:
+                self.other.add(('', param, value))
+
+        for match, options in kwargs:
+            for option, value in options:
+                field = option.rstrip('s')
+                if match in ['tcp', 'udp', 'multiport'] and field in [
+                        'sport', 'dport']:
+                    ranges = list()
+                    for port in value.lstrip('!').split(','):
+                        bounds = [int(b) for b in port.split(':')]
+                        ranges.append((bounds[0], bounds[-1]))
+                    if value.startswith('!'):
+                        ranges = self.complement(ranges, self.PORTS)
+                    setattr(self, field, self.intersect(
+                        getattr(self, field), ranges))
+                elif match != 'comment':
+                    self.other.add((match, option, value))
+
+    @staticmethod
+    def complement(ranges, top):
+        """ Returns the intervals of [0, top] not in ranges. """
+        result = list()
+        low = 0
+        for start, end in sorted(ranges):
+            if start > low:
+                result.append((low, start - 1))
+            low = max(low, end + 1)
+        if low <= top:
+            result.append((low, top))
+        return result
+
+    @staticmethod
+    def intersect(x, y):
+        """ Returns the intersection of interval lists (None is any). """
+        if isinstance(x, type(None)):
+            return sorted(y)
+        if isinstance(y, type(None)):
+            return sorted(x)
+        return sorted((max(a, c), min(b, d)) for a, b in x for c, d in y
+                      if max(a, c) <= min(b, d))
+
+    @staticmethod
+    def within(x, y):
+        """ Returns True, if interval list x is within interval list y. """
+        if isinstance(y, type(None)):
+            return True
+        if isinstance(x, type(None)):
+            return False
+        return all(any(c <= a and b <= d for c, d in y) for a, b in x)
+
+    @staticmethod
+    def disjoint(x, y):
+        """ Returns True, if interval lists x and y do not intersect. """
+        if isinstance(x, type(None)) or isinstance(y, type(None)):
+            return False
+        return not any(max(a, c) <= min(b, d) for a, b in x for c, d in y)
+
+    @staticmethod
+    def pattern_within(x, y):
+        """ Returns True, if interface x is within interface pattern y. """
+        if isinstance(y, type(None)):
+            return True
+        if isinstance(x, type(None)):
+            return False
+        if y.endswith('+'):
+            return x.rstrip('+').startswith(y[:-1])
+        return x == y
+
+    def covers(self, other):
+        """ Returns True, if every packet matching other matches this. """
+        return (self.ipv == other.ipv and
+                (isinstance(self.protocol, type(None)) or
+                 self.protocol == other.protocol) and
+                self.pattern_within(other.in_interface, self.in_interface) and
+                self.pattern_within(other.out_interface,
+                                    self.out_interface) and
+                all(self.within(getattr(other, f), getattr(self, f))
+                    for f in ['src', 'dst', 'sport', 'dport']) and
+                self.other <= other.other)
+
+    def overlaps(self, other):
+        """ Returns True, if some packet may match both regions.
+        Other matches on the same option with different values are taken
+        to be disjoint. """
+        if self.ipv != other.ipv:
+            return False
+        if (self.protocol and other.protocol and
+                self.protocol != other.protocol):
+            return False
+        for f in ['in_interface', 'out_interface']:
+            x = getattr(self, f)
+            y = getattr(other, f)
+            if not (self.pattern_within(x, y) or self.pattern_within(y, x)):
+                return False
+        if any(self.disjoint(getattr(self, f), getattr(other, f))
+               for f in ['src', 'dst', 'sport', 'dport']):
+            return False
+        options = {(m, o): v for m, o, v in self.other}
+        return all(options.get((m, o), v) == v for m, o, v in other.other)
+
+
+class Analysis:
+    """ Finds anomalies between the rules of each chain.
+
+    shadowed -- (rule, earlier) pairs, where the earlier rule has another
+    terminal target and matches every packet of the rule
+    redundant -- (rule, earlier) pairs, where the earlier rule has the same
+    terminal target and matches every packet of the rule
+    correlated -- (rule, earlier) pairs with different targets, matching
+    some of the same packets
+    Rules are given as indices into the analysed rules.
+
+    Earlier rules are indexed by protocol, then by source prefix and by
+    destination port (see RegionIndex), so each rule is only compared with
+    the earlier rules it may overlap.
+
+    Example:
+    analysis = Analysis(node.rules + node.final_rules)
+    print(analysis)
+    """
+
+    # Targets which end traversal of a chain
+    TERMINAL = ['ACCEPT', 'DROP', 'REJECT', 'RETURN']
+
+    def __init__(self, rules):
+        """Arguments:
+        rules -- a RuleArray, or sequence of rules
+        """
+        self.rules = list(rules)
+        self.shadowed = list()
+        self.redundant = list()
+        self.correlated = list()
+
+        chains = dict()
+        for index, rule in enumerate(self.rules):
+            chains.setdefault(rule.key()[:3], list()).append(index)
+        for indices in chains.values():
+            self.chain(indices)
+
+    @classmethod
+    def node(cls, node):
+        """ Returns the Analysis of a node's rules and final rules. """
+        return cls(node.rules + node.final_rules)
+
+    def chain(self, indices):
+        """ Analyses the rules of one chain, in order. """
+        # {protocol: RegionIndex} of earlier rules
+        indexes = dict()
+        regions = dict()
+
+        for index in indices:
+            region = Region(self.rules[index])
+            regions[index] = region
+
+            if isinstance(region.protocol, type(None)):
+                searched = list(indexes.values())
+            else:
+                searched = [indexes[p] for p in [region.protocol, None]
+                            if p in indexes]
+            candidates = set()
+            for searchIndex in searched:
+                candidates.update(searchIndex.candidates(region))
+
+            self.compare(index, region, sorted(candidates), regions)
+
+            if region.protocol not in indexes:
+                indexes[region.protocol] = RegionIndex(region.ipv)
+            indexes[region.protocol].add(index, region)
+
+    def compare(self, index, region, candidates, regions):
+        """ Compares a rule with earlier candidate rules. """
+        for earlier in candidates:
+            other = regions[earlier]
+            if other.target in self.TERMINAL and other.covers(region):
+                if other.target == region.target:
+                    self.redundant.append((index, earlier))
+                else:
+                    self.shadowed.append((index, earlier))
+                return
+
+        for earlier in candidates:
+            other = regions[earlier]
+            if other.target != region.target and other.overlaps(region):
+                self.correlated.append((index, earlier))
+
+    def __str__(self):
+        lines = list()
+        for name in ['shadowed', 'redundant', 'correlated']:
+            pairs = getattr(self, name)
+            lines.append('{}: {} rules'.format(name, len(pairs)))
+            for index, earlier in pairs:
+                lines.append('  {:4d} {}'.format(index, self.rules[index]))
+                lines.append('    by {:4d} {}'.format(
+                    earlier, self.rules[earlier]))
+        return '\n'.join(lines)
+
+
+class RegionIndex:
+    """ Indexes regions by source prefix and destination port, to find the
+    regions which may overlap a region.
+
+    Source prefixes are kept per prefix length, so the prefixes covering a
+    region are found with one lookup per shorter length, and in a sorted
+    list, so longer prefixes are found with a range search. Destination
+    ports are kept in buckets of port numbers. A lookup uses whichever of
+    the two gives fewer candidates.
+    """
+
+    # Ports per bucket, and buckets a region may span before it is kept
+    # with the regions matching any port
+    BUCKET = 16
+    MAX_BUCKETS = 64
+
+    def __init__(self, ipv=4):
+        """Arguments:
+        ipv -- The inet version 4 or 6 (int)
+        """
+        self.bits = 32 if ipv == 4 else 128
+        self.count = 0
+        self.prefixes = dict()
+        self.ranges = list()
+        self.general = list()
+        self.buckets = dict()
+        self.anyport = list()
+
+    def prefix(self, region):
+        """ Returns (low, prefixlen) of a region's source prefix, or None
+        if it is not a single prefix. """
+        if isinstance(region.src, type(None)):
+            return (0, 0)
+        if len(region.src) != 1:
+            return None
+        low, high = region.src[0]
+        size = high - low + 1
+        if size & (size - 1) or low % size:
+            return None
+        return (low, self.bits - size.bit_length() + 1)
+
+    def ports(self, region):
+        """ Returns the port buckets of a region, or None for too many. """
+        if isinstance(region.dport, type(None)):
+            return None
+        buckets = set()
+        for low, high in region.dport:
+            if high // self.BUCKET - low // self.BUCKET >= self.MAX_BUCKETS:
+                return None
+            buckets.update(range(low // self.BUCKET,
+                                 high // self.BUCKET + 1))
+        if len(buckets) > self.MAX_BUCKETS:
+            return None
+        return buckets
+
+    def add(self, index, region):
+        """ Adds a region, by its index. """
+        self.count += 1
+
+        prefix = self.prefix(region)
+        if isinstance(prefix, type(None)):
+            self.general.append(index)
+        else:
+            low, length = prefix
+            self.prefixes.setdefault(prefix, list()).append(index)
+            bisect.insort(self.ranges, (
+                low, low + (1 << (self.bits - length)) - 1, index))
+
+        buckets = self.ports(region)
+        if isinstance(buckets, type(None)):
+            self.anyport.append(index)
+        else:
+            for bucket in buckets:
+                self.buckets.setdefault(bucket, list()).append(index)
+
+    def candidates(self, region):
+        """ Returns the indices of regions which may overlap a region. """
+        buckets = self.ports(region)
+        if isinstance(buckets, type(None)):
+            by_port = self.count
+        else:
+            by_port = len(self.anyport) + sum(
+                len(self.buckets.get(b, ())) for b in buckets)
+
+        prefix = self.prefix(region)
+        lookups = list()
+        if isinstance(prefix, type(None)):
+            by_prefix = self.count
+        else:
+            low, length = prefix
+            top = (1 << self.bits) - 1
+            for k in range(length + 1):
+                mask = top ^ ((1 << (self.bits - k)) - 1)
+                lookups.append(self.prefixes.get((low & mask, k), ()))
+            high = low + (1 << (self.bits - length)) - 1
+            start = bisect.bisect_left(self.ranges, (low, -1, -1))
+            end = bisect.bisect_right(self.ranges, (high, top + 1, 0))
+            by_prefix = (len(self.general) + end - start +
+                         sum(len(l) for l in lookups))
+
+        if by_port <= by_prefix and not isinstance(buckets, type(None)):
+            found = set(self.anyport)
+            for bucket in buckets:
+                found.update(self.buckets.get(bucket, ()))
+            return found
+
+        if isinstance(prefix, type(None)):
+            return set(self.general).union(i for l, h, i in self.ranges)
+
+        found = set(self.general)
+        for lookup in lookups:
+            found.update(lookup)
+        found.update(i for l, h, i in self.ranges[start:end])
+        return found
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import ipaddress
+from baleful.rule import Rule
+from baleful.ipset import IpSet
+
+
+class Blocklist(IpSet):
+    """ A large list of blocked networks, kept in a hash:net ipset.
+
+    Blocklist files are parsed as a stream, one network per line, and
+    aggregated by collapsing adjacent and overlapping prefixes. The first
+    load fills a swap set and swaps it in, so the set is never half filled;
+    later updates are applied as add/del deltas.
+
+    Example:
+    blocklist = Blocklist('drop4')
+    with open('drop.txt') as fp:
+        IpSet.apply(blocklist.load(fp))
+    node.rules.append(blocklist.rule())
+    ...
+    with open('drop.txt') as fp:
+        IpSet.apply(blocklist.update(fp))
+    """
+
+    # A fixed size, so re-creating the set with -exist is a no-op
+    MAXELEM = 1 << 21
+
+    def __init__(self, name, ipv=4, table="RAW", chain="PREROUTING"):
+        """Arguments:
+        name -- the name of the set (max 26 characters)
+        ipv -- The inet version 4 or 6 (int)
+        table -- the table of the drop rule, RAW or MANGLE
+        chain -- the chain of the drop rule
+        """
+        if len(name) > 26:
+            raise(ValueError(
+                "blocklist name {} is longer than 26 characters".format(
+                    name)))
+
+        super().__init__(name, [], ipv=ipv, settype='hash:net')
+        self.swap = name + '-swap'
+        self.table = table
+        self.chain = chain
+        self.skipped = 0
+
+    def parse(self, fp):
+        """ Yields the networks of a blocklist file object.
+        Comments (# or ;) and blank lines are ignored, as is any text after
+        the network. Lines which are not networks, or of another inet
+        version, are counted in self.skipped. """
+        for line in fp:
+            line = line.split('#', 1)[0].split(';', 1)[0].strip()
+            if not line:
+                continue
+            try:
+                network = ipaddress.ip_network(line.split()[0], strict=False)
+            except ValueError:
+                self.skipped += 1
+                continue
+            if network.version != self.ipv:
+                self.skipped += 1
+                continue
+            yield network
+
+    @staticmethod
+    def aggregate(networks):
+        """ Returns a sorted list of networks, with adjacent and overlapping
+        prefixes collapsed. """
+        return list(ipaddress.collapse_addresses(networks))
+
+    def create(self, name=None):
+        """ Returns the 'ipset restore' line to create the set.
+        name -- the set to create (default self.name) """
+        return 'create {} {} family {} maxelem {} -exist'.format(
+            name if name else self.name, self.settype,
+            self.FAMILY[self.ipv], self.MAXELEM)
+
+    def restore(self):
+        """ Returns 'ipset restore' input to replace the set's entries.
+        Entries are added to a swap set, which is swapped in atomically. """
+        if len(self.entries) > self.MAXELEM:
+            raise(ValueError(
+                "{} networks exceed the limit of {}".format(
+                    len(self.entries), self.MAXELEM)))
+
+        lines = [self.create(self.swap),
+                 'flush {}'.format(self.swap)]
+        lines += ['add {} {}'.format(self.swap, entry)
+                  for entry in self.entries]
+        lines += [self.create(),
+                  'swap {} {}'.format(self.swap, self.name),
+                  'destroy {}'.format(self.swap)]
+        return '\n'.join(lines) + '\n'
+
+    def load(self, fp):
+        """ Replaces the entries from a blocklist file object.
+        Returns the 'ipset restore' input to load them, see restore. """
+        self.skipped = 0
+        self.entries = self.aggregate(self.parse(fp))
+        return self.restore()
+
+    def delta(self, entries):
+        """ Returns 'ipset restore' input to change the set's entries to an
+        aggregated list of networks, and keeps them as self.entries. """
+        old = set(self.entries)
+        new = set(entries)
+
+        # Add before deleting, so a re-aggregated prefix stays blocked
+        lines = ['add {} {} -exist'.format(self.name, entry)
+                 for entry in sorted(new - old)]
+        lines += ['del {} {} -exist'.format(self.name, entry)
+                  for entry in sorted(old - new)]
+        self.entries = list(entries)
+        return ''.join(line + '\n' for line in lines)
+
+    def update(self, fp):
+        """ Updates the entries from a blocklist file object.
+        Returns the 'ipset restore' input of the changes, see delta. """
+        self.skipped = 0
+        return self.delta(self.aggregate(self.parse(fp)))
+
+    def rule(self, direction='src'):
+        """ Returns the rule dropping traffic matching the blocklist.
+        In the raw table it drops packets before connection tracking.
+        direction -- 'src' or 'dst' """
+        return Rule(chain=self.chain,
+                    table=self.table,
+                    target="DROP",
+                    ipv=self.ipv,
+                    **self.match(direction))
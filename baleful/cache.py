@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import glob
+import hashlib
+import ipaddress
+import json
+import os
+import threading
+from baleful.rule import Rule, FrozenRule, RuleArray, RuleView
+from baleful.topo import Topology
+
+
+class Cache:
+    """ A content-addressed on-disk cache of compiled rulesets.
+
+    Entries are keyed by a hash of their inputs (see Cache.key): rules,
+    topologies, interfaces (e.g. NetworkInterface after refresh), hosts,
+    and the library's source, so a change to any of them is a miss. Each
+    entry is a JSON dict of texts, e.g. restore files, written atomically,
+    so concurrent runs read either a whole entry or none. The least
+    recently used entries are removed beyond max_bytes.
+
+    Example:
+    cache = Cache('/var/cache/baleful')
+    entry = cache.compile([topo, app.ssh, iface], lambda: {
+        'rules': Node(rules=list(topo * app.ssh)).restore(ipv=4)})
+    rules = Cache.rules(entry)
+    """
+
+    SUFFIX = '.json'
+
+    # Value types, keyed by their text
+    VALUES = (ipaddress.IPv4Address, ipaddress.IPv6Address,
+              ipaddress.IPv4Network, ipaddress.IPv6Network,
+              ipaddress.IPv4Interface, ipaddress.IPv6Interface)
+
+    __VERSION = None
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+        """Arguments:
+        directory -- the cache directory, created if missing
+        max_bytes -- the total size of entries to keep (default 64MiB)
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def version(cls):
+        """ Returns a digest of the library's modules, so entries compiled
+        by another version of baleful are not reused. """
+        if not cls.__VERSION:
+            digest = hashlib.sha256()
+            package = os.path.dirname(os.path.abspath(__file__))
+            for path in sorted(glob.glob(os.path.join(package, '*.py'))):
+                digest.update(os.path.basename(path).encode())
+                with open(path, 'rb') as fp:
+                    digest.update(fp.read())
+            cls.__VERSION = digest.hexdigest()
+        return cls.__VERSION
+
+    @classmethod
+    def canonical(cls, value):
+        """ Returns a JSON-able form of an input, equal for equal inputs.
+        Rules are their canonical keys (see Rule.key), dicts are sorted,
+        values (e.g. addresses) are their text, and baleful's own objects
+        are their class and public attributes, so lazily cached attributes
+        don't change the key. Other inputs raise a ValueError. """
+        canonical = cls.canonical
+        if isinstance(value, (Rule, FrozenRule)):
+            return ['Rule', repr(value.key())]
+        elif isinstance(value, (RuleArray, RuleView)):
+            return ['RuleArray', [canonical(rule) for rule in value]]
+        elif isinstance(value, Topology):
+            return ['Topology', canonical(value.forward),
+                    canonical(value.reverse)]
+        elif isinstance(value, dict):
+            return ['dict', sorted([repr(k), canonical(v)]
+                                   for k, v in value.items())]
+        elif isinstance(value, (list, tuple)):
+            return [canonical(v) for v in value]
+        elif isinstance(value, (set, frozenset)):
+            return sorted(json.dumps(canonical(v)) for v in value)
+        elif isinstance(value, (str, int, float, bool, type(None))):
+            return value
+        elif isinstance(value, cls.VALUES):
+            return [type(value).__name__, str(value)]
+        elif (type(value).__module__.startswith('baleful.') and
+                hasattr(value, '__dict__')):
+            return [type(value).__name__,
+                    canonical({k: v for k, v in vars(value).items()
+                               if not k.startswith('_')})]
+        raise(ValueError("Can not key a cache input of type {}".format(
+            type(value).__name__)))
+
+    @classmethod
+    def key(cls, *inputs):
+        """ Returns the key of the inputs, a hex digest. """
+        text = json.dumps([cls.version(), cls.canonical(list(inputs))],
+                          separators=(',', ':'))
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def get(self, key):
+        """ Returns the entry of a key, or None if it is missing.
+        A hit marks the entry as recently used. """
+        path = self.path(key)
+        try:
+            with open(path) as fp:
+                entry = json.load(fp)
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        """ Writes an entry atomically, then evicts beyond max_bytes.
+        entry -- a JSON-able dict, e.g. {'rules': restore text} """
+        path = self.path(key)
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp, 'w') as fp:
+                json.dump(entry, fp, sort_keys=True)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.evict()
+
+    def evict(self):
+        """ Removes the least recently used entries beyond max_bytes.
+        Entries removed by a concurrent run are skipped. """
+        entries = list()
+        for path in glob.glob(os.path.join(self.directory,
+                                           '*' + self.SUFFIX)):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, path, stat.st_size))
+
+        total = sum(size for mtime, path, size in entries)
+        for mtime, path, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def compile(self, inputs, function):
+        """ Returns the cached entry of the inputs, or on a miss, the entry
+        returned by function(), which is then cached.
+        inputs -- a list of inputs, see Cache.key
+        function -- compiles the inputs into a dict of texts """
+        key = self.key(*inputs)
+        entry = self.get(key)
+        if isinstance(entry, type(None)):
+            entry = function()
+            self.put(key, entry)
+        return entry
+
+    @staticmethod
+    def rules(entry, name='rules', ipv=4):
+        """ Returns the RuleArray of restore text in an entry. """
+        return RuleArray.parse_save(entry[name].splitlines(), ipv=ipv)
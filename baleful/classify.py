@@ -0,0 +1,746 @@
+#!/usr/bin/env python3
+
+"""Offline evaluation of a node's ruleset.
+Packets are evaluated in batches of NumPy arrays, so millions of flow tuples
+can be classified without installing any rules."""
+
+import ipaddress
+import numpy
+from baleful.rule import Rule
+
+
+class Packets:
+    """ A batch of packets of one inet version, as NumPy arrays.
+
+    Addresses are stored as an (n, words) array of 64 bit integers, one word
+    for ipv4 and two for ipv6. Scalar arguments apply to every packet.
+
+    Example:
+    packets = Packets(4, 'INPUT', src=['10.0.0.1', '10.0.0.2'],
+                      dst='10.0.0.254', protocol='tcp', dport=[22, 80],
+                      in_interface='eth0', state='NEW')
+    """
+
+    PROTOCOLS = {'icmp': 1, 'igmp': 2, 'tcp': 6, 'udp': 17, 'gre': 47,
+                 'esp': 50, 'ah': 51, 'ipv6-icmp': 58, 'icmpv6': 58,
+                 'sctp': 132}
+
+    STATES = {'INVALID': 1, 'NEW': 2, 'ESTABLISHED': 4, 'RELATED': 8,
+              'UNTRACKED': 16, 'SNAT': 32, 'DNAT': 64}
+
+    def __init__(self, ipv, chain, src=0, dst=0, protocol=0, sport=0,
+                 dport=0, icmp_type=-1, state='NEW',
+                 in_interface='', out_interface=''):
+        """Arguments:
+        ipv -- The inet version 4 or 6 (int)
+        chain -- the built-in chain the packets traverse (str or array)
+        Keyword Arguments:
+        src, dst -- addresses (str, int, or arrays of them)
+        protocol -- protocol names or numbers
+        sport, dport -- ports, 0 where not applicable
+        icmp_type -- icmp types, -1 where not applicable
+        state -- conntrack states (str, e.g. 'NEW', or a bitmask of STATES)
+        in_interface, out_interface -- interface names, '' for none
+        """
+        self.ipv = ipv
+        self.words = 1 if ipv == 4 else 2
+
+        arrays = [numpy.asarray(a) for a in (
+            chain, protocol, sport, dport, icmp_type, state,
+            in_interface, out_interface)]
+        addresses = [self.address(a) for a in (src, dst)]
+        length = max([a.size for a in arrays] +
+                     [a.shape[0] for a in addresses])
+
+        def column(value, dtype=None):
+            return numpy.broadcast_to(
+                value if dtype is None else value.astype(dtype), (length,))
+
+        def address(value):
+            return numpy.broadcast_to(value, (length, self.words))
+
+        (chain, protocol, sport, dport, icmp_type, state,
+         in_interface, out_interface) = arrays
+
+        self.chain = column(chain.astype(str))
+        self.src = address(addresses[0])
+        self.dst = address(addresses[1])
+        self.protocol = column(self.numbers(protocol, self.PROTOCOLS))
+        self.sport = column(sport, numpy.int64)
+        self.dport = column(dport, numpy.int64)
+        self.icmp_type = column(icmp_type, numpy.int64)
+        self.state = column(self.states(state))
+        self.in_interface = column(in_interface.astype(str))
+        self.out_interface = column(out_interface.astype(str))
+
+    def __len__(self):
+        return self.chain.shape[0]
+
+    def address(self, value):
+        """ Returns addresses as an (n, words) uint64 array. """
+        value = numpy.asarray(value)
+        if value.dtype.kind in 'iu':
+            if value.ndim == 2:
+                return value.astype(numpy.uint64)
+            value = value.reshape(-1).astype(numpy.uint64)
+            if self.words == 1:
+                return value.reshape(-1, 1)
+            return numpy.stack(
+                [numpy.zeros_like(value), value], axis=1)
+
+        ints = [int(ipaddress.ip_address(str(a)))
+                for a in value.reshape(-1)]
+        return numpy.array(
+            [[(i >> (64 * w)) & 0xFFFFFFFFFFFFFFFF
+              for w in reversed(range(self.words))] for i in ints],
+            dtype=numpy.uint64).reshape(-1, self.words)
+
+    @staticmethod
+    def numbers(value, names):
+        """ Returns an int64 array from names or numbers. """
+        if value.dtype.kind in 'iu':
+            return value.astype(numpy.int64)
+        return numpy.array(
+            [names[v.lower()] if v.lower() in names else int(v)
+             for v in value.reshape(-1).astype(str)],
+            dtype=numpy.int64).reshape(value.shape)
+
+    @classmethod
+    def states(cls, value):
+        """ Returns a conntrack state bitmask array. """
+        if value.dtype.kind in 'iu':
+            return value.astype(numpy.int64)
+        return numpy.array(
+            [sum(cls.STATES[s.strip().upper()]
+                 for s in v.split(',') if s.strip())
+             for v in value.reshape(-1).astype(str)],
+            dtype=numpy.int64).reshape(value.shape)
+
+
+class Matches:
+    """ Compiles rule matches into vectorized tests.
+    A test is a function(packets, idx) returning a bool mask for the
+    packets idx of a batch of Packets. """
+
+    ICMP_TYPES = {4: {'echo-reply': 0, 'pong': 0,
+                      'destination-unreachable': 3, 'source-quench': 4,
+                      'redirect': 5, 'echo-request': 8, 'ping': 8,
+                      'router-advertisement': 9, 'router-solicitation': 10,
+                      'time-exceeded': 11, 'ttl-exceeded': 11,
+                      'parameter-problem': 12, 'timestamp-request': 13,
+                      'timestamp-reply': 14},
+                  6: {'destination-unreachable': 1, 'packet-too-big': 2,
+                      'time-exceeded': 3, 'ttl-exceeded': 3,
+                      'parameter-problem': 4, 'echo-request': 128,
+                      'echo-reply': 129, 'router-solicitation': 133,
+                      'router-advertisement': 134,
+                      'neighbour-solicitation': 135,
+                      'neighbor-solicitation': 135,
+                      'neighbour-advertisement': 136,
+                      'neighbor-advertisement': 136}}
+
+    def __init__(self, sets=None):
+        """Arguments:
+        sets -- IpSets matched by the rules
+        """
+        self.sets = {s.name: s for s in (sets if sets else list())}
+
+    def compile(self, rule):
+        """ Returns a function(packets, idx) -> bool mask matching a rule.
+        Raises ValueError for matches which can not be evaluated. """
+        ipv, table, chain, target, params, kwargs = rule.key()
+        tests = list()
+
+        for param, value in params:
+            neg = value.startswith('!')
+            test = self.param(ipv, param, value.lstrip('!'))
+            tests.append(self.negate(test) if neg else test)
+
+        for match, options in kwargs:
+            for option, value in options:
+                neg = value.startswith('!')
+                value = value.lstrip('!')
+                test = self.option(ipv, match, option, value)
+                if test:
+                    tests.append(self.negate(test) if neg else test)
+
+        return self.conjunction(tests)
+
+    @staticmethod
+    def conjunction(tests):
+        """ Returns a test matching packets which pass every test. """
+        def match(packets, idx):
+            mask = numpy.ones(idx.shape[0], dtype=bool)
+            for test in tests:
+                if not mask.any():
+                    break
+                mask &= test(packets, idx)
+            return mask
+        return match
+
+    def param(self, ipv, param, value):
+        """ Returns a test for a (non-negated) rule param. """
+        if param in ['src', 'dst']:
+            return self.network(param, ipv, value)
+        if param in ['in_interface', 'out_interface']:
+            return self.interface(param, value)
+        if param == 'protocol':
+            return self.protocol(value)
+        if param == 'fragment':
+            # Only unfragmented packets are modelled
+            return self.never
+        raise(ValueError("Can not evaluate {}".format(param)))
+
+    def option(self, ipv, match, option, value):
+        """ Returns a test for a match option, or None if it does not
+        restrict packets (e.g. comments). """
+        if match in ['tcp', 'udp', 'multiport'] and option in [
+                'dport', 'sport', 'dports', 'sports', 'ports']:
+            return self.ports(option, value)
+        if match in ['icmp', 'icmp6'] and option in [
+                'icmp-type', 'icmpv6-type']:
+            return self.icmp(ipv, value)
+        if (match, option) in [('state', 'state'),
+                               ('conntrack', 'ctstate')]:
+            return self.state(value)
+        if match == 'set' and option == 'match-set':
+            return self.ipset(value)
+        if match in ['comment', 'limit']:
+            return None
+        raise(ValueError(
+            "Can not evaluate -m {} --{}".format(match, option)))
+
+    @staticmethod
+    def never(packets, idx):
+        return numpy.zeros(idx.shape[0], dtype=bool)
+
+    @staticmethod
+    def negate(test):
+        return lambda packets, idx: ~test(packets, idx)
+
+    @staticmethod
+    def words(network):
+        """ Returns (network, mask) uint64 word arrays of a network. """
+        words = 1 if network.version == 4 else 2
+        split = [(int(network.network_address) >> (64 * w),
+                  int(network.netmask) >> (64 * w))
+                 for w in reversed(range(words))]
+        return (numpy.array([n & 0xFFFFFFFFFFFFFFFF for n, m in split],
+                            dtype=numpy.uint64),
+                numpy.array([m & 0xFFFFFFFFFFFFFFFF for n, m in split],
+                            dtype=numpy.uint64))
+
+    def network(self, param, ipv, value):
+        net, mask = self.words(
+            Rule.IPTABLES[ipv]['addr'](value, strict=False))
+
+        def test(packets, idx):
+            addr = getattr(packets, param)[idx]
+            return numpy.all((addr & mask) == net, axis=1)
+        return test
+
+    @staticmethod
+    def interface(param, value):
+        if value.endswith('+'):
+            prefix = value[:-1]
+            return lambda packets, idx: numpy.char.startswith(
+                getattr(packets, param)[idx], prefix)
+        return lambda packets, idx: getattr(packets, param)[idx] == value
+
+    @staticmethod
+    def protocol(value):
+        number = Packets.numbers(numpy.array([value]), Packets.PROTOCOLS)[0]
+        return lambda packets, idx: packets.protocol[idx] == number
+
+    @staticmethod
+    def ports(option, value):
+        ranges = list()
+        for port in value.split(','):
+            bounds = [int(b) for b in port.split(':')]
+            ranges.append((bounds[0], bounds[-1]))
+
+        if option in ['ports']:
+            fields = ['sport', 'dport']
+        else:
+            fields = [option.rstrip('s')]
+
+        def test(packets, idx):
+            mask = numpy.zeros(idx.shape[0], dtype=bool)
+            for field in fields:
+                port = getattr(packets, field)[idx]
+                for low, high in ranges:
+                    mask |= (port >= low) & (port <= high)
+            return mask
+        return test
+
+    def icmp(self, ipv, value):
+        value = value.split('/')[0]
+        if value == 'any':
+            return None
+        number = self.ICMP_TYPES[ipv].get(value)
+        if isinstance(number, type(None)):
+            number = int(value)
+        return lambda packets, idx: packets.icmp_type[idx] == number
+
+    @staticmethod
+    def state(value):
+        states = Packets.states(numpy.array([value]))[0]
+        return lambda packets, idx: (packets.state[idx] & states) != 0
+
+    def ipset(self, value):
+        name, direction = value.split(',')[:2]
+        if name not in self.sets:
+            raise(ValueError("Unknown ipset {}".format(name)))
+        ipset = self.sets[name]
+        param = 'src' if direction == 'src' else 'dst'
+
+        if ipset.ipv == 4:
+            # Sorted, non-overlapping ranges, searched per packet
+            ranges = ipaddress.collapse_addresses(ipset.entries)
+            bounds = numpy.array(
+                [(int(n.network_address), int(n.broadcast_address))
+                 for n in ranges], dtype=numpy.uint64).reshape(-1, 2)
+            if not bounds.size:
+                return self.never
+
+            def test(packets, idx):
+                addr = getattr(packets, param)[idx][:, 0]
+                pos = numpy.searchsorted(bounds[:, 0], addr,
+                                         side='right') - 1
+                found = pos >= 0
+                pos[~found] = 0
+                return found & (addr <= bounds[pos, 1])
+            return test
+
+        tests = [self.network(param, 6, str(n)) for n in ipset.entries]
+
+        def test(packets, idx):
+            mask = numpy.zeros(idx.shape[0], dtype=bool)
+            for t in tests:
+                mask |= t(packets, idx)
+            return mask
+        return test
+
+
+class Classifier(Matches):
+    """ Evaluates packets against a node's rules, without a kernel.
+
+    Rules of one table are compiled once into vectorized match functions.
+    Jumps to user-defined chains, RETURN and the built-in chain policies of
+    Node.policy are followed. Non-terminal targets (e.g. LOG) are skipped.
+
+    Example:
+    classifier = Classifier(node)
+    verdicts, indices = classifier.classify(packets)
+    """
+
+    # Targets which end rule traversal
+    TERMINAL = ['ACCEPT', 'DROP', 'REJECT']
+
+    # Limit on nested jumps, catches chain loops
+    MAX_DEPTH = 32
+
+    def __init__(self, node, table="FILTER", sets=None, tree=False):
+        """Arguments:
+        node -- the baleful Node to evaluate
+        table -- the table to evaluate (str)
+        sets -- IpSets matched by the rules (default node.ipsets)
+        tree -- Look rules up in a DecisionTree per chain, rather than
+        testing them one by one
+        """
+        super().__init__(
+            sets if not isinstance(sets, type(None)) else node.ipsets)
+        self.node = node
+        self.table = table.upper()
+
+        # {ipv: {chain: [(index, target, match)]}}
+        self.chains = {4: dict(), 6: dict()}
+        rules = {4: dict(), 6: dict()}
+        for index, rule in enumerate(node.rules + node.final_rules):
+            ipv, table, chain, target = rule.key()[:4]
+            if table != self.table:
+                continue
+            self.chains[ipv].setdefault(chain, list()).append(
+                (index, target, None if tree else self.compile(rule)))
+            rules[ipv].setdefault(chain, list()).append(rule)
+
+        # {ipv: {chain: DecisionTree}}
+        self.trees = None
+        if tree:
+            self.trees = {ipv: {chain: DecisionTree(r, ipv, self)
+                                for chain, r in chains.items()}
+                          for ipv, chains in rules.items()}
+
+    def classify(self, packets):
+        """ Returns (verdicts, indices) arrays for a batch of Packets.
+        indices are of the matching rule in node.rules + node.final_rules,
+        or -1 where the chain policy applies. """
+        verdicts = numpy.empty(len(packets), dtype=object)
+        indices = numpy.full(len(packets), -1, dtype=numpy.int64)
+
+        policy = self.node.policy.get(packets.ipv, dict())
+        for chain in numpy.unique(packets.chain):
+            idx = numpy.flatnonzero(packets.chain == chain)
+            v, i = self.evaluate(packets, str(chain), idx)
+            fallthrough = v == None  # noqa: E711
+            v[fallthrough] = policy.get(str(chain), 'ACCEPT')
+            verdicts[idx] = v
+            indices[idx] = i
+        return verdicts, indices
+
+    def classify_one(self, ipv, chain, **kwargs):
+        """ Returns (verdict, index) for a single packet.
+        See Packets for the arguments. """
+        verdicts, indices = self.classify(Packets(ipv, chain, **kwargs))
+        return verdicts[0], int(indices[0])
+
+    def evaluate(self, packets, chain, idx, depth=0):
+        """ Returns (verdicts, indices) for packets idx traversing a chain.
+        Verdicts are None for packets which reach the end of the chain, or
+        a RETURN. """
+        if depth > self.MAX_DEPTH:
+            raise(ValueError(
+                "Jumps nested deeper than {} at {}".format(
+                    self.MAX_DEPTH, chain)))
+
+        verdicts = numpy.full(idx.shape[0], None, dtype=object)
+        indices = numpy.full(idx.shape[0], -1, dtype=numpy.int64)
+        pending = numpy.arange(idx.shape[0])
+
+        if self.trees:
+            self.lookup(packets, chain, idx, verdicts, indices, depth)
+            return verdicts, indices
+
+        for index, target, match in self.chains[packets.ipv].get(chain, []):
+            if not pending.size:
+                break
+            hit = pending[match(packets, idx[pending])]
+            if not hit.size:
+                continue
+
+            if target in self.TERMINAL:
+                verdicts[hit] = target
+                indices[hit] = index
+            elif target == 'RETURN':
+                pass
+            elif target in self.chains[packets.ipv]:
+                v, i = self.evaluate(packets, target, idx[hit], depth + 1)
+                done = v != None  # noqa: E711
+                verdicts[hit[done]] = v[done]
+                indices[hit[done]] = i[done]
+                hit = hit[done]
+            else:
+                # Non-terminal targets, e.g. LOG
+                continue
+            pending = numpy.setdiff1d(pending, hit, assume_unique=True)
+
+        return verdicts, indices
+
+    def lookup(self, packets, chain, idx, verdicts, indices, depth):
+        """ Evaluates packets idx traversing a chain with its DecisionTree,
+        filling in verdicts and indices. """
+        entries = self.chains[packets.ipv].get(chain)
+        if not entries:
+            return
+        tree = self.trees[packets.ipv][chain]
+
+        pending = numpy.arange(idx.shape[0])
+        start = numpy.zeros(idx.shape[0], dtype=numpy.int64)
+        while pending.size:
+            positions = tree.first(packets, idx[pending], start[pending])
+            matched = positions >= 0
+            hits = pending[matched]
+            positions = positions[matched]
+
+            following = list()
+            for position, chunk in DecisionTree.groups(positions):
+                hit = hits[chunk]
+                index, target, match = entries[position]
+                if target in self.TERMINAL:
+                    verdicts[hit] = target
+                    indices[hit] = index
+                    continue
+                elif target in self.chains[packets.ipv]:
+                    v, i = self.evaluate(
+                        packets, target, idx[hit], depth + 1)
+                    done = v != None  # noqa: E711
+                    verdicts[hit[done]] = v[done]
+                    indices[hit[done]] = i[done]
+                    hit = hit[~done]
+                elif target == 'RETURN':
+                    continue
+                start[hit] = position + 1
+                following.append(hit)
+
+            pending = (numpy.concatenate(following) if following
+                       else numpy.zeros(0, dtype=numpy.int64))
+
+
+class DecisionTree:
+    """ A decision diagram over the interval fields of a chain's rules.
+
+    Each level splits on one field (protocol, ports, address words) into
+    intervals, and each interval leads to the node for the rules which can
+    still match. Identical nodes are shared, and rules after one which
+    matches everything left (with a terminal target) are dropped. A lookup
+    takes one binary search per field, then checks the few remaining rules'
+    other matches (interfaces, state, ...) in order, so first-match
+    semantics are kept.
+
+    Example:
+    tree = DecisionTree(rules)
+    positions = tree.first(packets)  # index in rules, or -1
+    """
+
+    WORD = 0xFFFFFFFFFFFFFFFF
+
+    # Targets which end traversal of a chain
+    TERMINAL = Classifier.TERMINAL + ['RETURN']
+
+    def __init__(self, rules, ipv=4, matches=None):
+        """Arguments:
+        rules -- the rules of one chain, in order
+        ipv -- The inet version 4 or 6 (int)
+        matches -- the Matches to compile other matches with
+        (default one without ipsets)
+        """
+        self.ipv = ipv
+        self.rules = list(rules)
+        self.matches = matches if matches else Matches()
+
+        words = 1 if ipv == 4 else 2
+        self.fields = (['protocol', 'dport'] +
+                       ['src{}'.format(w) for w in range(words)] +
+                       ['dst{}'.format(w) for w in range(words)] +
+                       ['sport'])
+        self.domain = {'protocol': 255, 'dport': 65535, 'sport': 65535}
+        for w in range(words):
+            for param in ['src', 'dst']:
+                self.domain[param + str(w)] = (
+                    0xFFFFFFFF if ipv == 4 else self.WORD)
+
+        self.intervals = list()
+        self.residual = list()
+        self.full = list()
+        for rule in self.rules:
+            intervals, tests = self.split(rule)
+            self.intervals.append(intervals)
+            self.residual.append(
+                self.matches.conjunction(tests) if tests else None)
+
+            # The level from which the rule matches every packet
+            level = max([self.fields.index(f) + 1 for f in intervals] + [0])
+            if tests or rule.key()[3] not in self.TERMINAL:
+                level = len(self.fields) + 1
+            self.full.append(level)
+
+        self.kind = list()
+        self.bounds = list()
+        self.children = list()
+        self.leaves = list()
+        self.memo = dict()
+        self.root = self.node(0, tuple(range(len(self.rules))))
+        self.memo = dict()
+        self.kind = numpy.array(self.kind, dtype=numpy.int64)
+
+    def __len__(self):
+        """ Returns the number of nodes. """
+        return len(self.kind)
+
+    def restrict(self, intervals, field, ranges, neg=False):
+        """ Restricts a field of a rule to a list of (low, high) ranges. """
+        domain = self.domain[field]
+        ranges = sorted(ranges)
+        if neg:
+            complement = list()
+            low = 0
+            for start, end in ranges:
+                if start > low:
+                    complement.append((low, start - 1))
+                low = max(low, end + 1)
+            if low <= domain:
+                complement.append((low, domain))
+            ranges = complement
+
+        if field in intervals:
+            ranges = [(max(a, c), min(b, d))
+                      for a, b in intervals[field] for c, d in ranges
+                      if max(a, c) <= min(b, d)]
+        intervals[field] = ranges
+
+    def split(self, rule):
+        """ Returns ({field: ranges}, tests) for a rule.
+        tests are the matches which are not intervals of a field. """
+        ipv, table, chain, target, params, kwargs = rule.key()
+        intervals = dict()
+        tests = list()
+
+        for param, value in params:
+            neg = value.startswith('!')
+            value = value.lstrip('!')
+            if param == 'protocol':
+                number = Packets.numbers(
+                    numpy.array([value]), Packets.PROTOCOLS)[0]
+                self.restrict(intervals, 'protocol',
+                              [(int(number), int(number))], neg)
+            elif param in ['src', 'dst'] and (ipv == 4 or not neg):
+                net = Rule.IPTABLES[ipv]['addr'](value, strict=False)
+                low = int(net.network_address)
+                high = int(net.broadcast_address)
+                if ipv == 4:
+                    self.restrict(intervals, param + '0',
+                                  [(low, high)], neg)
+                    continue
+                self.restrict(intervals, param + '0',
+                              [(low >> 64, high >> 64)])
+                if net.prefixlen > 64:
+                    self.restrict(intervals, param + '1',
+                                  [(low & self.WORD, high & self.WORD)])
+            else:
+                test = self.matches.param(ipv, param, value)
+                tests.append(self.matches.negate(test) if neg else test)
+
+        for match, options in kwargs:
+            for option, value in options:
+                neg = value.startswith('!')
+                value = value.lstrip('!')
+                if (match in ['tcp', 'udp', 'multiport'] and
+                        option in ['dport', 'sport', 'dports', 'sports']):
+                    ranges = list()
+                    for port in value.split(','):
+                        bounds = [int(b) for b in port.split(':')]
+                        ranges.append((bounds[0], bounds[-1]))
+                    self.restrict(intervals, option.rstrip('s'),
+                                  ranges, neg)
+                    continue
+                test = self.matches.option(ipv, match, option, value)
+                if test:
+                    tests.append(self.matches.negate(test) if neg else test)
+
+        return intervals, tests
+
+    def node(self, level, candidates):
+        """ Returns the id of the node for candidate rules at a level. """
+        key = (level, candidates)
+        if key in self.memo:
+            return self.memo[key]
+
+        # Rules after one which matches everything left are unreachable
+        for i, c in enumerate(candidates):
+            if self.full[c] <= level:
+                candidates = candidates[:i + 1]
+                break
+
+        if level == len(self.fields) or not candidates:
+            return self.leaf(key, candidates)
+
+        field = self.fields[level]
+        domain = self.domain[field]
+        points = {0}
+        for c in candidates:
+            for low, high in self.intervals[c].get(field, [(0, domain)]):
+                points.add(low)
+                if high < domain:
+                    points.add(high + 1)
+
+        if len(points) == 1:
+            self.memo[key] = self.node(level + 1, candidates)
+            return self.memo[key]
+
+        # Sweep the elementary intervals, tracking rules covering each
+        points = sorted(points)
+        position = {p: i for i, p in enumerate(points)}
+        starts = dict()
+        ends = dict()
+        for c in candidates:
+            for low, high in self.intervals[c].get(field, [(0, domain)]):
+                starts.setdefault(position[low], list()).append(c)
+                if high < domain:
+                    ends.setdefault(position[high + 1], list()).append(c)
+
+        active = set()
+        bounds = list()
+        children = list()
+        for i, point in enumerate(points):
+            active.difference_update(ends.get(i, ()))
+            active.update(starts.get(i, ()))
+            child = self.node(level + 1, tuple(sorted(active)))
+            if not children or children[-1] != child:
+                bounds.append(point)
+                children.append(child)
+
+        if len(children) == 1:
+            self.memo[key] = children[0]
+            return children[0]
+
+        self.memo[key] = len(self.kind)
+        self.kind.append(level)
+        self.bounds.append(numpy.array(bounds, dtype=numpy.uint64))
+        self.children.append(numpy.array(children, dtype=numpy.int64))
+        self.leaves.append(None)
+        return self.memo[key]
+
+    def leaf(self, key, candidates):
+        """ Returns the id of a leaf of candidate rules. """
+        leaf = ('leaf', candidates)
+        if leaf not in self.memo:
+            self.memo[leaf] = len(self.kind)
+            self.kind.append(-1)
+            self.bounds.append(None)
+            self.children.append(None)
+            self.leaves.append(numpy.array(candidates, dtype=numpy.int64))
+        self.memo[key] = self.memo[leaf]
+        return self.memo[leaf]
+
+    def values(self, packets, field, idx):
+        """ Returns the uint64 values of a field for packets idx. """
+        if field[:3] in ['src', 'dst']:
+            return getattr(packets, field[:3])[idx, int(field[3:])]
+        return getattr(packets, field)[idx].astype(numpy.uint64)
+
+    @staticmethod
+    def groups(keys):
+        """ Yields (key, positions) for each distinct key. """
+        order = numpy.argsort(keys, kind='stable')
+        distinct, starts = numpy.unique(keys[order], return_index=True)
+        return zip(distinct, numpy.split(order, starts[1:]))
+
+    def lookup(self, packets, idx):
+        """ Returns the leaf id of packets idx. """
+        nodes = numpy.full(idx.shape[0], self.root, dtype=numpy.int64)
+        while True:
+            inner = numpy.flatnonzero(self.kind[nodes] >= 0)
+            if not inner.size:
+                return nodes
+            for node, chunk in self.groups(nodes[inner]):
+                chunk = inner[chunk]
+                values = self.values(
+                    packets, self.fields[self.kind[node]], idx[chunk])
+                pos = numpy.searchsorted(
+                    self.bounds[node], values, side='right') - 1
+                nodes[chunk] = self.children[node][pos]
+
+    def first(self, packets, idx=None, start=None):
+        """ Returns the position of the first rule matching each packet,
+        or -1.
+        idx -- the packets of the batch to look up (default all)
+        start -- skip rules before these positions (default 0) """
+        if isinstance(idx, type(None)):
+            idx = numpy.arange(len(packets))
+        if isinstance(start, type(None)):
+            start = numpy.zeros(idx.shape[0], dtype=numpy.int64)
+
+        result = numpy.full(idx.shape[0], -1, dtype=numpy.int64)
+        for leaf, chunk in self.groups(self.lookup(packets, idx)):
+            remaining = numpy.ones(chunk.shape[0], dtype=bool)
+            begin = start[chunk]
+            for c in self.leaves[leaf]:
+                hit = remaining & (begin <= c)
+                if self.residual[c] and hit.any():
+                    sub = numpy.flatnonzero(hit)
+                    hit[sub] = self.residual[c](packets, idx[chunk[sub]])
+                result[chunk[hit]] = c
+                remaining &= ~hit
+                if not remaining.any():
+                    break
+        return result
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+"""Compiles the rulesets of many hosts from one app catalog and a set of
+named topologies, in a process pool.
+
+The catalog and topologies are frozen once, and sent to each worker once,
+when the worker starts. Hosts are compiled independently, and the output
+does not depend on the number of workers or the order hosts complete in.
+"""
+
+import concurrent.futures
+import ipaddress
+import os
+import time
+import baleful.app
+from baleful.node import Node
+from baleful.rule import Rule, RuleArray
+from baleful.topo import Topology
+
+
+class Service:
+    """ An application a host serves or uses. """
+
+    ROLES = ['client', 'server']
+
+    def __init__(self, app, role='client', topology='any', interface=None):
+        """Arguments:
+        app -- the name of the application in the catalog, e.g. 'ssh'
+        role -- 'client' connects out, 'server' accepts connections
+        topology -- the name of a fleet topology, e.g. 'any' or 'lan'
+        interface -- the host interface, or None for all of them
+        """
+        if role not in self.ROLES:
+            raise(ValueError("Unknown role: {}".format(role)))
+        self.app = app
+        self.role = role
+        self.topology = topology
+        self.interface = interface
+
+
+class Host:
+    """ The description of a host to compile. """
+
+    def __init__(self,
+                 hostname,
+                 interfaces=None,
+                 services=None,
+                 policy=None,
+                 rules=None,
+                 final_rules=None):
+        """Arguments:
+        hostname -- the hostname, also the name of its artifacts
+        interfaces -- a dict {interface: [address/prefix, ...]}
+        services -- a list of Services
+        policy -- a dict of policies for the filter table, see Node
+        rules -- a list of rules before the services' rules
+        final_rules -- a list of rules after the services' rules
+        """
+        self.hostname = hostname
+        self.interfaces = interfaces if interfaces else dict()
+        self.services = services if services else list()
+        self.policy = policy
+        self.rules = rules if rules else list()
+        self.final_rules = final_rules if final_rules else list()
+
+    def topology(self, interface, address, role):
+        """ Returns the Topology of traffic from an address of the host.
+        A client sends out of the interface, and receives replies into it,
+        a server the reverse. """
+        addr = ipaddress.ip_interface(address)
+        ipv = addr.version
+        host = str(addr.ip)
+        out = Rule(chain="OUTPUT", ipv=ipv,
+                   params={'out_interface': interface, 'src': host})
+        into = Rule(chain="INPUT", ipv=ipv,
+                    params={'in_interface': interface, 'dst': host})
+        if role == 'server':
+            out, into = into, out
+        return Topology(RuleArray(out), RuleArray(into))
+
+    @staticmethod
+    def family(topology, ipv):
+        """ Returns the Topology of the rules of an inet version, those with
+        another version, or addresses of another version, are removed. """
+        def matches(rule):
+            if rule.ipv and rule.ipv != ipv:
+                return False
+            params = dict(rule.params)
+            for key in ['src', 'dst']:
+                value = params.get(key)
+                if isinstance(value, str):
+                    value = ipaddress.ip_network(value.lstrip('!'),
+                                                 strict=False)
+                if (value and value.version != ipv and
+                        value != Rule.WILD_NET[value.version]):
+                    return False
+            return True
+
+        return Topology(RuleArray(*filter(matches, topology.forward)),
+                        RuleArray(*filter(matches, topology.reverse)))
+
+    def node(self, catalog, topologies):
+        """ Returns the host's Node.
+        The rules of each service, on each address of its interfaces, are
+        host topology * fleet topology * app. Fleet topologies are written
+        as seen by a client, e.g. the remote address is 'dst', and are
+        flipped for servers. Only the fleet topology's rules of the address'
+        inet version apply, see Host.family.
+        catalog -- a dict {app: RuleArray or Topology}
+        topologies -- a dict {name: Topology} """
+        rules = list(self.rules)
+        for service in self.services:
+            if service.app not in catalog:
+                raise(ValueError("Unknown app: {}".format(service.app)))
+            if service.topology not in topologies:
+                raise(ValueError("Unknown topology: {}".format(
+                    service.topology)))
+            app = catalog[service.app]
+            topo = topologies[service.topology]
+            if service.role == 'server':
+                topo = Topology(topo.forward.flipped(),
+                                topo.reverse.flipped())
+
+            names = sorted(self.interfaces)
+            if not isinstance(service.interface, type(None)):
+                if service.interface not in self.interfaces:
+                    raise(ValueError("Unknown interface: {}".format(
+                        service.interface)))
+                names = [service.interface]
+
+            for name in names:
+                for address in self.interfaces[name]:
+                    ipv = ipaddress.ip_interface(address).version
+                    rules += list(self.topology(name, address, service.role)
+                                  * self.family(topo, ipv) * app)
+
+        return Node(self.hostname,
+                    rules=rules,
+                    policy=self.policy,
+                    final_rules=list(self.final_rules))
+
+
+class Build:
+    """ The compiled artifacts of a host. """
+
+    def __init__(self, hostname, artifacts=None, rules=0, seconds=0.0,
+                 error=None, cached=False):
+        """Arguments:
+        hostname -- the hostname
+        artifacts -- a dict {suffix: text}, e.g. {'rules': ..., 'rules6': ...}
+        rules -- the number of rules compiled
+        seconds -- the time taken to compile the host
+        error -- the error message, if the host failed to compile
+        cached -- whether the artifacts were loaded from a Cache
+        """
+        self.hostname = hostname
+        self.artifacts = artifacts if artifacts else dict()
+        self.rules = rules
+        self.seconds = seconds
+        self.error = error
+        self.cached = cached
+
+    def __str__(self):
+        if self.error:
+            return '{} failed: {}'.format(self.hostname, self.error)
+        return '{} {} rules {:.3f} s{}'.format(
+            self.hostname, self.rules, self.seconds,
+            ' (cached)' if self.cached else '')
+
+
+# The fleet's frozen catalog and topologies, in each worker process.
+_SHARED = dict()
+
+
+def _share(catalog, topologies):
+    """ Initializes a worker with the fleet's shared inputs. """
+    _SHARED['catalog'] = catalog
+    _SHARED['topologies'] = topologies
+
+
+def _error(e):
+    """ Returns the error message of a failed build. """
+    if isinstance(e, ValueError):
+        return str(e)
+    return '{}: {}'.format(type(e).__name__, e)
+
+
+def _compile(host, formats):
+    """ Compiles a host with the shared inputs, returns a Build.
+    Errors are returned in the Build, so a malformed host does not stop
+    the other hosts. """
+    start = time.perf_counter()
+    try:
+        node = host.node(_SHARED['catalog'], _SHARED['topologies'])
+        artifacts = dict()
+        if 'restore' in formats:
+            artifacts['rules'] = node.restore(ipv=4)
+            artifacts['rules6'] = node.restore(ipv=6)
+        if 'nft' in formats:
+            artifacts['nft'] = node.nft()
+    except Exception as e:
+        return Build(host.hostname, error=_error(e),
+                     seconds=time.perf_counter() - start)
+
+    return Build(host.hostname,
+                 artifacts=artifacts,
+                 rules=len(node.rules) + len(node.final_rules),
+                 seconds=time.perf_counter() - start)
+
+
+class Fleet:
+    """ Compiles many hosts from a shared app catalog and topologies. """
+
+    FORMATS = ['restore', 'nft']
+
+    def __init__(self, hosts, catalog=None, topologies=None,
+                 formats=('restore',), cache=None):
+        """Arguments:
+        hosts -- a list of Hosts, with unique hostnames
+        catalog -- a dict {app: RuleArray or Topology},
+        (default the applications in baleful.app)
+        topologies -- a dict {name: Topology} of fleet topologies, added
+        to 'any', which accepts all traffic of an app
+        formats -- the artifacts to render, 'restore' and/or 'nft'
+        cache -- a Cache of compiled hosts (default none)
+        """
+        names = [host.hostname for host in hosts]
+        if len(set(names)) != len(names):
+            raise(ValueError("Duplicate hostnames"))
+        for f in formats:
+            if f not in self.FORMATS:
+                raise(ValueError("Unknown format: {}".format(f)))
+
+        if isinstance(catalog, type(None)):
+            catalog = {k: v for k, v in vars(baleful.app).items()
+                       if isinstance(v, (RuleArray, Topology))}
+        shared = {'any': Topology(RuleArray(Rule(target="ACCEPT")))}
+        if topologies:
+            shared.update(topologies)
+
+        self.hosts = sorted(hosts, key=lambda host: host.hostname)
+        self.catalog = {k: v.freeze() for k, v in catalog.items()}
+        self.topologies = {k: v.freeze() for k, v in shared.items()}
+        self.formats = tuple(formats)
+        self.cache = cache
+
+    def compile(self, workers=None, progress=None):
+        """ Compiles every host, returns a list of Builds by hostname.
+        workers -- the number of worker processes, (default os.cpu_count())
+        0 or 1 compiles in this process
+        progress -- a function called as progress(done, total, build),
+        as each host completes """
+        total = len(self.hosts)
+        builds = dict()
+
+        def done(build):
+            builds[build.hostname] = build
+            if progress:
+                progress(len(builds), total, build)
+
+        hosts = self.hosts
+        keys = dict()
+        if self.cache:
+            # The shared inputs are hashed once, not per host.
+            shared = self.cache.key(self.catalog, self.topologies,
+                                    self.formats)
+            hosts = list()
+            for host in self.hosts:
+                start = time.perf_counter()
+                key = self.cache.key(shared, host)
+                entry = self.cache.get(key)
+                if isinstance(entry, type(None)):
+                    keys[host.hostname] = key
+                    hosts.append(host)
+                else:
+                    done(Build(host.hostname,
+                               artifacts=entry['artifacts'],
+                               rules=entry['rules'],
+                               seconds=time.perf_counter() - start,
+                               cached=True))
+
+        def compiled(build):
+            if build.hostname in keys and not build.error:
+                self.cache.put(keys[build.hostname],
+                               {'artifacts': build.artifacts,
+                                'rules': build.rules})
+            done(build)
+
+        if isinstance(workers, type(None)):
+            workers = os.cpu_count() or 1
+
+        if workers <= 1 or len(hosts) <= 1:
+            _share(self.catalog, self.topologies)
+            for host in hosts:
+                compiled(_compile(host, self.formats))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=min(workers, len(hosts)),
+                    initializer=_share,
+                    initargs=(self.catalog, self.topologies)) as pool:
+                futures = {pool.submit(_compile, host, self.formats): host
+                           for host in hosts}
+                for future in concurrent.futures.as_completed(futures):
+                    # e.g. a host which can not be sent to a worker
+                    try:
+                        build = future.result()
+                    except Exception as e:
+                        build = Build(futures[future].hostname,
+                                      error=_error(e))
+                    compiled(build)
+
+        return [builds[host.hostname] for host in self.hosts]
+
+    @staticmethod
+    def write(builds, directory):
+        """ Writes each build's artifacts to directory/hostname.suffix,
+        returns the paths written. Failed builds are skipped. """
+        os.makedirs(directory, exist_ok=True)
+        paths = list()
+        for build in builds:
+            if build.error:
+                continue
+            for suffix, text in sorted(build.artifacts.items()):
+                path = os.path.join(directory, '{}.{}'.format(
+                    build.hostname, suffix))
+                with open(path, 'w') as fp:
+                    fp.write(text)
+                paths.append(path)
+        return paths
+
+    @staticmethod
+    def report(done, total, build):
+        """ A progress function, printing each build. """
+        print('[{:{w}d}/{}] {}'.format(done, total, build,
+                                       w=len(str(total))), flush=True)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import hashlib
+import ipaddress
+import subprocess
+
+
+class IpSet:
+    """ An ipset of networks, rendered as 'ipset restore' input.
+
+    Sets generated from rules are named after their content (see
+    IpSet.named), so a changed set gets a new name. Creating the sets before
+    the rules that reference them means iptables-restore switches rules
+    between old and new sets in its own atomic commit. Superseded sets are
+    destroyed afterwards, see Node.prune_ipset.
+    """
+
+    FAMILY = {4: 'inet',
+              6: 'inet6'}
+
+    # ipset defaults, sets larger than this need a larger maxelem
+    MAXELEM = 65536
+
+    def __init__(self, name, entries, ipv=4, settype=None):
+        """Arguments:
+        name -- the name of the set (max 31 characters)
+        entries -- network addresses (str or ip_network)
+        ipv -- The inet version 4 or 6 (int)
+        settype -- hash:ip or hash:net, worked out from entries by default
+        """
+        if len(name) > 31:
+            raise(ValueError(
+                "ipset name {} is longer than 31 characters".format(name)))
+
+        self.name = name
+        self.ipv = ipv
+        self.entries = [ipaddress.ip_network(e, strict=False)
+                        for e in entries]
+
+        for entry in self.entries:
+            if entry.version != ipv:
+                raise(ValueError(
+                    "{} is not an ipv{} network".format(entry, ipv)))
+
+        if not settype:
+            hosts = all(e.prefixlen == e.max_prefixlen
+                        for e in self.entries)
+            settype = 'hash:ip' if hosts else 'hash:net'
+        self.settype = settype
+
+    @classmethod
+    def named(cls, entries, ipv=4, prefix='baleful'):
+        """ Returns an IpSet named after a digest of its entries. """
+        entries = sorted(set(ipaddress.ip_network(e, strict=False)
+                             for e in entries))
+        digest = hashlib.sha1(
+            '\n'.join(str(e) for e in entries).encode()).hexdigest()
+        name = '{}{}-{}'.format(prefix[:18], ipv, digest[:10])
+        return cls(name, entries, ipv=ipv)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        return self.name
+
+    def match(self, direction='src'):
+        """ Returns iptables set match kwargs for this set.
+        direction -- 'src' or 'dst' """
+        return {'set': {'match_set': (self.name, direction)}}
+
+    def create(self):
+        """ Returns the 'ipset restore' line to create the set. """
+        line = 'create {} {} family {}'.format(
+            self.name, self.settype, self.FAMILY[self.ipv])
+        if len(self.entries) > self.MAXELEM:
+            line += ' maxelem {}'.format(len(self.entries))
+        return line + ' -exist'
+
+    def restore(self):
+        """ Returns 'ipset restore' input to create and fill the set.
+        Existing sets and entries are kept (-exist). """
+        lines = [self.create()]
+        for entry in self.entries:
+            if self.settype == 'hash:ip':
+                entry = entry.network_address
+            lines.append('add {} {} -exist'.format(self.name, entry))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def apply(text):
+        """ Applies 'ipset restore' input. """
+        subprocess.run(['ipset', 'restore'],
+                       input=text,
+                       universal_newlines=True,
+                       check=True)
+
+    @staticmethod
+    def destroy(name):
+        """ Destroys a set, unless it is in use.
+        Returns True if the set was destroyed. """
+        proc = subprocess.run(['ipset', 'destroy', name],
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+        return not proc.returncode
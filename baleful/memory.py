@@ -0,0 +1,499 @@
+#!/usr/bin/env python3
+
+"""An in-memory netfilter backend.
+Implements the parts of the python-iptables API which baleful uses (tables,
+chains, rules, matches, targets and policies), so node apply, sync, status
+and lock paths run without root or a kernel. See Backend.install."""
+
+import contextlib
+import errno
+import ipaddress
+import os
+import time
+import iptc
+from baleful.rule import Rule as BalefulRule
+
+
+class IPTCError(iptc.ip4tc.IPTCError):
+    """ An error of the in-memory backend, caught as an iptc error. """
+
+
+class Backend:
+    """ An in-memory netfilter, in place of the kernel.
+
+    Tables, chains, policies, rules and counters are kept per inet version.
+    A table handle reads a copy of its table and commits it back as a whole,
+    as libiptc does: a commit fails with EAGAIN if another handle committed
+    the table since it was read, and counters of unchanged rules carry over.
+    Each commit takes overhead seconds, plus latency seconds per rule in the
+    committed table.
+
+    Example:
+    backend = Backend(latency=1e-6)
+    with backend.install():
+        node.start()
+        backend.count(4, "FILTER", "INPUT", 0, packets=10, nbytes=600)
+        print(node.status())
+    """
+
+    BUILTIN = {'FILTER': ['INPUT', 'FORWARD', 'OUTPUT'],
+               'NAT': ['PREROUTING', 'INPUT', 'OUTPUT', 'POSTROUTING'],
+               'MANGLE': ['PREROUTING', 'INPUT', 'FORWARD', 'OUTPUT',
+                          'POSTROUTING'],
+               'RAW': ['PREROUTING', 'OUTPUT'],
+               'SECURITY': ['INPUT', 'FORWARD', 'OUTPUT']}
+
+    def __init__(self, latency=0.0, overhead=0.0):
+        """Arguments:
+        latency -- simulated commit time per rule in a table (seconds)
+        overhead -- simulated time per commit (seconds)
+        """
+        self.latency = latency
+        self.overhead = overhead
+        self.tables = dict()
+        self.commits = 0
+        self.elapsed = 0.0
+
+        table = type('Table', (Table,), {'backend': self})
+        table6 = type('Table6', (table,), {'ipv': 6,
+                                           'ALL': Table6.ALL})
+        self.iptables = {4: {'module': iptc,
+                             'rule': Rule,
+                             'table': table,
+                             'chain': Chain},
+                         6: {'module': iptc,
+                             'rule': Rule6,
+                             'table': table6,
+                             'chain': Chain}}
+
+    def state(self, ipv, name):
+        """ Returns the committed state of a table, creating it if needed.
+        A dict {'generation': commits, 'chains': {chain: {'policy': policy,
+        'rules': [Rule]}}} """
+        key = (ipv, name.upper())
+        if key not in self.tables:
+            self.tables[key] = {
+                'generation': 0,
+                'chains': {chain: {'policy': 'ACCEPT', 'rules': list()}
+                           for chain in self.BUILTIN[key[1]]}}
+        return self.tables[key]
+
+    def rules(self, ipv=4, table="FILTER", chain="OUTPUT"):
+        """ Returns the committed rules of a chain. """
+        return list(self.state(ipv, table)['chains'][chain]['rules'])
+
+    def count(self, ipv=4, table="FILTER", chain="OUTPUT", position=0,
+              packets=1, nbytes=0):
+        """ Adds to the counters of a committed rule, as matched traffic
+        would. Open handles see the new counters when they commit. """
+        counters = self.rules(ipv, table, chain)[position].counters
+        counters[0] += packets
+        counters[1] += nbytes
+
+    def wait(self, seconds):
+        """ Simulates time spent in the kernel. """
+        self.elapsed += seconds
+        if seconds > 0:
+            time.sleep(seconds)
+
+    @contextlib.contextmanager
+    def install(self):
+        """ A context manager using this backend for all baleful rules.
+        The previous backend is restored on exit. """
+        previous = BalefulRule.use(self.iptables)
+        try:
+            yield self
+        finally:
+            BalefulRule.use(previous)
+
+
+class Table:
+    """ A handle of an in-memory table, as iptc.Table.
+    Unlike iptc, every handle is independent, so concurrent writers can be
+    simulated with several handles. """
+
+    FILTER = "filter"
+    NAT = "nat"
+    MANGLE = "mangle"
+    RAW = "raw"
+    SECURITY = "security"
+    ALL = ["filter", "mangle", "raw", "nat", "security"]
+
+    ipv = 4
+    backend = None
+
+    def __init__(self, name, autocommit=True):
+        """Arguments:
+        name -- the table name, e.g. Table.FILTER
+        autocommit -- commit after every change
+        """
+        if name.upper() not in Backend.BUILTIN:
+            raise(IPTCError("can't initialize {}: {}".format(
+                name, os.strerror(errno.ENOENT))))
+        self.name = name
+        self.autocommit = autocommit
+        self.refresh()
+
+    def refresh(self):
+        """ Re-reads the table, discarding uncommitted changes. """
+        state = self.backend.state(self.ipv, self.name)
+        self.generation = state['generation']
+        self._chains = {
+            name: {'policy': chain['policy'],
+                   'rules': [rule.copy(origin=rule)
+                             for rule in chain['rules']]}
+            for name, chain in state['chains'].items()}
+
+    def commit(self):
+        """ Commits the table, replacing the committed state. """
+        state = self.backend.state(self.ipv, self.name)
+        if state['generation'] != self.generation:
+            raise(IPTCError("can't commit: {}".format(
+                os.strerror(errno.EAGAIN))))
+
+        size = sum(len(chain['rules']) for chain in self._chains.values())
+        self.backend.wait(self.backend.overhead + self.backend.latency * size)
+
+        state['chains'] = {
+            name: {'policy': chain['policy'],
+                   'rules': [rule.copy(counters=(
+                       rule.origin.counters if rule.origin
+                       else rule.counters)) for rule in chain['rules']]}
+            for name, chain in self._chains.items()}
+        state['generation'] += 1
+        self.generation = state['generation']
+        self.backend.commits += 1
+
+    def changed(self):
+        """ Commits a change, if autocommit is set. """
+        if self.autocommit:
+            self.commit()
+            self.refresh()
+
+    def builtin(self, name):
+        """ Returns True, if name is a built-in chain of the table. """
+        return name in Backend.BUILTIN[self.name.upper()]
+
+    def entries(self, name):
+        """ Returns the (uncommitted) state of a chain. """
+        if name not in self._chains:
+            raise(IPTCError("No chain/target/match by that name"))
+        return self._chains[name]
+
+    @property
+    def chains(self):
+        """ The chains of the table, built-in chains first. """
+        names = [name for name in self._chains if self.builtin(name)]
+        names += sorted(name for name in self._chains
+                        if not self.builtin(name))
+        return [Chain(self, name) for name in names]
+
+    def is_chain(self, name):
+        return name in self._chains
+
+    def builtin_chain(self, name):
+        return self.builtin(name)
+
+    def create_chain(self, name):
+        if name in self._chains:
+            raise(IPTCError("can't create chain {}: {}".format(
+                name, os.strerror(errno.EEXIST))))
+        self._chains[name] = {'policy': None, 'rules': list()}
+        self.changed()
+        return Chain(self, name)
+
+    def delete_chain(self, name):
+        if isinstance(name, Chain):
+            name = name.name
+        entries = self.entries(name)
+        if self.builtin(name):
+            reason = errno.EPERM
+        elif entries['rules']:
+            reason = errno.ENOTEMPTY
+        elif any(rule.target and rule.target.name == name
+                 for chain in self._chains.values()
+                 for rule in chain['rules']):
+            reason = errno.EBUSY
+        else:
+            del self._chains[name]
+            self.changed()
+            return
+        raise(IPTCError("can't delete chain {}: {}".format(
+            name, os.strerror(reason))))
+
+    def delete_num_entry(self, name, position):
+        """ Deletes the rule at a (0-based) position of a chain, as
+        libiptc's iptc_delete_num_entry. """
+        rules = self.entries(name)['rules']
+        if position >= len(rules):
+            raise(IPTCError("Index of deletion too big"))
+        del rules[position]
+        self.changed()
+
+    def flush_entries(self, name):
+        self.entries(name)['rules'] = list()
+        self.changed()
+
+    def zero_entries(self, name):
+        for rule in self.entries(name)['rules']:
+            rule.counters = [0, 0]
+            rule.origin = None
+        self.changed()
+
+
+class Table6(Table):
+    """ A handle of an in-memory ip6 table, as iptc.Table6. """
+
+    ALL = ["filter", "mangle", "raw", "security", "nat"]
+
+    ipv = 6
+
+
+class Policy:
+    """ A chain policy, as iptc.Policy. """
+
+    def __init__(self, name):
+        self.name = name
+
+
+class Chain:
+    """ A chain of an in-memory table handle, as iptc.Chain. """
+
+    # Targets which are not chains
+    TARGETS = ['', 'ACCEPT', 'DROP', 'QUEUE', 'RETURN', 'REJECT', 'LOG',
+               'NFLOG', 'NFQUEUE', 'MARK', 'CONNMARK', 'CT', 'NOTRACK',
+               'MASQUERADE', 'SNAT', 'DNAT', 'REDIRECT', 'TCPMSS', 'TRACE',
+               'CLASSIFY', 'TEE', 'AUDIT', 'CHECKSUM', 'SET', 'DSCP', 'TOS',
+               'TTL', 'HL']
+
+    def __init__(self, table, name):
+        """Arguments:
+        table -- the Table handle
+        name -- the chain name
+        """
+        self.table = table
+        self.name = name
+
+    @property
+    def rules(self):
+        """ The rules of the chain, as read by the table handle. """
+        return [rule.copy(chain=self, origin=rule.origin)
+                for rule in self.table.entries(self.name)['rules']]
+
+    def entry(self, rule):
+        """ Returns a copy of a rule to add to the chain. """
+        target = rule.target.name if rule.target else ''
+        if target not in self.TARGETS and not self.table.is_chain(target):
+            raise(IPTCError("No chain/target/match by that name"))
+        return rule.copy(chain=self, counters=[0, 0])
+
+    def append_rule(self, rule):
+        self.table.entries(self.name)['rules'].append(self.entry(rule))
+        self.table.changed()
+
+    def insert_rule(self, rule, position=0):
+        rules = self.table.entries(self.name)['rules']
+        if position > len(rules):
+            raise(IPTCError("Index of insertion too big"))
+        rules.insert(position, self.entry(rule))
+        self.table.changed()
+
+    def replace_rule(self, rule, position=0):
+        rules = self.table.entries(self.name)['rules']
+        if position >= len(rules):
+            raise(IPTCError("Index of replacement too big"))
+        rules[position] = self.entry(rule)
+        self.table.changed()
+
+    def delete_rule(self, rule):
+        rules = self.table.entries(self.name)['rules']
+        for position, entry in enumerate(rules):
+            if entry == rule:
+                del rules[position]
+                self.table.changed()
+                return
+        raise(IPTCError(
+            "Bad rule (does a matching rule exist in that chain?)"))
+
+    def flush(self):
+        self.table.flush_entries(self.name)
+
+    def zero_counters(self):
+        self.table.zero_entries(self.name)
+
+    def delete(self):
+        self.table.delete_chain(self.name)
+
+    def is_builtin(self):
+        return self.table.builtin(self.name)
+
+    def get_policy(self):
+        policy = self.table.entries(self.name)['policy']
+        return Policy(policy) if policy else None
+
+    def set_policy(self, policy, counters=None):
+        if isinstance(policy, Policy):
+            policy = policy.name
+        if not self.is_builtin() or policy not in ['ACCEPT', 'DROP']:
+            raise(IPTCError("can't set policy {} on chain {}".format(
+                policy, self.name)))
+        self.table.entries(self.name)['policy'] = policy
+        self.table.changed()
+
+
+class Match:
+    """ A rule match, as iptc.Match.
+    Values are kept as lists of strings, with negation as a leading '!'. """
+
+    def __init__(self, rule, name):
+        self.rule = rule
+        self.name = name
+        self.parameters = dict()
+
+    def set_parameter(self, parameter, value=None):
+        if isinstance(value, (list, tuple)):
+            values = [str(v) for v in value]
+        elif isinstance(value, type(None)):
+            values = list()
+        else:
+            values = [str(value).strip()]
+            if values[0].startswith('!'):
+                values = ['!'] + [v for v in [values[0][1:].strip()] if v]
+        self.parameters[parameter.replace('_', '-')] = values
+
+    def get_all_parameters(self):
+        return {k: list(v) for k, v in self.parameters.items()}
+
+    def copy(self, rule):
+        match = type(self)(rule, self.name)
+        match.parameters = self.get_all_parameters()
+        return match
+
+    def key(self):
+        return (self.name, tuple(sorted(
+            (k, tuple(v)) for k, v in self.parameters.items())))
+
+
+class Target(Match):
+    """ A rule target, as iptc.Target. """
+
+
+class Rule:
+    """ A rule, as iptc.Rule.
+    counters -- [packets, bytes] matched by the rule
+    origin -- the committed rule this was read from, if any """
+
+    ipv = 4
+
+    ADDR = ipaddress.IPv4Network
+
+    def __init__(self, entry=None, chain=None):
+        self.chain = chain
+        self.src = str(self.ADDR((0, 0)))
+        self.dst = str(self.ADDR((0, 0)))
+        self.in_interface = None
+        self.out_interface = None
+        self.protocol = 'ip'
+        self.fragment = False
+        self.matches = list()
+        self.target = None
+        self.counters = [0, 0]
+        self.origin = None
+
+    def copy(self, chain=None, counters=None, origin=None):
+        """ Returns a copy of the rule, in another chain (default the same).
+        counters -- the counters of the copy (default a copy of these) """
+        rule = type(self)(chain=chain if chain else self.chain)
+        for name in ['src', 'dst', 'in_interface', 'out_interface',
+                     'protocol', 'fragment']:
+            setattr(rule, name, getattr(self, name))
+        rule.matches = [match.copy(rule) for match in self.matches]
+        if self.target:
+            rule.target = self.target.copy(rule)
+        rule.counters = list(counters if counters else self.counters)
+        rule.origin = origin
+        return rule
+
+    def key(self):
+        """ Returns the rule as compared by the kernel, without counters. """
+        return (self.src, self.dst, self.in_interface, self.out_interface,
+                self.protocol, self.fragment,
+                tuple(match.key() for match in self.matches),
+                self.target.key() if self.target else None)
+
+    def __eq__(self, other):
+        if not isinstance(other, Rule):
+            return NotImplemented
+        return self.ipv == other.ipv and self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __address(self, value):
+        neg = '!' if value.startswith('!') else ''
+        return neg + str(self.ADDR(value.lstrip('!').strip(), strict=False))
+
+    def __show(self, value):
+        neg = '!' if value.startswith('!') else ''
+        net = self.ADDR(value.lstrip('!'))
+        return neg + (net.with_netmask if self.ipv == 4
+                      else net.with_prefixlen)
+
+    def set_src(self, value):
+        self.src = self.__address(value)
+
+    def get_src(self):
+        return self.__show(self.src)
+
+    def set_dst(self, value):
+        self.dst = self.__address(value)
+
+    def get_dst(self):
+        return self.__show(self.dst)
+
+    def set_in_interface(self, value):
+        self.in_interface = value if value else None
+
+    def get_in_interface(self):
+        return self.in_interface
+
+    def set_out_interface(self, value):
+        self.out_interface = value if value else None
+
+    def get_out_interface(self):
+        return self.out_interface
+
+    def set_protocol(self, value):
+        self.protocol = str(value).lower() if value else 'ip'
+
+    def get_protocol(self):
+        return self.protocol
+
+    def set_fragment(self, value):
+        self.fragment = bool(value)
+
+    def get_fragment(self):
+        return self.fragment
+
+    def create_match(self, name):
+        match = Match(self, name)
+        self.matches.append(match)
+        return match
+
+    def create_target(self, name):
+        self.target = Target(self, name if name else '')
+        return self.target
+
+    def get_counters(self):
+        return tuple(self.counters)
+
+
+class Rule6(Rule):
+    """ A rule, as iptc.Rule6. """
+
+    ipv = 6
+
+    ADDR = ipaddress.IPv6Network
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import hashlib
+import http.server
+import os
+import time
+
+
+class Exporter:
+    """ Exports per-rule counters of a node in the Prometheus text format.
+
+    Each scrape takes one snapshot (see Node.status). Labels are rendered
+    once per rule key and reused, and per-second rates are derived from the
+    previous scrape.
+
+    Example:
+    exporter = Exporter(node, apps={'ssh': topo * app.ssh})
+    exporter.write('/var/lib/node_exporter/baleful.prom')
+    """
+
+    PREFIX = 'baleful_rule'
+
+    METRICS = [('packets_total', 'counter', 'Packets matched by a rule.'),
+               ('bytes_total', 'counter', 'Bytes matched by a rule.'),
+               ('packets_rate', 'gauge',
+                'Packets per second matched by a rule, since the last scrape.'),
+               ('bytes_rate', 'gauge',
+                'Bytes per second matched by a rule, since the last scrape.'),
+               ('exists', 'gauge', 'Whether a rule is installed.')]
+
+    def __init__(self, node, apps=None):
+        """Arguments:
+        node -- the baleful Node to export
+        apps -- a dict of application names to their rules, to label rules
+        with (default none)
+        """
+        self.node = node
+        self.apps = dict()
+        for name, rules in (apps if apps else dict()).items():
+            for rule in rules:
+                self.apps.setdefault(rule.key(), name)
+
+        self.labels = dict()
+        self.samples = dict()
+
+    @staticmethod
+    def rule_id(rule):
+        """ Returns a stable ID for a rule, from its canonical key. """
+        return hashlib.sha1(repr(rule.key()).encode()).hexdigest()[:12]
+
+    @staticmethod
+    def escape(value):
+        """ Escapes a label value. """
+        return (str(value).replace('\\', '\\\\')
+                .replace('"', '\\"').replace('\n', '\\n'))
+
+    def label(self, rule):
+        """ Returns (rule ID, rendered labels) for a rule, cached by key. """
+        key = rule.key()
+        if key not in self.labels:
+            ipv, table, chain, target = key[:4]
+            rid = self.rule_id(rule)
+            self.labels[key] = (rid, ','.join(
+                '{}="{}"'.format(k, self.escape(v)) for k, v in [
+                    ('id', rid),
+                    ('ipv', ipv),
+                    ('table', table.lower()),
+                    ('chain', chain),
+                    ('target', target if target else ''),
+                    ('app', self.apps.get(key, ''))]))
+        return self.labels[key]
+
+    def collect(self, now=None):
+        """ Returns {metric: [(labels, value)]} from one snapshot.
+        now -- the time of the scrape (default time.time()) """
+        if isinstance(now, type(None)):
+            now = time.time()
+
+        rules = self.node.rules + self.node.final_rules
+        stats = self.node.status()
+
+        metrics = {name: list() for name, kind, text in self.METRICS}
+        samples = dict()
+        seen = dict()
+        for rule, (exists, (packets, nbytes)) in zip(rules, stats):
+            rid, labels = self.label(rule)
+
+            # Repeated rules get their own series
+            seen[rid] = seen.get(rid, 0) + 1
+            if seen[rid] > 1:
+                rid = '{}-{}'.format(rid, seen[rid])
+                labels = labels.replace(
+                    'id="{}"'.format(rid.rsplit('-', 1)[0]),
+                    'id="{}"'.format(rid), 1)
+
+            metrics['packets_total'].append((labels, packets))
+            metrics['bytes_total'].append((labels, nbytes))
+            metrics['exists'].append((labels, int(exists)))
+            samples[rid] = (now, packets, nbytes)
+
+            if rid in self.samples:
+                then, last_packets, last_bytes = self.samples[rid]
+                elapsed = now - then
+                if elapsed > 0:
+                    # Counters restart from zero when reset
+                    if packets < last_packets or nbytes < last_bytes:
+                        last_packets, last_bytes = 0, 0
+                    metrics['packets_rate'].append(
+                        (labels, (packets - last_packets) / elapsed))
+                    metrics['bytes_rate'].append(
+                        (labels, (nbytes - last_bytes) / elapsed))
+
+        self.samples = samples
+        return metrics
+
+    def render(self, now=None):
+        """ Returns the metrics in the Prometheus text format. """
+        metrics = self.collect(now=now)
+
+        lines = list()
+        for name, kind, text in self.METRICS:
+            metric = '{}_{}'.format(self.PREFIX, name)
+            lines.append('# HELP {} {}'.format(metric, text))
+            lines.append('# TYPE {} {}'.format(metric, kind))
+            for labels, value in metrics[name]:
+                lines.append('{}{{{}}} {}'.format(metric, labels, value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """ Writes the metrics to a file for the node exporter textfile
+        collector. The file is replaced atomically, and left as it was if
+        rendering or writing fails. """
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp, 'w') as fp:
+                fp.write(self.render())
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def serve(self, address=('', 9447)):
+        """ Serves the metrics over http, until interrupted.
+        address -- the (host, port) to listen on """
+        exporter = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = exporter.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        with http.server.HTTPServer(address, Handler) as server:
+            server.serve_forever()
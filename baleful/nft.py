@@ -0,0 +1,622 @@
+#!/usr/bin/env python3
+
+"""Rendering of rules and nodes as nftables rulesets.
+A node is rendered as one inet table in an 'nft -f' script, which nft applies
+in a single netlink transaction. Rules which are the same for v4 and v6 are
+rendered once, and runs of rules differing in one address, port or interface
+are merged into anonymous sets and verdict maps."""
+
+import difflib
+import ipaddress
+import subprocess
+
+
+def chain_name(table, chain):
+    """ Returns the nftables chain of an iptables table and chain.
+    Chains of the filter table keep their name, others are prefixed by their
+    table, e.g. raw-PREROUTING. """
+    if table.upper() == "FILTER":
+        return chain
+    return '{}-{}'.format(table.lower(), chain)
+
+
+class NftRule:
+    """ An nftables rule, translated from the canonical key of a rule.
+
+    matches -- a list of (field, op, values) expressions, e.g.
+    ('tcp dport', '', ['80', '443'])
+    statements -- statements after the counter, e.g. log
+    verdict -- the verdict, e.g. 'accept' or 'jump LOGDROP' (or None)
+    ipv -- the inet version of the rule
+
+    Example:
+    NftRule(rule.key()).body()
+    """
+
+    # Fields which can be merged into sets and verdict maps
+    SETS = ['ip saddr', 'ip daddr', 'ip6 saddr', 'ip6 daddr',
+            'tcp dport', 'tcp sport', 'udp dport', 'udp sport',
+            'iifname', 'oifname']
+
+    # Fields which restrict a rule to one inet version
+    FAMILIES = {'ip ': 4, 'icmp ': 4, 'ip6 ': 6, 'icmpv6 ': 6}
+
+    VERDICTS = {'ACCEPT': 'accept', 'DROP': 'drop', 'RETURN': 'return',
+                'MASQUERADE': 'masquerade', 'NOTRACK': None}
+
+    REJECT = {'icmp-port-unreachable': 'reject',
+              'icmp6-port-unreachable': 'reject',
+              'port-unreach': 'reject',
+              'tcp-reset': 'reject with tcp reset',
+              'icmp-host-prohibited': 'reject with icmp type host-prohibited',
+              'icmp-net-prohibited': 'reject with icmp type net-prohibited',
+              'icmp-admin-prohibited':
+              'reject with icmp type admin-prohibited',
+              'icmp6-adm-prohibited':
+              'reject with icmpv6 type admin-prohibited'}
+
+    # Targets which are not translated
+    EXTENSIONS = ['QUEUE', 'NFQUEUE', 'NFLOG', 'TCPMSS', 'TRACE', 'CLASSIFY',
+                  'TEE', 'AUDIT', 'CHECKSUM', 'SET', 'DSCP', 'TOS', 'TTL',
+                  'HL', 'CONNMARK', 'CT']
+
+    LIMIT_UNITS = {'s': 'second', 'sec': 'second', 'second': 'second',
+                   'm': 'minute', 'min': 'minute', 'minute': 'minute',
+                   'h': 'hour', 'hour': 'hour', 'd': 'day', 'day': 'day'}
+
+    def __init__(self, key):
+        """Arguments:
+        key -- the canonical key of a rule (see Rule.key)
+        """
+        ipv, table, chain, target, params, kwargs = key
+        self.ipv = ipv
+        self.table = table
+        self.chain = chain
+        self.matches = list()
+        self.statements = list()
+        self.verdict = None
+        self.jump = None
+        self.comment = None
+
+        family = 'ip' if ipv == 4 else 'ip6'
+        params = dict(params)
+        kwargs = dict(kwargs)
+        target_param = dict(kwargs.pop('target_param', ()))
+
+        for param, field in [('in_interface', 'iifname'),
+                             ('out_interface', 'oifname')]:
+            if param in params:
+                op, value = self.split(params.pop(param))
+                if value.endswith('+'):
+                    value = value[:-1] + '*'
+                self.matches.append((field, op, ['"{}"'.format(value)]))
+
+        for param, field in [('src', 'saddr'), ('dst', 'daddr')]:
+            if param in params:
+                op, value = self.split(params.pop(param))
+                self.matches.append(('{} {}'.format(family, field), op,
+                                     [self.address(value)]))
+
+        if params.pop('fragment', None):
+            self.matches.append(('ip frag-off & 0x1fff', '!=', ['0']))
+
+        protocol = params.pop('protocol', None)
+        if params:
+            raise(ValueError("Can not translate {}".format(
+                ', '.join(params))))
+
+        # Matches on ports imply their protocol
+        if protocol and not any(self.implies(m, dict(o), protocol)
+                                for m, o in kwargs.items()):
+            op, value = self.split(protocol)
+            self.matches.append(('meta l4proto', op, [value]))
+
+        for match, options in kwargs.items():
+            self.match(match, dict(options), family, protocol)
+
+        self.target(target, target_param, family)
+
+    @staticmethod
+    def split(value):
+        """ Returns (op, value) of a possibly negated ('!') value. """
+        if value.startswith('!'):
+            return '!=', value[1:]
+        return '', value
+
+    @staticmethod
+    def address(value):
+        """ Returns an address, without the prefix of single hosts. """
+        network = ipaddress.ip_network(value, strict=False)
+        if network.prefixlen == network.max_prefixlen:
+            return str(network.network_address)
+        return str(network)
+
+    @staticmethod
+    def ports(value):
+        """ Returns the elements of a port list, with nftables ranges. """
+        return [port.replace(':', '-') for port in value.split(',')]
+
+    @staticmethod
+    def implies(match, options, protocol):
+        """ Returns True, if a match implies the rule's protocol. """
+        if match in ['icmp', 'icmp6']:
+            return any(v != 'any' for v in options.values())
+        return match in ['tcp', 'udp', 'sctp'] or (
+            match == 'multiport' and protocol in ['tcp', 'udp', 'sctp'])
+
+    def match(self, match, options, family, protocol):
+        """ Translates the options of a match. """
+        if match in ['tcp', 'udp', 'sctp', 'multiport']:
+            proto = match if match != 'multiport' else protocol
+            if proto not in ['tcp', 'udp', 'sctp']:
+                raise(ValueError("multiport requires a tcp or udp protocol"))
+            for option, value in sorted(options.items()):
+                field = option.rstrip('s')
+                if field not in ['dport', 'sport']:
+                    raise(ValueError("Can not translate -m {} --{}".format(
+                        match, option)))
+                op, value = self.split(value)
+                self.matches.append(('{} {}'.format(proto, field), op,
+                                     self.ports(value)))
+
+        elif (match, set(options)) in [('state', {'state'}),
+                                       ('conntrack', {'ctstate'})]:
+            op, value = self.split(list(options.values())[0])
+            self.matches.append(('ct state', op, [value.lower()]))
+
+        elif match in ['icmp', 'icmp6']:
+            for option, value in options.items():
+                op, value = self.split(value)
+                if value != 'any':
+                    self.matches.append((
+                        'icmp type' if match == 'icmp' else 'icmpv6 type',
+                        op, [value]))
+
+        elif match == 'set' and set(options) == {'match-set'}:
+            op, value = self.split(options['match-set'])
+            name, direction = value.split(',')
+            if direction not in ['src', 'dst']:
+                raise(ValueError("Can not translate set {}".format(value)))
+            self.matches.append(('{} {}addr'.format(family, direction[0]),
+                                 op, ['@' + name]))
+
+        elif match == 'limit':
+            rate, unit = options['limit'].split('/')
+            text = '{}/{}'.format(rate, self.LIMIT_UNITS[unit])
+            if 'limit-burst' in options:
+                text += ' burst {} packets'.format(options['limit-burst'])
+            self.matches.append(('limit rate', '', [text]))
+
+        elif match == 'comment':
+            self.comment = options['comment'].replace('"', "'")
+
+        else:
+            fields = {('mark', 'mark'): 'meta mark',
+                      ('mac', 'mac-source'): 'ether saddr',
+                      ('owner', 'uid-owner'): 'meta skuid',
+                      ('owner', 'gid-owner'): 'meta skgid',
+                      ('pkttype', 'pkt-type'): 'pkttype',
+                      ('addrtype', 'src-type'): 'fib saddr type',
+                      ('addrtype', 'dst-type'): 'fib daddr type'}
+            for option, value in options.items():
+                if (match, option) not in fields:
+                    raise(ValueError("Can not translate -m {} --{}".format(
+                        match, option)))
+                op, value = self.split(value)
+                self.matches.append((fields[(match, option)], op,
+                                     [value.lower()]))
+
+    def target(self, target, params, family):
+        """ Translates the target into statements and a verdict. """
+        if isinstance(target, type(None)):
+            return
+
+        if target in self.VERDICTS:
+            self.verdict = self.VERDICTS[target]
+            if target == 'NOTRACK':
+                self.statements.append('notrack')
+        elif target == 'REJECT':
+            reject = params.get('reject-with', 'icmp-port-unreachable')
+            if reject not in self.REJECT:
+                raise(ValueError("Can not translate --reject-with {}".format(
+                    reject)))
+            self.verdict = self.REJECT[reject]
+        elif target == 'LOG':
+            statement = 'log'
+            if 'log-prefix' in params:
+                statement += ' prefix "{}"'.format(
+                    params['log-prefix'].replace('"', "'"))
+            if 'log-level' in params:
+                statement += ' level {}'.format(params['log-level'])
+            self.statements.append(statement)
+        elif target == 'CT' and 'notrack' in params:
+            self.statements.append('notrack')
+        elif target == 'MARK':
+            self.statements.append('meta mark set {}'.format(
+                params.get('set-mark', params.get('set-xmark'))))
+        elif target in ['SNAT', 'DNAT']:
+            option = 'to-source' if target == 'SNAT' else 'to-destination'
+            self.verdict = '{} {} to {}'.format(
+                target.lower(), family, params[option])
+        elif target == 'REDIRECT':
+            self.verdict = 'redirect to :{}'.format(
+                params['to-ports'].replace(':', '-'))
+        elif target in self.EXTENSIONS:
+            raise(ValueError("Can not translate -j {}".format(target)))
+        else:
+            self.jump = target
+            self.verdict = 'jump ' + chain_name(self.table, target)
+
+    def family(self):
+        """ Returns the inet version a rule is restricted to by its
+        matches, or None. """
+        for field, op, values in self.matches:
+            for prefix, ipv in self.FAMILIES.items():
+                if field.startswith(prefix):
+                    return ipv
+        if self.verdict and self.verdict.startswith(('snat', 'dnat')):
+            return self.ipv
+        if self.verdict and ' icmp' in self.verdict:
+            return self.ipv
+        return None
+
+    @staticmethod
+    def expression(field, op, values):
+        """ Renders a match, with several values as an anonymous set. """
+        if len(values) > 1:
+            value = '{{ {} }}'.format(', '.join(values))
+        else:
+            value = values[0]
+        return ' '.join(p for p in [field, op, value] if p)
+
+    def body(self, matches=None, verdict=None):
+        """ Returns the rule text.
+        matches -- matches in place of the rule's (default self.matches)
+        verdict -- a verdict in place of the rule's """
+        if isinstance(matches, type(None)):
+            matches = self.matches
+        parts = [self.expression(*match) for match in matches]
+        parts.append('counter')
+        parts += self.statements
+        verdict = verdict if verdict else self.verdict
+        if verdict:
+            parts.append(verdict)
+        if self.comment:
+            parts.append('comment "{}"'.format(self.comment))
+        return ' '.join(parts)
+
+    def text(self, ipv=None, body=None):
+        """ Returns the rule text for an inet table.
+        ipv -- the inet version to restrict the rule to, unless its matches
+        already do (default none, for rules common to v4 and v6)
+        body -- the text in place of the rule's (see body) """
+        text = body if body else self.body()
+        if ipv and not self.family():
+            text = 'meta nfproto ipv{} {}'.format(ipv, text)
+        return text
+
+    def __str__(self):
+        return self.text(self.ipv)
+
+
+class Ruleset:
+    """ A node rendered as an nftables ruleset in one inet table.
+
+    The table is deleted and re-created in the same 'nft -f' script, so the
+    whole ruleset is replaced in a single atomic transaction. Chains of the
+    iptables tables become base chains at their priorities (see chain_name),
+    the node's IpSets become named sets, and where v4 and v6 policies differ
+    the policy of one family is a final rule.
+
+    Example:
+    text = Ruleset(node).script()
+    Ruleset.apply(text)
+    """
+
+    HOOKS = {'PREROUTING': 'prerouting', 'INPUT': 'input',
+             'FORWARD': 'forward', 'OUTPUT': 'output',
+             'POSTROUTING': 'postrouting'}
+
+    # (type, priority) of base chains, per table and hook
+    PRIORITIES = {'RAW': ('filter', 'raw'),
+                  'MANGLE': ('filter', 'mangle'),
+                  'NAT': ('nat', 'dstnat'),
+                  'FILTER': ('filter', 'filter'),
+                  'SECURITY': ('filter', 'security')}
+
+    TABLES = ['RAW', 'MANGLE', 'NAT', 'FILTER', 'SECURITY']
+
+    SETTYPES = {4: 'ipv4_addr', 6: 'ipv6_addr'}
+
+    VMAP = ('accept', 'drop', 'return', 'jump ', 'goto ')
+
+    # Verdicts which end a packet's traversal of the chain
+    TERMINAL = ('accept', 'drop', 'reject', 'return')
+
+    def __init__(self, node, name='baleful', merge=True):
+        """Arguments:
+        node -- the baleful Node to render
+        name -- the name of the inet table
+        merge -- merge rules into sets and verdict maps
+        """
+        self.node = node
+        self.name = name
+        self.merge = merge
+
+        # {(table, chain): [(NftRule, ipv or None for both)]}
+        self.chains = dict()
+        families = dict()
+        for (ipv, table, chain), rules in node.chains().items():
+            families.setdefault((table, chain), dict())[ipv] = [
+                NftRule(rule.key()) for rule in rules]
+        for key, rules in families.items():
+            self.chains[key] = self.interleave(rules.get(4, list()),
+                                               rules.get(6, list()))
+
+        for ipv, policies in node.policy.items():
+            for chain in policies:
+                self.chains.setdefault(("FILTER", chain), list())
+
+    @staticmethod
+    def interleave(rules4, rules6):
+        """ Returns the rules of a chain for both inet versions.
+        Rules common to both, in the same order, are kept once. As v4 rules
+        never match v6 packets, other rules keep only their own order. """
+        text4 = [r.body() for r in rules4]
+        text6 = [r.body() for r in rules6]
+        matcher = difflib.SequenceMatcher(None, text4, text6, autojunk=False)
+
+        rules = list()
+        i = j = 0
+        for a, b, size in matcher.get_matching_blocks():
+            rules += [(r, 4) for r in rules4[i:a]]
+            rules += [(r, 6) for r in rules6[j:b]]
+            for k in range(size):
+                rule = rules4[a + k]
+                both = isinstance(rule.family(), type(None))
+                rules.append((rule, None if both else 4))
+                if not both:
+                    rules.append((rules6[b + k], 6))
+            i, j = a + size, b + size
+        return rules
+
+    @classmethod
+    def interval(cls, field, value):
+        """ Returns the (low, high) interval of a set element, or None. """
+        if field.endswith(('saddr', 'daddr')) and not value.startswith('@'):
+            network = ipaddress.ip_network(value, strict=False)
+            return (int(network.network_address),
+                    int(network.broadcast_address))
+        if field.endswith(('dport', 'sport')):
+            bounds = [int(b) for b in value.split('-')]
+            return (bounds[0], bounds[-1])
+        if field in ['iifname', 'oifname'] and '*' not in value:
+            return (value, value)
+        return None
+
+    @classmethod
+    def elements(cls, field, values):
+        """ Returns set elements, with overlapping intervals merged. """
+        if field.endswith(('saddr', 'daddr')):
+            networks = ipaddress.collapse_addresses(
+                ipaddress.ip_network(v, strict=False) for v in values)
+            return [NftRule.address(str(n)) for n in networks]
+        if field.endswith(('dport', 'sport')):
+            merged = list()
+            for low, high in sorted(cls.interval(field, v) for v in values):
+                if merged and low <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], high)
+                else:
+                    merged.append([low, high])
+            return ['{}-{}'.format(l, h) if l != h else str(l)
+                    for l, h in merged]
+        return sorted(set(values))
+
+    @classmethod
+    def difference(cls, x, y):
+        """ Returns the index of the only match x and y differ in, if it can
+        be merged into a set, otherwise None. """
+        (rx, fx), (ry, fy) = x, y
+        if (fx != fy or rx.statements != ry.statements or
+                rx.comment != ry.comment or
+                [m[0] for m in rx.matches] != [m[0] for m in ry.matches]):
+            return None
+        diff = [i for i, (a, b) in enumerate(zip(rx.matches, ry.matches))
+                if a != b]
+        if len(diff) != 1:
+            return None
+        field, opx, valx = rx.matches[diff[0]]
+        field, opy, valy = ry.matches[diff[0]]
+        if (field not in NftRule.SETS or opx or opy or
+                any(isinstance(cls.interval(field, v), type(None))
+                    for v in valx + valy)):
+            return None
+        return diff[0]
+
+    @classmethod
+    def disjoint(cls, field, x, y):
+        """ Returns True, if element lists x and y do not overlap. """
+        return not any(
+            max(a[0], b[0]) <= min(a[1], b[1])
+            for a in [cls.interval(field, v) for v in x]
+            for b in [cls.interval(field, v) for v in y])
+
+    def vmap(self, rule):
+        """ Returns True, if a rule's verdict can be in a verdict map. """
+        return bool(rule.verdict) and rule.verdict.startswith(self.VMAP)
+
+    def terminal(self, rule):
+        """ Returns True, if a rule's verdict ends the chain traversal. """
+        return bool(rule.verdict) and rule.verdict.startswith(self.TERMINAL)
+
+    def group(self, rules, i):
+        """ Returns (index, end) of the run of rules from i which can be
+        merged, differing only in their match at index. """
+        if not self.merge or i + 1 >= len(rules):
+            return None, i + 1
+        index = self.difference(rules[i], rules[i + 1])
+        if isinstance(index, type(None)):
+            return None, i + 1
+
+        rule = rules[i][0]
+        field = rule.matches[index][0]
+        same = rules[i + 1][0].verdict == rule.verdict
+        if not same and not self.vmap(rule):
+            return None, i + 1
+
+        end = i + 1
+        while end < len(rules):
+            other = rules[end][0]
+            if self.difference(rules[i], rules[end]) != index:
+                break
+            if same and other.verdict != rule.verdict:
+                break
+            if not same and not self.vmap(other):
+                break
+            # A verdict map needs disjoint keys, to keep first match order,
+            # and a set of a non-terminal verdict (log, jump, mark) too, as
+            # a packet in overlapping elements would hit each rule
+            if (not same or not self.terminal(rule)) and not all(
+                    self.disjoint(field, r.matches[index][2],
+                                  other.matches[index][2])
+                    for r, f in rules[i:end]):
+                break
+            end += 1
+        return index, end
+
+    def merged(self, rules):
+        """ Returns the rule texts of a chain, merging runs of rules which
+        differ only in one set field: with the same verdict into an
+        anonymous set, with different verdicts into a verdict map.
+        See Ruleset.group for when overlapping elements may merge. """
+        texts = list()
+        i = 0
+        while i < len(rules):
+            index, end = self.group(rules, i)
+            rule, ipv = rules[i]
+            group = [r for r, f in rules[i:end]]
+            if len(group) == 1:
+                texts.append(rule.text(ipv))
+                i = end
+                continue
+
+            field = rule.matches[index][0]
+            matches = list(rule.matches)
+            if all(r.verdict == rule.verdict for r in group):
+                matches[index] = (field, '', self.elements(
+                    field, [v for r in group for v in r.matches[index][2]]))
+                body = rule.body(matches=matches)
+            else:
+                matches.pop(index)
+                vmap = '{} vmap {{ {} }}'.format(field, ', '.join(
+                    '{} : {}'.format(v, r.verdict)
+                    for r in group for v in r.matches[index][2]))
+                body = rule.body(matches=matches, verdict=vmap)
+            texts.append(rule.text(ipv, body=body))
+            i = end
+        return texts
+
+    def base(self, table, chain):
+        """ Returns the base chain declaration of a built-in chain. """
+        kind, priority = self.PRIORITIES[table]
+        if table == 'NAT' and chain in ['INPUT', 'POSTROUTING']:
+            priority = 'srcnat'
+        if table == 'MANGLE' and chain == 'OUTPUT':
+            kind = 'route'
+        text = 'type {} hook {} priority {};'.format(
+            kind, self.HOOKS[chain], priority)
+
+        policies = {ipv: self.node.policy.get(ipv, dict()).get(chain)
+                    for ipv in [4, 6]} if table == 'FILTER' else dict()
+        if policies and policies[4] == policies[6] and policies[4]:
+            text += ' policy {};'.format(policies[4].lower())
+        return text, policies
+
+    def order(self):
+        """ Returns the chains in declaration order: user chains before
+        the chains jumping to them, then built-in chains by priority. """
+        jumps = dict()
+        for (table, chain), rules in self.chains.items():
+            jumps[(table, chain)] = [(table, r.jump) for r, f in rules
+                                     if r.jump]
+
+        order = list()
+        seen = set()
+
+        def visit(key):
+            if key in seen or key not in self.chains:
+                return
+            seen.add(key)
+            for target in jumps[key]:
+                visit(target)
+            if key[1] not in self.HOOKS:
+                order.append(key)
+
+        for key in self.chains:
+            visit(key)
+        order += sorted(
+            (key for key in self.chains if key[1] in self.HOOKS),
+            key=lambda k: (self.TABLES.index(k[0]),
+                           list(self.HOOKS).index(k[1])))
+        return order
+
+    def sets(self):
+        """ Returns the declarations of the node's IpSets. """
+        lines = list()
+        for ipset in self.node.ipsets:
+            lines.append('\tset {} {{'.format(ipset.name))
+            lines.append('\t\ttype {}'.format(self.SETTYPES[ipset.ipv]))
+            lines.append('\t\tflags interval')
+            if ipset.entries:
+                lines.append('\t\telements = {{ {} }}'.format(', '.join(
+                    self.elements('ip saddr',
+                                  [str(e) for e in ipset.entries]))))
+            lines.append('\t}')
+            lines.append('')
+        return lines
+
+    def script(self):
+        """ Returns the ruleset as an 'nft -f' script. """
+        table = 'inet {}'.format(self.name)
+        lines = ['#!/usr/sbin/nft -f']
+        if self.node.hostname:
+            lines.append('# {}'.format(self.node.hostname))
+        lines += ['',
+                  'table {}'.format(table),
+                  'delete table {}'.format(table),
+                  '',
+                  'table {} {{'.format(table)]
+        lines += self.sets()
+
+        for table_name, chain in self.order():
+            rules = self.chains[(table_name, chain)]
+            lines.append('\tchain {} {{'.format(
+                chain_name(table_name, chain)))
+
+            policies = dict()
+            if chain in self.HOOKS:
+                text, policies = self.base(table_name, chain)
+                lines.append('\t\t' + text)
+
+            for text in self.merged(rules):
+                lines.append('\t\t' + text)
+
+            if policies and policies[4] != policies[6]:
+                for ipv in [4, 6]:
+                    policy = policies[ipv]
+                    if policy and policy != 'ACCEPT':
+                        lines.append('\t\tmeta nfproto ipv{} {}'.format(
+                            ipv, policy.lower()))
+            lines.append('\t}')
+            lines.append('')
+
+        if lines[-1] == '':
+            lines.pop()
+        lines.append('}')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def apply(text):
+        """ Applies an 'nft -f' script in one transaction. """
+        subprocess.run(['nft', '-f', '-'], input=text, text=True,
+                       check=True)
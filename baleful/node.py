@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 
-from baleful.rule import Rule
+from baleful.rule import Rule, RuleArray
+from baleful.ipset import IpSet
+from baleful.optimize import Reorder
+from baleful.nft import Ruleset
+import difflib
 import iptc
+import subprocess
 
 
 class Node:
@@ -19,11 +24,13 @@ class Node:
                  hostname=str(),
                  rules=None,
                  policy=None,
-                 final_rules=None):
+                 final_rules=None,
+                 ipsets=None):
         """ Keyword arguments:
         hostname -- the hostname of the node (default "")
         rules -- a list of baleful rules
         polcy -- a dict of policies for the filter table
+        ipsets -- a list of IpSets used by the rules (see optimize.IpSets)
         """
         self.hostname = hostname
         self.rules = rules if rules else list()
@@ -35,78 +42,345 @@ class Node:
                 "OUTPUT": "ACCEPT",
                 "FORWARD": "ACCEPT"}}
         self.final_rules = final_rules if final_rules else list()
+        self.ipsets = ipsets if ipsets else list()
+        self.loaded_ipsets = set()
 
     def set_policy(self):
         """ Sets the policy for node.
         Only policies described in self.policy will be set"""
-        for i, v in self.policy.items():
-            for table in self.tables(ipv=[i]):
-                for chain in table.chains:
-                    if chain.name in v:
-                        chain.set_policy(v[chain.name])
+        with Rule.POOL.transaction() as pool:
+            for i, v in self.policy.items():
+                for table in self.tables(ipv=[i]):
+                    for chain in table.chains:
+                        if chain.name in v:
+                            pool.set_policy(i, table.name, chain.name,
+                                            v[chain.name])
 
-    def start(self, position=None):
+    def start(self, position=None, restore=False):
         """ Starts iptables instance for node.
         insert -- The position to insert rules at,
-        otherwise rules will be appended"""
+        otherwise rules will be appended
+        restore -- Apply all rules with iptables-restore,
+        one atomic commit per table.
+        The node's ipsets are loaded before any rule references them."""
+
+        self.apply_ipset()
+        if restore:
+            for ipv in [4, 6]:
+                text = self.restore(ipv=ipv, position=position)
+                if text:
+                    self.apply_restore(text, ipv=ipv)
+            self.prune_ipset()
+            return
 
         # Reverse rule order if inserting
         rules = self.rules.copy() + self.final_rules.copy()
         if not isinstance(position, type(None)):
             rules.reverse()
 
-        for rule in rules:
-            iptc_rule = rule.iptc()
-            if isinstance(position, type(None)):
-                iptc_rule.chain.append_rule(
-                    iptc_rule)
+        with Rule.POOL.transaction() as pool:
+            for ipv, table, chain in self.chains():
+                if chain not in Rule.BUILTIN_CHAINS:
+                    pool.create_chain(ipv, table, chain)
+
+            for rule in rules:
+                if isinstance(position, type(None)):
+                    pool.append(rule)
+                else:
+                    pool.insert(rule)
+        self.prune_ipset()
+
+    def chains(self):
+        """ Returns the node's rules grouped by chain.
+        Returns a dict {(ipv, table, chain): [rules]}, in rule order. """
+        chains = dict()
+        for rule in self.rules + self.final_rules:
+            key = (rule.ipv if rule.ipv else 4,
+                   rule.table if rule.table else "FILTER",
+                   rule.chain if rule.chain else "OUTPUT")
+            chains.setdefault(key, list()).append(rule)
+        return chains
+
+    @staticmethod
+    def edit(source, target):
+        """ Returns an ordered edit script from source to target.
+        Only the middle, past the common prefix and suffix, is diffed (see
+        difflib.SequenceMatcher), so large chains with few changes are
+        cheap.
+        source, target -- lists of comparable keys
+        Returns a list of (action, position, index) tuples, to be applied in
+        order: 'delete' source[index] at position, or 'insert' target[index]
+        at position. Positions are 0-based, in the chain being edited. """
+
+        # Strip the common prefix and suffix, then diff the middle
+        start = 0
+        while (start < min(len(source), len(target)) and
+               source[start] == target[start]):
+            start += 1
+
+        end = 0
+        while (end < min(len(source), len(target)) - start and
+               source[-1 - end] == target[-1 - end]):
+            end += 1
+
+        a = source[start:len(source) - end]
+        b = target[start:len(target) - end]
+        matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+
+        ops = list()
+        position = start
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                position += i2 - i1
+                continue
+            for j in range(j1, j2):
+                ops.append(('insert', position, start + j))
+                position += 1
+            for i in range(i1, i2):
+                ops.append(('delete', position, start + i))
+        return ops
+
+    def diff(self):
+        """ Returns the changes to bring live chains to the node's rules.
+        Returns a list of (action, position, rule) tuples, in the order they
+        should be applied. action is 'insert' or 'delete', at the (0-based)
+        position of rule.chain.
+
+        N.B. Only chains with node rules are compared, and these are made to
+        hold exactly the node's rules. """
+
+        plan = list()
+        with Rule.POOL.transaction() as pool:
+            for (ipv, table, chain), rules in self.chains().items():
+                # Chains missing from the kernel are empty
+                live = RuleArray()
+                if pool.table(ipv, table, read=True).is_chain(chain):
+                    live = RuleArray.read(table=table, chain=chain, ipv=ipv)
+                for action, position, index in self.edit(
+                        [r.key() for r in live],
+                        [r.key() for r in rules]):
+                    if action == 'delete':
+                        plan.append((action, position, live[index]))
+                    else:
+                        plan.append((action, position, rules[index]))
+        return plan
+
+    def sync(self):
+        """ Applies only the changes between the live chains and the node's
+        rules, in one transaction.
+        The plan is applied as one pool operation, so if another writer
+        commits first, the plan is recomputed against the new chains rather
+        than replayed at stale positions.
+        Returns the applied plan, see Node.diff. """
+
+        self.apply_ipset()
+        plan = list()
+        with Rule.POOL.transaction() as pool:
+            pool.execute(self.__apply, pool, plan)
+        self.prune_ipset()
+        return plan
+
+    def __apply(self, pool, plan):
+        """ Diffs the live chains and applies the changes, as plan. """
+        for ipv, table, chain in self.chains():
+            if chain not in Rule.BUILTIN_CHAINS:
+                pool.create_chain(ipv, table, chain)
+
+        plan[:] = self.diff()
+        for action, position, rule in plan:
+            if action == 'delete':
+                pool.delete_at(rule.ipv if rule.ipv else 4,
+                               rule.table if rule.table else "FILTER",
+                               rule.chain if rule.chain else "OUTPUT",
+                               position)
             else:
-                iptc_rule.chain.insert_rule(
-                    iptc_rule)
+                pool.insert(rule, position)
 
     def stop(self):
         """ Stops iptables instance for node.
         Deletes rules from iptables instance"""
 
-        for rule in self.rules + self.final_rules:
-            iptc_rule = rule.iptc()
-            iptc_rule.chain.delete_rule(
-                iptc_rule)
+        with Rule.POOL.transaction() as pool:
+            for rule in self.rules + self.final_rules:
+                pool.delete(rule)
 
     def __str__(self):
         """ Returns a string of iptables actions to be performed. """
-        string = ''
+        return ''.join(str(rule) + '\n'
+                       for rule in self.rules + self.final_rules)
+
+    def dump(self, fp):
+        """ Writes the iptables actions to be performed to a file object,
+        one rule per line. """
+        for rule in self.rules + self.final_rules:
+            fp.write(str(rule))
+            fp.write('\n')
+
+    def restore(self, ipv=4, position=None):
+        """ Returns the iptables-restore input for the node's rules.
+        Rules are grouped into one *table ... COMMIT block per table.
+        ipv -- The inet version 4 or 6 (int)
+        position -- The position to insert rules at,
+        otherwise rules will be appended
+
+        N.B. user-defined chains are declared, and so flushed, before they
+        are filled. """
+
+        tables = dict()
         for rule in self.rules + self.final_rules:
-            string += str(rule)
-            string += '\n'
+            if (rule.ipv if rule.ipv else 4) != ipv:
+                continue
+            table = (rule.table if rule.table else "FILTER").lower()
+            tables.setdefault(table, list()).append(rule)
+
+        string = ''
+        for table, rules in tables.items():
+            chains = list()
+            lines = list()
+            index = dict()
+            for rule in rules:
+                chain = rule.chain if rule.chain else "OUTPUT"
+                if (chain not in Rule.BUILTIN_CHAINS and
+                        chain not in chains):
+                    chains.append(chain)
+
+                if isinstance(position, type(None)):
+                    lines.append(rule.restore())
+                else:
+                    index[chain] = index.get(chain, position) + 1
+                    lines.append(rule.restore(position=index[chain]))
+
+            string += '*{}\n'.format(table)
+            for chain in chains:
+                string += ':{} - [0:0]\n'.format(chain)
+            for line in lines:
+                string += line
+                string += '\n'
+            string += 'COMMIT\n'
         return string
 
-    def status(self):
-        """ Returns the status of each rule.
+    def apply_restore(self, text, ipv=4):
+        """ Applies iptables-restore input without flushing other rules.
+        Each table block is committed to the kernel in one transaction. """
+        subprocess.run([Rule.IPTABLES[ipv]['restore'], '--noflush'],
+                       input=text,
+                       universal_newlines=True,
+                       check=True)
+        Rule.POOL.invalidate(ipv=ipv)
+
+    def nft(self, name='baleful'):
+        """ Returns the node's rules and ipsets as an 'nft -f' script,
+        replacing the inet table name in one transaction (see nft.Ruleset).
+        name -- the name of the inet table """
+        return Ruleset(self, name=name).script()
+
+    def apply_nft(self, text):
+        """ Applies an 'nft -f' script with the nft binary. """
+        Ruleset.apply(text)
+
+    def ipset(self):
+        """ Returns the ipset restore input for the node's ipsets. """
+        return ''.join(ipset.restore() for ipset in self.ipsets)
+
+    def apply_ipset(self):
+        """ Creates and fills the node's ipsets, keeping existing sets. """
+        text = self.ipset()
+        if text:
+            IpSet.apply(text)
+            self.loaded_ipsets.update(ipset.name for ipset in self.ipsets)
+
+    def prune_ipset(self):
+        """ Destroys the ipsets this node loaded (see Node.apply_ipset), but
+        no longer uses, once the rules referencing its current sets are
+        committed. Sets still referenced by a rule are kept, and pruned by a
+        later call.
+        Returns the names of the destroyed sets. """
+        names = set(ipset.name for ipset in self.ipsets)
+        destroyed = [name for name in sorted(self.loaded_ipsets - names)
+                     if IpSet.destroy(name)]
+        self.loaded_ipsets.difference_update(destroyed)
+        return destroyed
+
+    def snapshot(self, zero=False):
+        """ Reads the node's chains once, in one transaction.
+        No table is committed, unless the counters are zeroed.
+        zero -- Zero the chains' counters after reading them, so the next
+        snapshot counts packets since this one.
+        Returns a dict {rule key: [(packets, bytes)]}, in live rule order. """
+
+        index = dict()
+        with Rule.POOL.transaction() as pool:
+            for ipv, table, chain in self.chains():
+                if not pool.table(ipv, table).is_chain(chain):
+                    continue
+                for iptc_rule in pool.chain(ipv, table, chain).rules:
+                    index.setdefault(
+                        Rule.from_iptc(iptc_rule).key(), list()).append(
+                            iptc_rule.get_counters())
+                if zero:
+                    pool.zero(ipv, table, chain)
+        return index
+
+    def status(self, zero=False):
+        """ Returns the status of each rule, from a single snapshot.
+        zero -- Zero the counters after reading them (see Node.snapshot)
         Returns a tuple (exists, (packets, bytes)) """
 
+        index = self.snapshot(zero=zero)
+
         stats = list()
         for rule in self.rules + self.final_rules:
-            stats.append(
-                (rule.exists(), rule.iptc().get_counters()))
-
+            # Repeated rules take the live copies in order
+            counters = index.get(rule.key())
+            if counters:
+                stats.append((True, counters.pop(0)))
+            else:
+                stats.append((False, (0, 0)))
         return stats
 
+    def reorder(self, apply=False):
+        """ Moves frequently matched rules towards the top of their chains,
+        using the live packet counters (see optimize.Reorder).
+        Rules and final rules are reordered separately.
+        apply -- Apply the changes with Node.sync, otherwise only plan them
+        Returns the plan, see Node.diff. """
+        stats = self.status()
+        counters = [counts[0] if exists else 0
+                    for exists, counts in stats]
+        count = len(self.rules)
+
+        node = Node(hostname=self.hostname,
+                    rules=list(Reorder(self.rules,
+                                       counters[:count]).rules),
+                    policy=self.policy,
+                    final_rules=list(Reorder(self.final_rules,
+                                             counters[count:]).rules),
+                    ipsets=self.ipsets)
+        if not apply:
+            return node.diff()
+
+        plan = node.sync()
+        self.rules = node.rules
+        self.final_rules = node.final_rules
+        return plan
+
     def lock(self):
         """ Stops regular rules and implements lock down. """
 
-        self.panic()
+        with Rule.POOL.transaction() as pool:
+            self.panic()
+
+            # Panic deletes user chains, which lock rules may jump to
+            for ipv, table, chain in self.chains():
+                if chain not in Rule.BUILTIN_CHAINS:
+                    pool.create_chain(ipv, table, chain)
 
-        for rule in self.rules:
-            if rule.lock:
-                iptc_rule = rule.iptc()
-                iptc_rule.chain.append_rule(
-                    iptc_rule)
+            for rule in self.rules:
+                if rule.lock:
+                    pool.append(rule)
 
-        for rule in self.final_rules:
-            iptc_rule = rule.iptc()
-            iptc_rule.chain.append_rule(
-                iptc_rule)
+            for rule in self.final_rules:
+                pool.append(rule)
 
     def panic(self):
         """ Panic, DROP all packets. """
@@ -115,37 +389,37 @@ class Node:
         # ALL CONNECTIONS PASS THRU FILTER
 
         # Set policy to DROP
-        for i, v in self.__PANIC__.items():
-            tableClass = Rule.IPTABLES[i]['table']
-            table = tableClass(tableClass.FILTER)
-            for chain in table.chains:
-                chain.flush()
+        with Rule.POOL.transaction() as pool:
+            for i, v in self.__PANIC__.items():
+                table = pool.table(i, "FILTER")
+                for chain in table.chains:
+                    pool.flush(i, "FILTER", chain.name)
 
-                # Delete chain if possible
-                try:
-                    chain.delete()
-                except iptc.ip4tc.IPTCError:
-                    pass
-                except iptc.ip6tc.IPTCError:
-                    pass
+                    # Delete chain if possible
+                    try:
+                        pool.delete_chain(i, "FILTER", chain.name)
+                    except iptc.ip4tc.IPTCError:
+                        pass
+                    except iptc.ip6tc.IPTCError:
+                        pass
 
-                if chain.name in v:
-                    chain.set_policy(v[chain.name])
+                    if chain.name in v:
+                        pool.set_policy(i, "FILTER", chain.name,
+                                        v[chain.name])
 
     def flush(self, ipv=[4, 6]):
         """ Clear all iptables rules.
         From all tables."""
-        for i in ipv:
-            tableClass = Rule.IPTABLES[i]['table']
-            for t in tableClass.ALL:
-                table = tableClass(t)
-                for chain in table.chains:
-                    chain.flush()
+        with Rule.POOL.transaction() as pool:
+            for i in ipv:
+                for table in self.tables(ipv=[i]):
+                    for chain in table.chains:
+                        pool.flush(i, table.name, chain.name)
 
     def tables(self, ipv=[4, 6]):
-        """ Refreshs all the tables. """
+        """ Refreshs all the tables.
+        Tables are taken from the shared handle pool. """
         for i in ipv:
             tableClass = Rule.IPTABLES[i]['table']
             for t in tableClass.ALL:
-                table = tableClass(t)
-                yield table
+                yield Rule.POOL.table(i, t)
@@ -0,0 +1,562 @@
+#!/usr/bin/env python3
+
+"""Optimization passes over generated rulesets.
+Each pass takes a RuleArray, and provides the optimized rules as .rules with
+the rule counts before and after the pass."""
+
+import hashlib
+from baleful.rule import Rule, RuleArray, FrozenRule
+from baleful.ipset import IpSet
+
+
+class Pass:
+    """ A base class for ruleset optimization passes. """
+
+    NAME = 'pass'
+
+    # Targets which end rule traversal
+    TERMINAL = ['ACCEPT', 'DROP']
+
+    # Params which can not match the same packet with different values
+    DISJOINT = ['protocol', 'in_interface', 'out_interface']
+
+    def __init__(self, rules):
+        """Arguments:
+        rules -- the RuleArray (or sequence of rules) to optimize
+        """
+        self.before = len(rules)
+        self.rules = self.optimize(rules)
+        self.after = len(self.rules)
+
+    def optimize(self, rules):
+        """ Returns the optimized RuleArray. """
+        return RuleArray(*rules)
+
+    def __str__(self):
+        return '{}: {} -> {} rules'.format(self.NAME, self.before, self.after)
+
+    @classmethod
+    def commutes(cls, x, y):
+        """ Returns True, if rules x and y can swap places without changing
+        the verdict of any packet.
+        That is when they are in different chains, can not match the same
+        packet (different protocols or interfaces), or have the same
+        terminal target. """
+        xkey = x.key()
+        ykey = y.key()
+
+        if xkey[:3] != ykey[:3]:
+            return True
+
+        xparams = dict(xkey[4])
+        yparams = dict(ykey[4])
+        for param in cls.DISJOINT:
+            xvalue = xparams.get(param)
+            yvalue = yparams.get(param)
+            if (xvalue and yvalue and xvalue != yvalue and
+                    not xvalue.startswith('!') and
+                    not yvalue.startswith('!') and
+                    '+' not in xvalue and '+' not in yvalue):
+                return True
+
+        if (xkey[3] == ykey[3] and xkey[3] in cls.TERMINAL and
+                'target_param' not in dict(xkey[5]) and
+                'target_param' not in dict(ykey[5])):
+            return True
+
+        return False
+
+    # Open merge groups to keep, bounds the cost of each rule.
+    WINDOW = 64
+
+    @classmethod
+    def group(cls, rules, merge_key, fits=None):
+        """ Returns a list of groups of (rule, value) tuples, in rule order.
+
+        Rules with the same merge key are grouped, as long as every rule in
+        between commutes with them (see Pass.commutes).
+        Arguments:
+        rules -- the rules to group
+        merge_key -- a function returning (key, value) for a rule, or
+        (None, None) for a rule which can not be merged
+        fits -- a function returning True, if a group can take a value
+        """
+        entries = list()
+        groups = dict()
+
+        for rule in rules:
+            key, value = merge_key(rule)
+
+            if key in groups:
+                group = groups[key]
+                if not fits or fits(group, value):
+                    group.append((rule, value))
+                    continue
+                groups.pop(key)
+
+            # Later rules can not move before this one, unless they commute
+            for k in list(groups):
+                if not cls.commutes(rule, groups[k][0][0]):
+                    groups.pop(k)
+
+            group = [(rule, value)]
+            entries.append(group)
+            if key:
+                groups[key] = group
+                if len(groups) > cls.WINDOW:
+                    groups.pop(next(iter(groups)))
+
+        return entries
+
+
+class Multiport(Pass):
+    """ Merges rules differing only in a tcp/udp port into multiport matches.
+
+    Rules are only moved past rules they commute with (see Pass.commutes), so
+    first-match semantics are preserved. Merged rules respect the multiport
+    limit of 15 ports, where a port range counts as two.
+
+    Example:
+    opt = Multiport(topo * app.nfs)
+    print(opt)  # multiport: 16 -> 4 rules
+    """
+
+    NAME = 'multiport'
+    MAX_PORTS = 15
+
+    @staticmethod
+    def merge_key(rule):
+        """ Returns (merge key, port) for a rule which can be merged,
+        otherwise (None, None). Rules with the same merge key differ only in
+        the port. """
+        ipv, table, chain, target, params, kwargs = rule.key()
+
+        proto = dict(params).get('protocol')
+        if proto not in ['tcp', 'udp']:
+            return None, None
+
+        matches = dict(kwargs)
+        if 'multiport' in matches or proto not in matches:
+            return None, None
+
+        options = matches.pop(proto)
+        if len(options) != 1:
+            return None, None
+
+        option, port = options[0]
+        if option not in ['dport', 'sport'] or port.startswith('!'):
+            return None, None
+
+        key = (ipv, table, chain, target, params,
+               tuple(sorted(matches.items())), rule.lock, option)
+        return key, port
+
+    @staticmethod
+    def slots(port):
+        """ Returns the multiport slots used by a port or port range. """
+        return 2 if ':' in port else 1
+
+    def fits(self, group, port):
+        """ Returns True, if a group has multiport slots left for a port. """
+        used = sum(self.slots(p) for r, p in group)
+        return used + self.slots(port) <= self.MAX_PORTS
+
+    def optimize(self, rules):
+        groups = self.group(rules, self.merge_key, self.fits)
+        return RuleArray(*[self.merge(group) for group in groups])
+
+    @staticmethod
+    def merge(group):
+        """ Returns a single rule for a group of (rule, port) tuples. """
+        first = group[0][0]
+        if len(group) == 1:
+            return first
+
+        rule = first.thaw().copy()
+        proto = dict(rule.key()[4])['protocol']
+        option = Multiport.merge_key(rule)[0][-1]
+
+        for m in list(rule.kwargs):
+            if m.lower() == proto:
+                rule.kwargs.pop(m)
+
+        rule.kwargs['multiport'] = {
+            option + 's': ','.join(port for r, port in group)}
+        rule.invalidate()
+
+        if isinstance(first, FrozenRule):
+            return rule.freeze()
+        return rule
+
+
+class IpSets(Pass):
+    """ Moves the addresses of rules differing only in src (or dst) into a
+    generated ipset, matched by a single rule.
+
+    Rules are first merged on src, then on dst addresses. The generated sets
+    are named after their content, kept as .sets, and rendered as
+    'ipset restore' input by .restore(). Load them before the rules (see
+    Node.start), so the rules switch to new sets atomically.
+
+    Example:
+    opt = IpSets(rules)
+    print(opt.restore())  # create baleful4-... hash:net family inet -exist
+    """
+
+    NAME = 'ipset'
+
+    # Fewer addresses are left as rules
+    MIN_ENTRIES = 2
+
+    def __init__(self, rules, prefix='baleful'):
+        """Arguments:
+        rules -- the RuleArray (or sequence of rules) to optimize
+        prefix -- the name prefix of generated sets
+        """
+        self.prefix = prefix
+        self.sets = dict()
+        super().__init__(rules)
+
+    @staticmethod
+    def merge_key(rule, direction='src'):
+        """ Returns (merge key, address) for a rule which can be merged on
+        its direction ('src' or 'dst') address, otherwise (None, None). """
+        ipv, table, chain, target, params, kwargs = rule.key()
+
+        # Wildcard addresses are not part of the key
+        params = dict(params)
+        if 'set' in dict(kwargs) or direction not in params:
+            return None, None
+
+        addr = params.pop(direction)
+        if addr.startswith('!'):
+            return None, None
+
+        key = (ipv, table, chain, target, tuple(sorted(params.items())),
+               kwargs, rule.lock, direction)
+        return key, addr
+
+    def optimize(self, rules):
+        for direction in ['src', 'dst']:
+            groups = self.group(
+                rules, lambda rule: self.merge_key(rule, direction))
+            rules = RuleArray(*[self.merge(group, direction)
+                                for group in groups])
+        return rules
+
+    def merge(self, group, direction):
+        """ Returns a single rule for a group of (rule, address) tuples,
+        matching a generated ipset. """
+        first = group[0][0]
+        if len(group) < self.MIN_ENTRIES:
+            return first
+        ipv = first.key()[0]
+
+        ipset = IpSet.named([addr for r, addr in group],
+                            ipv=ipv, prefix=self.prefix)
+        self.sets[ipset.name] = ipset
+
+        rule = first.thaw().copy()
+        rule.params.pop(direction, None)
+        rule.kwargs.update(ipset.match(direction))
+        rule.invalidate()
+
+        if isinstance(first, FrozenRule):
+            return rule.freeze()
+        return rule
+
+    def restore(self):
+        """ Returns 'ipset restore' input for the generated sets. """
+        return ''.join(s.restore() for s in self.sets.values())
+
+
+class ChainTree(Pass):
+    """ Splits built-in chains into a tree of user-defined chains.
+
+    Rules branch on interface, then protocol, then destination port bucket,
+    e.g. INPUT -> BALEFUL-IN-eth0 -> BALEFUL-IN-eth0-tcp. A rule only moves
+    past rules which can not match the same packet (another interface,
+    protocol or port bucket), so first-match semantics are preserved.
+    Subchain rules are emitted before the rules jumping to them.
+
+    The expected number of rules compared to reach each rule, before and
+    after the split, is kept per chain as .depth.
+
+    Example:
+    opt = ChainTree(node.rules)
+    print(opt.depth)  # {(4, 'FILTER', 'INPUT'): (50.5, 7.25)}
+    """
+
+    NAME = 'chaintree'
+
+    # Smaller branches are kept in their parent chain
+    MIN_RULES = 4
+
+    # Width of destination port buckets
+    PORT_BUCKET = 1024
+
+    # iptables chain name limit
+    MAX_NAME = 28
+
+    SHORT = {'PREROUTING': 'PRE',
+             'INPUT': 'IN',
+             'FORWARD': 'FWD',
+             'OUTPUT': 'OUT',
+             'POSTROUTING': 'POST'}
+
+    LEVELS = ['interface', 'protocol', 'port']
+
+    def __init__(self, rules, prefix='BALEFUL'):
+        """Arguments:
+        rules -- the RuleArray (or sequence of rules) to optimize
+        prefix -- the name prefix of generated chains
+        """
+        self.prefix = prefix
+        self.depth = dict()
+        self.names = set()
+        super().__init__(rules)
+
+    def optimize(self, rules):
+        chains = dict()
+        for rule in rules:
+            chains.setdefault(rule.key()[:3], list()).append(rule)
+
+        result = RuleArray()
+        for key, chain_rules in chains.items():
+            ipv, table, chain = key
+            if chain not in self.SHORT:
+                result.extend(chain_rules)
+                continue
+
+            name = '{}-{}'.format(self.prefix, self.SHORT[chain])
+            rules, subrules, depths = self.split(
+                chain_rules, chain, chain, name, 0)
+            result.extend(subrules + rules)
+
+            count = len(chain_rules)
+            self.depth[key] = ((count + 1) / 2, sum(depths) / count)
+        return result
+
+    def split(self, rules, builtin, chain, name, level):
+        """ Returns (chain rules, subchain rules, depths) for rules in a
+        chain, split from a tree level on. depths are the number of rules
+        compared to reach each of the given rules.
+        Arguments:
+        rules -- the rules to split, in order
+        builtin -- the built-in chain the tree starts from
+        chain -- the chain to put the rules in
+        name -- the name to derive subchain names from
+        level -- the index in LEVELS to branch on
+        """
+        if level == len(self.LEVELS):
+            return ([self.place(rule, chain) for rule in rules], [],
+                    list(range(1, len(rules) + 1)))
+
+        # Group rules by branch value, a rule without one is a barrier
+        entries = list()
+        groups = dict()
+        for rule in rules:
+            value = self.branch(rule, builtin, level)
+            if isinstance(value, type(None)):
+                groups = dict()
+            elif value in groups:
+                groups[value].append(rule)
+                continue
+            group = [rule]
+            entries.append((value, group))
+            if not isinstance(value, type(None)):
+                groups[value] = group
+
+        # Merge adjacent rules which stay in this chain
+        merged = list()
+        for value, group in entries:
+            if len(group) < self.MIN_RULES:
+                value = None
+            if (isinstance(value, type(None)) and merged and
+                    isinstance(merged[-1][0], type(None))):
+                merged[-1][1].extend(group)
+            else:
+                merged.append((value, list(group)))
+
+        # A single branch would only add a jump
+        if len(merged) == 1:
+            merged = [(None, merged[0][1])]
+
+        chain_rules = list()
+        subrules = list()
+        depths = list()
+        for value, group in merged:
+            if isinstance(value, type(None)):
+                crules, srules, cdepths = self.split(
+                    group, builtin, chain, name, level + 1)
+                offset = len(chain_rules)
+                chain_rules.extend(crules)
+                subrules.extend(srules)
+                depths.extend(offset + d for d in cdepths)
+                continue
+
+            subchain = self.chain_name(name, level, value)
+            crules, srules, cdepths = self.split(
+                group, builtin, subchain, subchain, level + 1)
+            chain_rules.append(
+                self.jump(group, builtin, chain, subchain, level, value))
+            subrules.extend(srules + crules)
+            depths.extend(len(chain_rules) + d for d in cdepths)
+
+        return chain_rules, subrules, depths
+
+    @staticmethod
+    def interface(builtin):
+        """ Returns the interface parameter to branch on for a chain. """
+        if builtin in ['OUTPUT', 'POSTROUTING']:
+            return 'out_interface'
+        return 'in_interface'
+
+    def branch(self, rule, builtin, level):
+        """ Returns the branch value of a rule at a tree level, or None if
+        the rule stays in its chain.
+        Rules with different branch values can not match the same packet.
+        """
+        ipv, table, chain, target, params, kwargs = rule.key()
+        params = dict(params)
+
+        # RETURN would only leave the subchain
+        if target == 'RETURN':
+            return None
+
+        if self.LEVELS[level] == 'interface':
+            value = params.get(self.interface(builtin))
+            if not value or value.startswith('!') or '+' in value:
+                return None
+            return value
+
+        proto = params.get('protocol')
+        if not proto or proto.startswith('!'):
+            return None
+        if self.LEVELS[level] == 'protocol':
+            return proto
+
+        matches = dict(kwargs)
+        if proto not in ['tcp', 'udp'] or 'multiport' in matches:
+            return None
+        port = dict(matches.get(proto, ())).get('dport')
+        if not port or port.startswith('!'):
+            return None
+
+        bounds = port.split(':')
+        if not all(b.isdigit() for b in bounds):
+            return None
+        buckets = set(int(b) // self.PORT_BUCKET for b in bounds)
+        if len(buckets) != 1:
+            return None
+        low = buckets.pop() * self.PORT_BUCKET
+        return (proto, '{}:{}'.format(low, low + self.PORT_BUCKET - 1))
+
+    def chain_name(self, name, level, value):
+        """ Returns a unique subchain name, within the chain name limit. """
+        if self.LEVELS[level] == 'port':
+            proto, ports = value
+            suffix = ports.split(':')[0]
+            if not name.endswith('-' + proto):
+                suffix = proto + '-' + suffix
+        else:
+            suffix = value
+
+        subchain = '{}-{}'.format(name, suffix)
+        if len(subchain) > self.MAX_NAME:
+            digest = hashlib.sha1(subchain.encode()).hexdigest()
+            subchain = '{}-{}'.format(
+                subchain[:self.MAX_NAME - 9], digest[:8])
+
+        unique = subchain
+        count = 1
+        while unique in self.names:
+            count += 1
+            unique = '{}-{}'.format(subchain[:self.MAX_NAME - 4], count)
+        self.names.add(unique)
+        return unique
+
+    def jump(self, group, builtin, chain, subchain, level, value):
+        """ Returns the rule jumping from chain to subchain, for a group of
+        rules. The jump is a lock rule, if any rule of the group is, so
+        lock down (see Node.lock) reaches them. """
+        rule = group[0]
+        ipv, table = rule.key()[:2]
+        params = dict()
+        kwargs = dict()
+
+        if self.LEVELS[level] == 'interface':
+            params[self.interface(builtin)] = value
+        elif self.LEVELS[level] == 'protocol':
+            params['protocol'] = value
+        else:
+            proto, ports = value
+            params['protocol'] = proto
+            kwargs[proto] = {'dport': ports}
+
+        jump = Rule(params=params, target=subchain, chain=chain,
+                    table=table, ipv=ipv,
+                    lock=any(r.lock for r in group), **kwargs)
+        if isinstance(rule, FrozenRule):
+            return jump.freeze()
+        return jump
+
+    @staticmethod
+    def place(rule, chain):
+        """ Returns the rule, or a copy of it in another chain. """
+        if rule.key()[2] == chain:
+            return rule
+
+        copy = rule.thaw().copy()
+        copy.chain = chain
+        if isinstance(rule, FrozenRule):
+            return copy.freeze()
+        return copy
+
+
+class Reorder(Pass):
+    """ Moves frequently matched rules towards the top of their chain.
+
+    A rule is only moved up past rules it commutes with (see Pass.commutes)
+    and which matched fewer packets, so the verdict of every packet stays
+    the same. Counters are typically taken from Node.status, see
+    Node.reorder.
+
+    Example:
+    opt = Reorder(rules, [packets for exists, (packets, b) in stats])
+    print(opt.order)  # [3, 0, 1, 2]
+    """
+
+    NAME = 'reorder'
+
+    def __init__(self, rules, counters):
+        """Arguments:
+        rules -- the RuleArray (or sequence of rules) to optimize
+        counters -- the packet count of each rule
+        """
+        if len(counters) != len(rules):
+            raise(ValueError(
+                "{} counters for {} rules".format(len(counters), len(rules))))
+        self.counters = list(counters)
+        self.order = list()
+        super().__init__(rules)
+
+    def optimize(self, rules):
+        rules = list(rules)
+        order = list()
+
+        for i in range(len(rules)):
+            position = len(order)
+            while position and self.hotter(
+                    rules[i], self.counters[i],
+                    rules[order[position - 1]],
+                    self.counters[order[position - 1]]):
+                position -= 1
+            order.insert(position, i)
+
+        self.order = order
+        return RuleArray(*[rules[i] for i in order])
+
+    def hotter(self, x, xcount, y, ycount):
+        """ Returns True, if rule x should move before rule y. """
+        return xcount > ycount and self.commutes(x, y)
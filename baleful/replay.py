@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+
+"""Offline replay of captured traffic against node rulesets.
+Readers stream pcap files and flow logs as batches of (Packets, weights), in
+constant memory. A Replay compares the verdicts of an old and a new node."""
+
+import csv
+import ipaddress
+import mmap
+import struct
+import numpy
+from baleful.classify import Classifier, Packets
+
+
+class PcapReader:
+    """ Streams the IP packets of a pcap file, in batches.
+
+    The file is memory-mapped: record headers are walked in place, and the
+    packet headers of a batch are gathered with NumPy from the mapping,
+    without copying packet data. Conntrack state is approximated from TCP
+    flags: SYN without ACK (and any non-TCP packet) is NEW, everything else
+    ESTABLISHED. IPv6 extension headers are not followed.
+
+    Example:
+    for packets, weights in PcapReader('edge.pcap', chain='INPUT',
+                                       in_interface='eth0'):
+        ...
+    """
+
+    MAGIC = {0xa1b2c3d4: 'us', 0xa1b23c4d: 'ns'}
+
+    # Link type: (offset of the ethertype, offset of the ip header)
+    LINKS = {1: (12, 14),      # Ethernet
+             113: (14, 16),    # Linux cooked capture
+             276: (0, 20),     # Linux cooked capture v2
+             101: (None, 0),   # Raw IP
+             228: (None, 0),   # Raw IPv4
+             229: (None, 0)}   # Raw IPv6
+
+    ETHERTYPES = {0x0800: 4, 0x86DD: 6}
+    VLAN = [0x8100, 0x88A8]
+
+    def __init__(self, path, chain='INPUT', batch=65536, **kwargs):
+        """Arguments:
+        path -- the pcap file
+        chain -- the built-in chain the packets traverse
+        batch -- the number of packets per batch
+        kwargs -- other Packets arguments for every packet, e.g. in_interface
+        """
+        self.path = path
+        self.chain = chain
+        self.batch = batch
+        self.kwargs = kwargs
+        self.skipped = 0
+
+    def __iter__(self):
+        with open(self.path, 'rb') as fp:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield from self.read(mm)
+
+    def read(self, mm):
+        """ Yields (Packets, weights) batches from a mapped pcap file. """
+        if len(mm) < 24:
+            raise(ValueError("{} is not a pcap file".format(self.path)))
+
+        for endian in ['<', '>']:
+            magic = struct.unpack_from(endian + 'I', mm, 0)[0]
+            if magic in self.MAGIC:
+                break
+        else:
+            raise(ValueError("{} is not a pcap file".format(self.path)))
+
+        linktype = struct.unpack_from(endian + 'I', mm, 20)[0] & 0xFFFF
+        if linktype not in self.LINKS:
+            raise(ValueError("Unsupported link type {}".format(linktype)))
+
+        # A view of the mapping, released before it is closed
+        data = numpy.frombuffer(mm, dtype=numpy.uint8)
+        try:
+            length = struct.Struct(endian + 'I')
+            offsets = list()
+            lengths = list()
+            pos = 24
+            size = len(mm)
+            while pos + 16 <= size:
+                incl = length.unpack_from(mm, pos + 8)[0]
+                offsets.append(pos + 16)
+                lengths.append(min(incl, size - pos - 16))
+                pos += 16 + incl
+                if len(offsets) == self.batch:
+                    yield from self.parse(data, linktype, offsets, lengths)
+                    offsets = list()
+                    lengths = list()
+            if offsets:
+                yield from self.parse(data, linktype, offsets, lengths)
+        finally:
+            del data
+
+    @staticmethod
+    def integer(data, offsets, count):
+        """ Returns big-endian integers of count bytes at offsets. """
+        value = numpy.zeros(offsets.shape[0], dtype=numpy.uint64)
+        for i in range(count):
+            value = (value << numpy.uint64(8)) | data.take(
+                offsets + i, mode='clip').astype(numpy.uint64)
+        return value
+
+    def parse(self, data, linktype, offsets, lengths):
+        """ Yields (Packets, weights) per inet version for a batch. """
+        offsets = numpy.array(offsets, dtype=numpy.int64)
+        lengths = numpy.array(lengths, dtype=numpy.int64)
+        end = offsets + lengths
+
+        ethertype, l3 = self.LINKS[linktype]
+        if isinstance(ethertype, type(None)):
+            version = self.integer(data, offsets, 1) >> numpy.uint64(4)
+            version = numpy.where(version == 4, 4,
+                                  numpy.where(version == 6, 6, 0))
+            ip = offsets.copy()
+        else:
+            kind = self.integer(data, offsets + ethertype, 2)
+            ip = offsets + l3
+            if linktype == 1:
+                # One VLAN tag
+                tagged = numpy.isin(kind, self.VLAN)
+                kind[tagged] = self.integer(data, offsets[tagged] + 16, 2)
+                ip[tagged] += 4
+            version = numpy.zeros(offsets.shape[0], dtype=numpy.int64)
+            for key, ipv in self.ETHERTYPES.items():
+                version[kind == key] = ipv
+
+        for ipv in [4, 6]:
+            header = 20 if ipv == 4 else 40
+            select = numpy.flatnonzero((version == ipv) &
+                                       (ip + header <= end))
+            self.skipped += int(numpy.count_nonzero(version == ipv) -
+                                select.shape[0])
+            if select.size:
+                yield self.packets(data, ipv, ip[select], end[select])
+        self.skipped += int(numpy.count_nonzero(version == 0))
+
+    def packets(self, data, ipv, ip, end):
+        """ Returns (Packets, weights) for ip headers at offsets ip. """
+        count = ip.shape[0]
+        if ipv == 4:
+            protocol = self.integer(data, ip + 9, 1)
+            src = self.integer(data, ip + 12, 4)
+            dst = self.integer(data, ip + 16, 4)
+            l4 = ip + 4 * (self.integer(data, ip, 1) &
+                           numpy.uint64(0xF)).astype(numpy.int64)
+            fragment = (self.integer(data, ip + 6, 2) &
+                        numpy.uint64(0x1FFF)) != 0
+        else:
+            protocol = self.integer(data, ip + 6, 1)
+            src = numpy.stack([self.integer(data, ip + 8, 8),
+                               self.integer(data, ip + 16, 8)], axis=1)
+            dst = numpy.stack([self.integer(data, ip + 24, 8),
+                               self.integer(data, ip + 32, 8)], axis=1)
+            l4 = ip + 40
+            fragment = numpy.zeros(count, dtype=bool)
+
+        protocol = protocol.astype(numpy.int64)
+        ported = (numpy.isin(protocol, [6, 17]) & ~fragment &
+                  (l4 + 4 <= end))
+        sport = numpy.where(
+            ported, self.integer(data, l4, 2).astype(numpy.int64), 0)
+        dport = numpy.where(
+            ported, self.integer(data, l4 + 2, 2).astype(numpy.int64), 0)
+
+        icmp = (numpy.isin(protocol, [1, 58]) & ~fragment & (l4 < end))
+        icmp_type = numpy.where(
+            icmp, self.integer(data, l4, 1).astype(numpy.int64), -1)
+
+        # SYN without ACK opens a connection
+        flags = self.integer(data, l4 + 13, 1)
+        tcp = (protocol == 6) & ~fragment & (l4 + 14 <= end)
+        established = tcp & ((flags & numpy.uint64(0x12)) !=
+                             numpy.uint64(0x02))
+        state = numpy.where(established, Packets.STATES['ESTABLISHED'],
+                            Packets.STATES['NEW'])
+
+        packets = Packets(ipv, self.chain, src=src, dst=dst,
+                          protocol=protocol, sport=sport, dport=dport,
+                          icmp_type=icmp_type, state=state, **self.kwargs)
+        return packets, numpy.ones(count, dtype=numpy.int64)
+
+
+class FlowReader:
+    """ Streams a CSV flow log, in batches.
+
+    The first line names the columns. Addresses and ports are required;
+    NetFlow style names (srcaddr, dstport, ...) are understood. A packets
+    column weights each flow, and chain, state and interface columns
+    override the defaults.
+
+    Example:
+    for packets, weights in FlowReader('flows.csv', chain='FORWARD'):
+        ...
+    """
+
+    COLUMNS = {'src': 'src', 'srcaddr': 'src', 'saddr': 'src',
+               'dst': 'dst', 'dstaddr': 'dst', 'daddr': 'dst',
+               'protocol': 'protocol', 'proto': 'protocol',
+               'sport': 'sport', 'srcport': 'sport',
+               'dport': 'dport', 'dstport': 'dport',
+               'icmp_type': 'icmp_type',
+               'state': 'state',
+               'chain': 'chain',
+               'in_interface': 'in_interface',
+               'out_interface': 'out_interface',
+               'packets': 'packets', 'pkts': 'packets'}
+
+    DEFAULTS = {'protocol': 0, 'sport': 0, 'dport': 0, 'icmp_type': -1,
+                'state': 'NEW', 'in_interface': '', 'out_interface': ''}
+
+    def __init__(self, path, chain='INPUT', batch=65536, **kwargs):
+        """Arguments:
+        path -- the CSV file
+        chain -- the built-in chain of flows without a chain column
+        batch -- the number of flows per batch
+        kwargs -- defaults for other Packets arguments, e.g. in_interface
+        """
+        self.path = path
+        self.batch = batch
+        self.defaults = dict(self.DEFAULTS, chain=chain, **kwargs)
+
+    def __iter__(self):
+        with open(self.path, newline='') as fp:
+            reader = csv.reader(fp)
+            header = [self.COLUMNS.get(c.strip().lower())
+                      for c in next(reader)]
+            if 'src' not in header or 'dst' not in header:
+                raise(ValueError(
+                    "{} has no src and dst columns".format(self.path)))
+
+            rows = {4: list(), 6: list()}
+            for row in reader:
+                flow = dict(self.defaults)
+                flow['packets'] = 1
+                for name, value in zip(header, row):
+                    if name and value.strip():
+                        flow[name] = value.strip()
+
+                ipv = ipaddress.ip_address(flow['src']).version
+                rows[ipv].append(flow)
+                if len(rows[ipv]) == self.batch:
+                    yield self.packets(ipv, rows[ipv])
+                    rows[ipv] = list()
+
+            for ipv, flows in rows.items():
+                if flows:
+                    yield self.packets(ipv, flows)
+
+    @staticmethod
+    def packets(ipv, flows):
+        """ Returns (Packets, weights) for a list of flow dicts. """
+        def column(name, dtype=None):
+            values = [flow[name] for flow in flows]
+            return numpy.array(values, dtype=dtype) if dtype else values
+
+        packets = Packets(ipv, numpy.array(column('chain')),
+                          src=column('src'), dst=column('dst'),
+                          protocol=numpy.array(
+                              [str(p) for p in column('protocol')]),
+                          sport=column('sport', numpy.int64),
+                          dport=column('dport', numpy.int64),
+                          icmp_type=column('icmp_type', numpy.int64),
+                          state=numpy.array(column('state')),
+                          in_interface=numpy.array(column('in_interface')),
+                          out_interface=numpy.array(column('out_interface')))
+        return packets, column('packets', numpy.int64)
+
+
+class Replay:
+    """ Replays batches of packets against an old and a new node.
+
+    Counts hits per rule for both nodes, the packets whose verdict changes
+    and keeps a few examples of them.
+
+    Example:
+    replay = Replay(old_node, new_node)
+    replay.run(PcapReader('edge.pcap', in_interface='eth0'))
+    print(replay.report())
+    """
+
+    # Changed packets to keep as examples
+    SAMPLES = 10
+
+    def __init__(self, old, new=None, tree=True):
+        """Arguments:
+        old -- the baleful Node in production
+        new -- the baleful Node to compare (default none)
+        tree -- Evaluate with decision trees (see Classifier)
+        """
+        self.nodes = [node for node in [old, new] if node]
+        self.classifiers = [Classifier(node, tree=tree)
+                            for node in self.nodes]
+        self.hits = [numpy.zeros(len(node.rules + node.final_rules),
+                                 dtype=numpy.int64)
+                     for node in self.nodes]
+        self.verdicts = [dict() for node in self.nodes]
+        self.changes = dict()
+        self.samples = list()
+        self.packets = 0
+
+    def run(self, batches):
+        """ Evaluates (Packets, weights) batches, e.g. from a reader. """
+        for packets, weights in batches:
+            self.add(packets, weights)
+        return self
+
+    def add(self, packets, weights=None):
+        """ Evaluates a batch of Packets, weighted by packet counts. """
+        if isinstance(weights, type(None)):
+            weights = numpy.ones(len(packets), dtype=numpy.int64)
+        self.packets += int(weights.sum())
+
+        results = list()
+        for n, classifier in enumerate(self.classifiers):
+            verdicts, indices = classifier.classify(packets)
+            matched = indices >= 0
+            self.hits[n] += numpy.bincount(
+                indices[matched], weights=weights[matched],
+                minlength=self.hits[n].shape[0]).astype(numpy.int64)
+            for verdict in numpy.unique(verdicts):
+                self.verdicts[n][verdict] = self.verdicts[n].get(
+                    verdict, 0) + int(weights[verdicts == verdict].sum())
+            results.append((verdicts, indices))
+
+        if len(results) < 2:
+            return
+
+        (old, old_index), (new, new_index) = results
+        changed = numpy.flatnonzero(old != new)
+        for i in changed:
+            key = (old[i], new[i])
+            self.changes[key] = self.changes.get(key, 0) + int(weights[i])
+            if len(self.samples) < self.SAMPLES:
+                self.samples.append(
+                    (self.describe(packets, i), old[i], int(old_index[i]),
+                     new[i], int(new_index[i])))
+
+    @staticmethod
+    def describe(packets, i):
+        """ Returns a short description of packet i of a batch. """
+        def address(words):
+            value = 0
+            for word in words:
+                value = (value << 64) | int(word)
+            return ipaddress.ip_address(value)
+
+        return '{} {} {}:{} -> {}:{} proto {}'.format(
+            packets.chain[i], packets.in_interface[i] or '*',
+            address(packets.src[i]), packets.sport[i],
+            address(packets.dst[i]), packets.dport[i],
+            packets.protocol[i])
+
+    def unmatched(self, n=-1):
+        """ Returns the rules of a node (default the new one) which matched
+        no packets. """
+        rules = self.nodes[n].rules + self.nodes[n].final_rules
+        return [rules[i] for i in numpy.flatnonzero(self.hits[n] == 0)]
+
+    def report(self):
+        """ Returns a text report of the replay. """
+        lines = ['{} packets'.format(self.packets)]
+        for n, node in enumerate(self.nodes):
+            name = ['old', 'new'][n]
+            lines.append('{} {}: {}'.format(
+                name, node.hostname, ', '.join(
+                    '{} {}'.format(v, c)
+                    for v, c in sorted(self.verdicts[n].items()))))
+
+        if len(self.nodes) > 1:
+            lines.append('changed: {} packets'.format(
+                sum(self.changes.values())))
+            for (old, new), count in sorted(self.changes.items()):
+                lines.append('  {} -> {}: {}'.format(old, new, count))
+            for packet, old, old_index, new, new_index in self.samples:
+                lines.append('  {} : {} (rule {}) -> {} (rule {})'.format(
+                    packet, old, old_index, new, new_index))
+
+        rules = self.nodes[-1].rules + self.nodes[-1].final_rules
+        lines.append('hits:')
+        for i, rule in enumerate(rules):
+            lines.append('  {:10d} {:4d} {}'.format(
+                self.hits[-1][i], i, rule))
+
+        lines.append('never matched: {} rules'.format(
+            len(self.unmatched())))
+        return '\n'.join(lines) + '\n'
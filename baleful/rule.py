@@ -1,7 +1,15 @@
 #!/usr/bin/env python3
 
+import abc
 import iptc
 import ipaddress
+import collections
+import collections.abc
+import shlex
+import subprocess
+import sys
+from baleful.table import TablePool
+from baleful.nft import NftRule
 
 
 class Rule:
@@ -12,16 +20,28 @@ class Rule:
                     'table': iptc.Table,
                     'chain': iptc.Chain,
                     'addr': ipaddress.IPv4Network,
-                    'str': 'iptables'},
+                    'str': 'iptables',
+                    'restore': 'iptables-restore',
+                    'save': 'iptables-save'},
                 6: {'module': iptc,
                     'rule': iptc.Rule6,
                     'table': iptc.Table6,
                     'chain': iptc.Chain,
                     'addr': ipaddress.IPv6Network,
-                    'str': 'ip6tables'}}
+                    'str': 'ip6tables',
+                    'restore': 'ip6tables-restore',
+                    'save': 'ip6tables-save'}}
+
+    POOL = TablePool(IPTABLES)
 
     WILD_ADDR = {4: "0.0.0.0/0.0.0.0",
-                 6: "::/128"}
+                 6: "::/0"}
+
+    WILD_NET = {4: ipaddress.IPv4Network(WILD_ADDR[4]),
+                6: ipaddress.IPv6Network(WILD_ADDR[6])}
+
+    BUILTIN_CHAINS = ['PREROUTING', 'INPUT', 'FORWARD',
+                      'OUTPUT', 'POSTROUTING']
 
     def __init__(self,
                  params=None,
@@ -46,6 +66,7 @@ class Rule:
         mark = { ... }
         """
 
+        self.invalidate()
         self.target = target
         self.chain = chain
         self.table = table
@@ -54,13 +75,24 @@ class Rule:
         self.params = self.__conv_params(params)
         self.kwargs = kwargs if kwargs else dict()
 
+    def __setattr__(self, name, value):
+        """ Invalidates cached values when a rule attribute is replaced. """
+        object.__setattr__(self, name, value)
+        if not name.startswith('_'):
+            self.invalidate()
+
+    def invalidate(self):
+        """ Clears cached values (see Rule.key, Rule.__str__).
+        Call this after changing params or kwargs dicts in place. """
+        object.__setattr__(self, '_key', None)
+        object.__setattr__(self, '_str', None)
+        object.__setattr__(self, '_restore', None)
+
     def __default_params(self):
         """ Returns the default params. """
         ipv = self.ipv if self.ipv else 4
-        params = {'src': self.IPTABLES[ipv]['addr'](
-            self.WILD_ADDR[ipv]),
-            'dst': self.IPTABLES[ipv]['addr'](
-            self.WILD_ADDR[ipv]),
+        params = {'src': self.WILD_NET[ipv],
+                  'dst': self.WILD_NET[ipv],
             'in_interface': None,
             'out_interface': None,
             'protocol': 'ip'}
@@ -73,11 +105,14 @@ class Rule:
     def __conv_params(self, params):
         """ Converts params to  relevant objects.
             src, dst -> ip_network objects
+            (negated '!' addresses are kept as strings)
         """
         ipv = self.ipv if self.ipv else 4
         all_params = self.__default_params()
         if params:
             for key, val in params.items():
+                if isinstance(val, str) and val.startswith('!'):
+                    continue
                 if key in ['src', 'dst']:
                     params[key] = self.IPTABLES[ipv]['addr'](val,
                                                              strict=False)
@@ -113,11 +148,21 @@ class Rule:
         if not x.ipv and y.ipv:
             rule.ipv = y.ipv
 
+        # y's defaults (e.g. the wildcard of another inet version) carry
+        # no information, so they never override x's defaults.
+        y_defaults = y.__default_params()
         for key in params:
             if ((key in y.params and key in x.params) and
-                    (x.params[key] == defaults[key])):
+                    (x.params[key] == defaults[key]) and
+                    (y.params[key] != y_defaults.get(key))):
                 params[key] = y.params[key]
 
+        # x's wildcards are of its own inet version, not the one from y
+        if rule.ipv != x.ipv:
+            for key in ['src', 'dst']:
+                if params[key] == defaults[key]:
+                    params[key] = x.WILD_NET[rule.ipv]
+
         kwarg_keys = set(
             [k for k in kwargs] +
             [k for k in y.kwargs])
@@ -181,53 +226,124 @@ class Rule:
         return kwargs
 
     def __str__(self):
-        """ Return a string representation of the rule."""
-        ipv = self.ipv if self.ipv else 4
-        vdict = self.dict()
+        """ Return a string representation of the rule.
+        The string is cached, see Rule.invalidate. """
+        if self._str:
+            return self._str
 
-        for val in ['target', 'chain', 'table']:
-            vdict.pop(val)
-
-        # Remove src/dst addresses that are wildcards
-        for val in ['src', 'dst']:
-            if vdict[''][val] == self.IPTABLES[ipv]['addr'](
-                    self.WILD_ADDR[ipv]):
-                vdict[''].pop(val)
+        ipv = self.ipv if self.ipv else 4
+        wild = self.WILD_NET[ipv]
 
-        string = ''
-        string += self.IPTABLES[ipv]['str']
+        args = [self.IPTABLES[ipv]['str']]
 
         if self.table:
-            string += ' -t '
-            string += str(self.table)
+            args += ['-t', str(self.table)]
 
         if self.chain:
-            string += ' -A '
-            string += str(self.chain)
+            args += ['-A', str(self.chain)]
 
-        k1s = [k for k in vdict]
-        k1s.sort()
-        for k1 in k1s:
-            v1 = vdict[k1]
-            k2s = [k for k in v1]
-            k2s.sort()
+        for k1, v1 in [('', self.params)] + sorted(self.kwargs.items()):
             if k1:
-                string += ' -m '
-                string += k1
-            for k2 in k2s:
+                args += ['-m', k1]
+            for k2 in sorted(v1):
                 v2 = v1[k2]
+                # Skip src/dst addresses that are wildcards
+                if not k1 and k2 in ['src', 'dst'] and v2 == wild:
+                    continue
+                if isinstance(v2, (list, tuple)):
+                    v2 = ' '.join(str(v) for v in v2)
                 if v2:
-                    string += ' --'
-                    string += k2.replace('_', '-')
-                    string += ' '
-                    string += str(v2)
+                    args += ['--' + k2.replace('_', '-'), str(v2)]
 
         if self.target:
-            string += ' -j '
-            string += str(self.target)
+            args += ['-j', str(self.target)]
+
+        string = ' '.join(args)
+        object.__setattr__(self, '_str', string)
+        return string
+
+    # Option flags for iptables-restore rule specifications
+    __RESTORE_OPTS = {'src': '-s',
+                      'dst': '-d',
+                      'in_interface': '-i',
+                      'out_interface': '-o',
+                      'protocol': '-p'}
+
+    @staticmethod
+    def __restore_opt(opt, value):
+        """ Returns an iptables-restore option, with negation and quoting.
+        A list or tuple value is rendered as several arguments. """
+        if isinstance(value, (list, tuple)):
+            values = [str(v) for v in value]
+        else:
+            values = [str(value)]
+
+        neg = ''
+        if values[0].startswith('!'):
+            neg = '! '
+            values[0] = values[0][1:].strip()
+        values = [v for v in values if v]
+        if not values:
+            return neg + opt
+
+        for i, value in enumerate(values):
+            if any(c.isspace() for c in value):
+                values[i] = '"{}"'.format(value.replace('"', '\\"'))
+        return '{}{} {}'.format(neg, opt, ' '.join(values))
+
+    def restore(self, position=None):
+        """ Return the rule as an iptables-restore rule specification.
+        position -- The (1-based) position to insert the rule at,
+        otherwise the rule is appended.
+        Appended rules are cached, see Rule.invalidate. """
+        if isinstance(position, type(None)) and self._restore:
+            return self._restore
+
+        ipv = self.ipv if self.ipv else 4
+        chain = self.chain if self.chain else "OUTPUT"
+        wild = self.WILD_NET[ipv]
+
+        if isinstance(position, type(None)):
+            args = ['-A', chain]
+        else:
+            args = ['-I', chain, str(position)]
+
+        for key, opt in self.__RESTORE_OPTS.items():
+            val = self.params.get(key)
+            if not val or val == wild:
+                continue
+            if key == 'protocol' and val in ['ip', 'all']:
+                continue
+            args.append(self.__restore_opt(opt, val))
+
+        if self.params.get('fragment'):
+            args.append('-f')
+
+        kwargs = self.kwargs.copy()
+        target_param = kwargs.pop('target_param', dict())
+
+        for m, params in kwargs.items():
+            args.append('-m ' + m)
+            for arg, val in params.items():
+                args.append(self.__restore_opt(
+                    '--' + arg.replace('_', '-'), val))
 
+        if self.target:
+            args.append('-j ' + str(self.target))
+            for arg, val in target_param.items():
+                args.append(self.__restore_opt(
+                    '--' + arg.replace('_', '-'), val))
+
+        string = ' '.join(args)
+        if isinstance(position, type(None)):
+            object.__setattr__(self, '_restore', string)
         return string
 
+    def nft(self):
+        """ Returns the rule as an nftables rule, for a table of its inet
+        version. See baleful.nft for rendering whole nodes. """
+        return NftRule(self.key()).body()
+
     def __str_dict(self, kwargs):
         """ Converts a dictionary into string arguments for comparison. """
         k1s = [k for k in kwargs]
@@ -248,13 +364,117 @@ class Rule:
                     kwargs.pop(k1)
         return kwargs
 
+    # Aliases used to normalize rule keys
+    __PROTOCOLS = {'ip': None, 'all': None, '0': None,
+                   '1': 'icmp', '6': 'tcp', '17': 'udp',
+                   '58': 'ipv6-icmp', 'icmpv6': 'ipv6-icmp'}
+
+    __PORT_OPTS = {'dport': 'dport',
+                   'sport': 'sport',
+                   'destination-port': 'dport',
+                   'source-port': 'sport',
+                   'dports': 'dports',
+                   'sports': 'sports',
+                   'destination-ports': 'dports',
+                   'source-ports': 'sports',
+                   'ports': 'ports'}
+
+    @staticmethod
+    def __norm_value(value):
+        """ Returns (negation, value) strings for a parameter value.
+        List values are joined with ',', as in Rule.from_iptc. """
+        if isinstance(value, (list, tuple)):
+            value = ','.join(str(v) for v in value)
+        value = str(value).strip()
+        if value.startswith('!'):
+            return '!', value[1:].lstrip(', ')
+        return '', value
+
+    @staticmethod
+    def __norm_ports(value):
+        """ Normalizes a port, port range or port list string. """
+        ports = list()
+        for port in value.split(','):
+            bounds = [str(int(b)) if b.strip().isdigit() else b.strip()
+                      for b in port.split(':')]
+            if len(bounds) == 2 and bounds[0] == bounds[1]:
+                bounds = bounds[:1]
+            ports.append(':'.join(bounds))
+        return ','.join(ports)
+
+    def __norm_param(self, key, value):
+        """ Normalizes a rule param, returns None for wildcards. """
+        ipv = self.ipv if self.ipv else 4
+        if isinstance(value, type(None)) or value is False:
+            return None
+
+        if key in ['src', 'dst']:
+            if isinstance(value, str):
+                neg, value = self.__norm_value(value)
+                value = self.IPTABLES[ipv]['addr'](value, strict=False)
+            else:
+                neg = ''
+            if value.prefixlen == 0 or value == self.WILD_NET[ipv]:
+                return None
+            return neg + str(value)
+
+        neg, value = self.__norm_value(value)
+        if key == 'protocol':
+            value = value.lower()
+            value = self.__PROTOCOLS.get(value, value)
+            if isinstance(value, type(None)):
+                return None
+        elif not value:
+            return None
+        return neg + value
+
+    def key(self):
+        """ Returns a canonical, hashable key for the rule.
+        Two rules with the same key install the same kernel rule, e.g.
+        ports 22 and '22', protocols 6 and 'tcp', and wildcard addresses are
+        normalized. Default table, chain and ipv are filled in.
+        The key is cached, see Rule.invalidate. """
+
+        if self._key:
+            return self._key
+
+        params = list()
+        for k, v in self.params.items():
+            v = self.__norm_param(k, v)
+            if not isinstance(v, type(None)):
+                params.append((k, v))
+
+        kwargs = list()
+        for m, opts in self.kwargs.items():
+            options = list()
+            for k, v in opts.items():
+                if isinstance(v, type(None)) or v is False:
+                    continue
+                k = k.replace('_', '-')
+                neg, v = self.__norm_value(v)
+                if k in self.__PORT_OPTS:
+                    k = self.__PORT_OPTS[k]
+                    v = self.__norm_ports(v)
+                options.append((k, neg + v))
+            kwargs.append((m.lower(), tuple(sorted(options))))
+
+        key = (self.ipv if self.ipv else 4,
+               (self.table if self.table else "FILTER").upper(),
+               self.chain if self.chain else "OUTPUT",
+               str(self.target) if self.target else None,
+               tuple(sorted(params)),
+               tuple(sorted(kwargs)))
+        object.__setattr__(self, '_key', key)
+        return key
+
+    def __hash__(self):
+        return hash(self.key())
+
     def __eq__(self, other):
         if not isinstance(other, type(self)):
             return NotImplemented
 
-        if (self.__str_dict(self.dict()) == self.__str_dict(other.dict())):
-            return True
-        return False
+        return self.key() == other.key()
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -293,6 +513,20 @@ class Rule:
                     lock=self.lock,
                     **kwargs)
 
+    def freeze(self):
+        """ Returns an immutable, compact FrozenRule of this rule. """
+        return FrozenRule(self)
+
+    def thaw(self):
+        """ Returns the rule itself, see FrozenRule.thaw. """
+        return self
+
+    def flipped(self):
+        """ Returns a flipped copy of the rule. """
+        rule = self.copy()
+        rule.flip()
+        return rule
+
     def flip(self):
         """ Flips the iptables rule"""
 
@@ -317,6 +551,8 @@ class Rule:
                             value = self.kwargs[k0][k1]
                             self.kwargs[k0][k1] = self.__flip_val(value, v1)
 
+        self.invalidate()
+
     # KEYS and VALUES for flip method
     __FLIP_KEYS = {'': {'src': 'dst',
                         'in_interface': 'out_interface'},
@@ -367,13 +603,25 @@ class Rule:
         else:
             return value
 
+    @classmethod
+    def use(cls, iptables):
+        """ Switches the netfilter backend of all rules, e.g. to an
+        in-memory backend (see baleful.memory).
+        iptables -- a mapping of inet version to classes, as Rule.IPTABLES
+        Returns the previous backend. """
+        previous = {ipv: dict(classes)
+                    for ipv, classes in cls.IPTABLES.items()}
+        # Updated in place, as the pool shares the mapping
+        for ipv, classes in iptables.items():
+            cls.IPTABLES[ipv].update(classes)
+        cls.POOL.clear()
+        return previous
+
     def _iptc_table(self):
         """ Returns the iptc table. """
         ipv = self.ipv if self.ipv else 4
         tableName = self.table if self.table else "FILTER"
-        tableClass = self.IPTABLES[ipv]['table']
-        return tableClass(
-            tableClass.__dict__[tableName])
+        return self.POOL.table(ipv, tableName)
 
     def _iptc_chain(self):
         """ Returns the iptc chain. """
@@ -428,7 +676,10 @@ class Rule:
             match = rule.create_match(m)
             # Create arguments based on value dict.
             for arg, val in params.items():
-                match.set_parameter(arg, str(val))
+                if isinstance(val, (list, tuple)):
+                    match.set_parameter(arg, [str(v) for v in val])
+                else:
+                    match.set_parameter(arg, str(val))
 
         return rule
 
@@ -448,6 +699,13 @@ class Rule:
             for prop, val in match.get_all_parameters().items():
                 kwargs[key][prop] = ','.join(val)
 
+        # Target parameters, e.g. LOG --log-prefix, as in Rule.from_save
+        if rule.target:
+            target_param = {prop: ','.join(val) for prop, val in
+                            rule.target.get_all_parameters().items()}
+            if target_param:
+                kwargs['target_param'] = target_param
+
         params = {'src': rule.get_src(),
                   'dst': rule.get_dst(),
                   'in_interface': rule.get_in_interface(),
@@ -465,6 +723,86 @@ class Rule:
                     target=rule.target.name,
                     **kwargs)
 
+    # iptables-save options for rule params
+    __SAVE_OPTS = {'-s': 'src', '--source': 'src',
+                   '-d': 'dst', '--destination': 'dst',
+                   '-i': 'in_interface', '--in-interface': 'in_interface',
+                   '-o': 'out_interface', '--out-interface': 'out_interface',
+                   '-p': 'protocol', '--protocol': 'protocol'}
+
+    @classmethod
+    def from_save(cls, line, table=None, ipv=4):
+        """ Converts an iptables-save rule line into a baleful.Rule object.
+        line -- an '-A CHAIN ...' line, optionally prefixed by [pkts:bytes]
+        table -- the table the line was saved from (str)
+        ipv -- The inet version 4 or 6 (int)
+
+        Match option values are joined with ',', as in Rule.from_iptc.
+        A goto (-g) is read as a jump. """
+
+        tokens = shlex.split(line)
+        if tokens and tokens[0].startswith('['):
+            tokens.pop(0)
+
+        if len(tokens) < 2 or tokens[0] not in ['-A', '--append']:
+            raise(ValueError("Not an iptables-save rule: {}".format(line)))
+
+        chain = tokens[1]
+        target = None
+        params = dict()
+        kwargs = dict()
+        opts = None
+        key = None
+        neg = ''
+
+        for tok in tokens[2:]:
+            if tok == '!':
+                neg = '!'
+            elif tok in cls.__SAVE_OPTS and not kwargs:
+                key = cls.__SAVE_OPTS[tok]
+                opts = params
+            elif tok in ['-f', '--fragment']:
+                params['fragment'] = not neg
+                neg = ''
+                key = None
+            elif tok in ['-m', '--match']:
+                key = 'match'
+            elif tok in ['-j', '--jump', '-g', '--goto']:
+                key = 'target'
+            elif tok.startswith('--') and opts is not None:
+                key = tok[2:]
+                opts[key] = neg
+                neg = ''
+            elif key == 'match':
+                opts = kwargs.setdefault(tok, dict())
+                key = None
+            elif key == 'target':
+                target = tok
+                opts = kwargs.setdefault('target_param', dict())
+                key = None
+            elif opts is params and key:
+                params[key] = neg + tok
+                neg = ''
+                key = None
+                opts = None
+            elif key:
+                if opts[key] and opts[key] != '!':
+                    opts[key] += ','
+                opts[key] += tok
+            else:
+                raise(ValueError(
+                    "Unexpected token {!r} in: {}".format(tok, line)))
+
+        if 'target_param' in kwargs and not kwargs['target_param']:
+            kwargs.pop('target_param')
+
+        return Rule(params=params,
+                    ipv=ipv,
+                    chain=chain,
+                    table=table.upper() if table else None,
+                    target=target,
+                    **kwargs)
+
     def __iptc_rule_iter(self):
         """ Iterates over rules for a particular chain."""
         chain = self._iptc_chain()
@@ -490,6 +828,170 @@ class Rule:
                 yield brule
 
 
+class FrozenRule:
+    """ An immutable, compact rule.
+    Only non-default params are stored, match options are tuples, and values
+    are interned, so rules generated from the same apps and routes share
+    their data. Frozen rules are hashable, safe to share between threads, and
+    can be used in RuleArrays and Topologies alongside Rules.
+    See Rule.freeze and FrozenRule.thaw. """
+
+    __slots__ = ('ipv', 'table', 'chain', 'target', 'lock',
+                 'params', 'kwargs', '_key', '_str', '_restore')
+
+    # The most recently used values are shared, see FrozenRule.__intern
+    INTERN_SIZE = 65536
+
+    __INTERN = collections.OrderedDict()
+
+    @classmethod
+    def __intern(cls, value):
+        """ Returns a shared instance of an equal value.
+        Least recently used values are evicted beyond INTERN_SIZE, so long
+        running processes don't grow without bound. """
+        if isinstance(value, str):
+            return sys.intern(value)
+        interned = cls.__INTERN
+        key = (type(value), value)
+        try:
+            shared = interned[key]
+            interned.move_to_end(key)
+            return shared
+        except TypeError:
+            return value
+        except KeyError:
+            pass
+        interned[key] = value
+        while len(interned) > cls.INTERN_SIZE:
+            try:
+                interned.popitem(last=False)
+            except KeyError:
+                break
+        return value
+
+    def __init__(self, rule):
+        """Arguments:
+        rule -- the Rule to freeze
+        """
+        intern = self.__intern
+        ipv = rule.ipv if rule.ipv else 4
+        wild = Rule.WILD_NET[ipv]
+
+        params = tuple((intern(k), intern(v))
+                       for k, v in rule.params.items()
+                       if v and v != wild and
+                       not (k == 'protocol' and v == 'ip'))
+
+        kwargs = tuple((intern(m),
+                        intern(tuple((intern(k), intern(v))
+                                     for k, v in opts.items())))
+                       for m, opts in rule.kwargs.items())
+
+        set_slot = object.__setattr__
+        set_slot(self, 'ipv', rule.ipv)
+        set_slot(self, 'table', intern(rule.table) if rule.table else None)
+        set_slot(self, 'chain', intern(rule.chain) if rule.chain else None)
+        set_slot(self, 'target', intern(rule.target) if rule.target else None)
+        set_slot(self, 'lock', rule.lock)
+        set_slot(self, 'params', intern(params))
+        set_slot(self, 'kwargs', intern(kwargs))
+        set_slot(self, '_key', rule._key)
+        set_slot(self, '_str', rule._str)
+        set_slot(self, '_restore', rule._restore)
+
+    def __setattr__(self, name, value):
+        raise(AttributeError("FrozenRule is immutable, see thaw()."))
+
+    def __reduce__(self):
+        """ Pickles the thawed rule, it is frozen again when unpickled. """
+        return (FrozenRule, (self.thaw(),))
+
+    def thaw(self):
+        """ Returns a mutable Rule. """
+        return Rule(params=dict(self.params),
+                    target=self.target,
+                    chain=self.chain,
+                    table=self.table,
+                    ipv=self.ipv,
+                    lock=self.lock,
+                    **{m: dict(opts) for m, opts in self.kwargs})
+
+    def freeze(self):
+        return self
+
+    def copy(self):
+        """ Frozen rules are immutable, so they are shared not copied. """
+        return self
+
+    def key(self):
+        """ Returns the canonical key of the rule, see Rule.key. """
+        if not self._key:
+            object.__setattr__(self, '_key', self.thaw().key())
+        return self._key
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __eq__(self, other):
+        if not isinstance(other, (Rule, FrozenRule)):
+            return NotImplemented
+        return self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __mul__(self, other):
+        if not isinstance(other, (Rule, FrozenRule)):
+            return NotImplemented
+        return Rule.combine(self.thaw(), other.thaw()).freeze()
+
+    def __rmul__(self, other):
+        if not isinstance(other, Rule):
+            return NotImplemented
+        return Rule.combine(other, self.thaw()).freeze()
+
+    def __sub__(self, other):
+        if not isinstance(other, (Rule, FrozenRule)):
+            return NotImplemented
+        return (self.thaw() - other.thaw()).freeze()
+
+    def __rsub__(self, other):
+        if not isinstance(other, Rule):
+            return NotImplemented
+        return other - self.thaw()
+
+    def __contains__(self, rule):
+        return rule.thaw() in self.thaw()
+
+    def __str__(self):
+        if not self._str:
+            object.__setattr__(self, '_str', str(self.thaw()))
+        return self._str
+
+    def dict(self):
+        return self.thaw().dict()
+
+    def flipped(self):
+        """ Returns a flipped FrozenRule. """
+        return self.thaw().flipped().freeze()
+
+    def restore(self, position=None):
+        if not isinstance(position, type(None)):
+            return self.thaw().restore(position=position)
+        if not self._restore:
+            object.__setattr__(self, '_restore', self.thaw().restore())
+        return self._restore
+
+    def nft(self):
+        return self.thaw().nft()
+
+    def iptc(self):
+        return self.thaw().iptc()
+
+    def exists(self):
+        return self.thaw().exists()
+
+
 class RuleArray(list):
     """ A rule array class for handling Rules """
 
@@ -499,7 +1001,7 @@ class RuleArray(list):
         """
 
         for R in rules:
-            if not isinstance(R, Rule):
+            if not isinstance(R, (Rule, FrozenRule)):
                 raise(TypeError(
                     "Only type(Rule) is allowed."))
             else:
@@ -512,17 +1014,64 @@ class RuleArray(list):
             newArray.append(R.copy())
         return newArray
 
+    def freeze(self):
+        """ Returns a RuleArray of FrozenRules. """
+        return RuleArray(*[R.freeze() for R in self])
+
+    def thaw(self):
+        """ Returns a RuleArray of mutable Rules. """
+        return RuleArray(*[R.thaw() if isinstance(R, FrozenRule) else R.copy()
+                           for R in self])
+
+    def dump(self, fp):
+        """ Writes each rule as a line to a file object. """
+        for R in self:
+            fp.write(str(R))
+            fp.write('\n')
+
+    def lazy(self):
+        """ Returns a lazy view of the array, see RuleView. """
+        return RuleConcat(self)
+
+    def flipped(self):
+        """ Returns a RuleArray of flipped copies of the rules. """
+        return RuleArray(*[R.flipped() for R in self])
+
     def __add__(self, other):
         """ Add two RuleArrays together. """
+        if isinstance(other, RuleView):
+            return NotImplemented
         return RuleArray(*self, *other)
 
     def __sub__(self, other):
         """ Subtract two RuleArrays together. """
-        rules = self.copy()
-        for rule in other:
-            if rule in rules:
-                rules.pop(rule)
-        return rules
+        return self.difference(other).copy()
+
+    def dedupe(self):
+        """ Returns the rules without duplicates, keeping the first of each.
+        Rules are compared by their canonical key (see Rule.key). """
+        seen = set()
+        rarr = RuleArray()
+        for rule in self:
+            if rule not in seen:
+                seen.add(rule)
+                rarr.append(rule)
+        return rarr
+
+    def difference(self, other):
+        """ Returns rules which are not in other, in order. """
+        keys = set(other)
+        return RuleArray(*[rule for rule in self if rule not in keys])
+
+    def intersection(self, other):
+        """ Returns rules which are also in other, in order. """
+        keys = set(other)
+        return RuleArray(*[rule for rule in self if rule in keys])
+
+    def union(self, other):
+        """ Returns rules in either array without duplicates,
+        self first, then other. """
+        return (self + other).dedupe()
 
     @staticmethod
     def combine(x, y):
@@ -535,7 +1084,7 @@ class RuleArray(list):
 
     def __mul__(self, other):
         """ Adds a rule with every item in Array. """
-        if isinstance(other, Rule):
+        if isinstance(other, (Rule, FrozenRule)):
             y = RuleArray(other)
         elif isinstance(other, RuleArray):
             y = other
@@ -546,7 +1095,7 @@ class RuleArray(list):
     def __rmul__(self, other):
         """ Adds a rule with every item in Array.
         y * x_arr = z_arr, where values in x_arr take precedence. """
-        if isinstance(other, Rule):
+        if isinstance(other, (Rule, FrozenRule)):
             y = RuleArray(other)
         else:
             return NotImplemented
@@ -578,25 +1127,243 @@ class RuleArray(list):
             ipv = [ipv]
 
         if isinstance(table, type(None)):
-            iptc_tables = [Rule.IPTABLES[v]['table'](t)
-                           for v in ipv
-                           for t in Rule.IPTABLES[v]['table'].ALL]
+            tables = [(v, t.upper())
+                      for v in ipv
+                      for t in Rule.IPTABLES[v]['table'].ALL]
 
         else:
-            iptc_tables = [Rule.IPTABLES[v]['table'](
-                Rule.IPTABLES[v]['table'].__dict__[table])
-                for v in ipv]
+            tables = [(v, table) for v in ipv]
+
+        with Rule.POOL.transaction() as pool:
+            for v, t in tables:
+                tableObj = pool.table(v, t, read=True)
+                if isinstance(chain, type(None)):
+                    iptc_chains = tableObj.chains
+                else:
+                    iptc_chains = [pool.chain(v, t, chain, read=True)]
+
+                for chainObj in iptc_chains:
+                    for iptc_rule in chainObj.rules:
+                        rarr.append(
+                            Rule.from_iptc(
+                                iptc_rule))
+        return rarr
 
-        for tableObj in iptc_tables:
-            if isinstance(chain, type(None)):
-                iptc_chains = tableObj.chains
+    @classmethod
+    def parse_save(cls, lines, table=None, chain=None, ipv=4):
+        """ Creates a RuleArray from iptables-save output.
+        lines -- an iterable of iptables-save lines (e.g. a file object)
+        table -- only read rules from this table (str)
+        chain -- only read rules from this chain (str)
+        ipv -- The inet version of the saved rules (int) """
+
+        rarr = RuleArray()
+        current = None
+
+        for line in lines:
+            line = line.strip()
+            if line.startswith('*'):
+                current = line[1:]
+            elif not line.startswith(('-A', '[')):
+                continue
+            elif table and str(current).upper() != table.upper():
+                continue
+            elif chain and line.split(None, 3)[
+                    2 if line.startswith('[') else 1] != chain:
+                continue
             else:
-                iptc_chains = [Rule.IPTABLES[v]['chain'](
-                    tableObj, chain) for v in ipv]
-
-            for chainObj in iptc_chains:
-                for iptc_rule in chainObj.rules:
-                    rarr.append(
-                        Rule.from_iptc(
-                            iptc_rule))
+                rarr.append(
+                    Rule.from_save(
+                        line, table=current, ipv=ipv))
         return rarr
+
+    @classmethod
+    def read_save(cls, table=None, chain=None, ipv=None, fp=None):
+        """ Creates a RuleArray from iptables-save output.
+        This is much faster than RuleArray.read for large rulesets.
+        table -- only read rules from this table (str)
+        chain -- only read rules from this chain (str)
+        ipv -- The inet version 4 or 6 (int), defaults to both,
+        or to 4 when reading from fp
+        fp -- read saved rules from this file, instead of running
+        iptables-save/ip6tables-save """
+
+        if not isinstance(fp, type(None)):
+            return cls.parse_save(fp, table=table, chain=chain,
+                                  ipv=ipv if ipv else 4)
+
+        if isinstance(ipv, type(None)):
+            ipv = [4, 6]
+        else:
+            ipv = [ipv]
+
+        rarr = RuleArray()
+        for v in ipv:
+            args = [Rule.IPTABLES[v]['save']]
+            if table:
+                args += ['-t', table.lower()]
+
+            with subprocess.Popen(args,
+                                  stdout=subprocess.PIPE,
+                                  universal_newlines=True) as proc:
+                rarr += cls.parse_save(proc.stdout, table=table,
+                                       chain=chain, ipv=v)
+            if proc.returncode:
+                raise(subprocess.CalledProcessError(
+                    proc.returncode, args))
+        return rarr
+
+
+class RuleView(collections.abc.Sequence):
+    """ A lazy, read-only sequence of rules.
+
+    Views compose with *, + and flipped() without materializing, so chained
+    expressions only build rules as they are iterated or indexed.
+    Indexing is computed arithmetically and each access builds a new rule,
+    so changes to an item are not kept; see materialize().
+
+    Subclasses implement __len__ and _get (collections.abc.Sequence is an
+    abstract base class, so incomplete views can't be constructed).
+
+    Example:
+    rules = topo.lazy() * routes * app
+    """
+
+    @abc.abstractmethod
+    def __len__(self):
+        pass
+
+    @abc.abstractmethod
+    def _get(self, index):
+        """ Returns the item at a (non-negative) index. """
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return RuleArray(*[self._get(i)
+                               for i in range(*key.indices(len(self)))])
+        if not isinstance(key, int):
+            raise(TypeError(
+                "Indices must be integers or slices."))
+
+        length = len(self)
+        if key < 0:
+            key += length
+        if not 0 <= key < length:
+            raise(IndexError("RuleView index out of range"))
+        return self._get(key)
+
+    def lazy(self):
+        return self
+
+    def materialize(self):
+        """ Returns a RuleArray of all rules in the view. """
+        return RuleArray(*self)
+
+    def copy(self):
+        """ Returns a materialized copy of the view. """
+        return self.materialize().copy()
+
+    def flipped(self):
+        """ Returns a lazy view of flipped rules. """
+        return RuleFlip(self)
+
+    @staticmethod
+    def __wrap(other):
+        """ Returns other as a sequence of rules, or None. """
+        if isinstance(other, (Rule, FrozenRule)):
+            return RuleArray(other)
+        if isinstance(other, (RuleArray, RuleView)):
+            return other
+        return None
+
+    def __mul__(self, other):
+        y = self.__wrap(other)
+        if isinstance(y, type(None)):
+            return NotImplemented
+        return RuleProduct(self, y)
+
+    def __rmul__(self, other):
+        y = self.__wrap(other)
+        if isinstance(y, type(None)):
+            return NotImplemented
+        return RuleProduct(y, self)
+
+    def __add__(self, other):
+        if not isinstance(other, (list, RuleView)):
+            return NotImplemented
+        return RuleConcat(self, other)
+
+    def __radd__(self, other):
+        if not isinstance(other, list):
+            return NotImplemented
+        return RuleConcat(other, self)
+
+
+class RuleProduct(RuleView):
+    """ A lazy cartesian product x * y of two rule sequences.
+    Item i is x[i // len(y)] * y[i % len(y)], as in RuleArray.combine. """
+
+    def __init__(self, x, y):
+        """Arguments:
+        x -- the left sequence of rules, which take precedence
+        y -- the right sequence of rules
+        """
+        self.x = x
+        self.y = y
+
+    def __len__(self):
+        return len(self.x) * len(self.y)
+
+    def _get(self, index):
+        i, j = divmod(index, len(self.y))
+        return self.x[i] * self.y[j]
+
+    def __iter__(self):
+        for i in self.x:
+            for j in self.y:
+                yield i * j
+
+
+class RuleConcat(RuleView):
+    """ A lazy concatenation of rule sequences. """
+
+    def __init__(self, *parts):
+        """Arguments:
+        *parts -- sequences of rules
+        """
+        self.parts = parts
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+
+    def _get(self, index):
+        for part in self.parts:
+            if index < len(part):
+                return part[index]
+            index -= len(part)
+        raise(IndexError("RuleView index out of range"))
+
+    def __iter__(self):
+        for part in self.parts:
+            for rule in part:
+                yield rule
+
+
+class RuleFlip(RuleView):
+    """ A lazy view of flipped rules, see Rule.flipped. """
+
+    def __init__(self, rules):
+        """Arguments:
+        rules -- a sequence of rules
+        """
+        self.rules = rules
+
+    def __len__(self):
+        return len(self.rules)
+
+    def _get(self, index):
+        return self.rules[index].flipped()
+
+    def __iter__(self):
+        for rule in self.rules:
+            yield rule.flipped()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+import contextlib
+import errno
+import os
+import iptc
+
+
+class TablePool:
+    """ A shared pool of iptc table handles with explicit transactions.
+
+    Handles are keyed by inet version and table name. Inside a transaction,
+    autocommit is disabled: each table is read from the kernel once, changes
+    are batched in memory, and every changed table is committed (and
+    refreshed) once at the end of the outermost transaction. Tables which
+    were only read are not committed.
+
+    Example:
+    with Rule.POOL.transaction() as pool:
+        for rule in rules:
+            pool.append(rule)
+    """
+
+    ERRORS = (iptc.ip4tc.IPTCError, iptc.ip6tc.IPTCError)
+
+    def __init__(self, iptables, retries=3):
+        """ Arguments:
+        iptables -- a mapping of inet version to iptc classes (Rule.IPTABLES)
+        retries -- times to replay a transaction, when another writer changes
+        a table before it is committed.
+        """
+        self.iptables = iptables
+        self.retries = retries
+        self.handles = dict()
+        self.stale = set()
+        self.touched = set()
+        self.dirty = set()
+        self.ops = list()
+        self.depth = 0
+        self.executing = 0
+
+    def table(self, ipv=4, name="FILTER", read=False):
+        """ Returns the pooled iptc table handle.
+        Invalidated handles are refreshed from the kernel on access.
+        read -- the handle is only read by the executing operation, so it
+        need not be committed """
+        key = (ipv, name.upper())
+        tableClass = self.iptables[ipv]['table']
+
+        if key not in self.handles:
+            self.handles[key] = tableClass(getattr(tableClass, key[1]))
+        elif key in self.stale:
+            self.handles[key].refresh()
+        self.stale.discard(key)
+
+        table = self.handles[key]
+        table.autocommit = not self.depth
+        if self.depth:
+            self.touched.add(key)
+            if self.executing and not read:
+                self.dirty.add(key)
+        return table
+
+    def chain(self, ipv=4, table="FILTER", chain="OUTPUT", read=False):
+        """ Returns an iptc chain from a pooled table handle.
+        read -- the chain is only read, see TablePool.table """
+        return self.iptables[ipv]['chain'](
+            self.table(ipv, table, read=read), chain)
+
+    def clear(self):
+        """ Drops every handle, so tables are re-opened from the current
+        backend (see Rule.use). """
+        if self.depth:
+            raise(ValueError("can't clear the pool within a transaction"))
+        self.handles = dict()
+        self.stale = set()
+        self.touched = set()
+        self.dirty = set()
+        self.ops = list()
+
+    def invalidate(self, ipv=None, name=None):
+        """ Marks handles as stale, after another writer changed a table.
+        ipv -- the inet version to invalidate (default all)
+        name -- the table name to invalidate (default all) """
+        for key in self.handles:
+            if ((isinstance(ipv, type(None)) or key[0] == ipv) and
+                    (isinstance(name, type(None)) or
+                     key[1] == name.upper())):
+                self.stale.add(key)
+
+    def begin(self):
+        """ Begins a (nested) transaction.
+        The outermost transaction re-reads each table on first access. """
+        if not self.depth:
+            self.invalidate()
+            self.touched = set()
+            self.dirty = set()
+            self.ops = list()
+        self.depth += 1
+
+    def commit(self):
+        """ Ends a (nested) transaction.
+        The outermost transaction commits every changed table once,
+        replaying its operations if another writer got there first. """
+        self.depth -= 1
+        if self.depth:
+            return
+
+        attempt = 0
+        while True:
+            try:
+                self.__commit()
+                break
+            except self.ERRORS as e:
+                attempt += 1
+                if (attempt > self.retries or
+                        os.strerror(errno.EAGAIN) not in str(e)):
+                    self.rollback()
+                    raise
+                self.__replay()
+        self.ops = list()
+
+    def rollback(self):
+        """ Aborts the transaction, discarding uncommitted changes. """
+        self.depth = 0
+        self.executing = 0
+        for key in self.touched:
+            if key in self.dirty:
+                self.handles[key].refresh()
+            self.handles[key].autocommit = True
+        self.touched = set()
+        self.dirty = set()
+        self.ops = list()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ A context manager for a transaction. """
+        self.begin()
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    def __commit(self):
+        """ Commits and refreshes every changed table, and releases tables
+        which were only read. """
+        for key in self.dirty:
+            self.handles[key].commit()
+        for key in self.touched:
+            if key in self.dirty:
+                self.handles[key].refresh()
+            self.handles[key].autocommit = True
+        self.touched = set()
+        self.dirty = set()
+
+    def __replay(self):
+        """ Re-reads changed tables and replays recorded operations. """
+        depth = self.depth
+        ops = self.ops
+        self.rollback()
+        self.begin()
+        for fn, args in ops:
+            self.execute(fn, *args)
+        self.depth = depth
+
+    def execute(self, fn, *args):
+        """ Executes a table operation.
+        Within a transaction, the operation is recorded for replay, so it
+        should look up handles through the pool, which marks the tables it
+        uses as changed. Operations executed by an operation are replayed
+        with it, not on their own, e.g. Node.sync recomputes its diff.
+        """
+        self.executing += 1
+        try:
+            ret = fn(*args)
+        finally:
+            self.executing -= 1
+        if self.depth and not self.executing:
+            self.ops.append((fn, args))
+        return ret
+
+    def append(self, rule):
+        """ Appends a baleful rule to its chain. """
+        self.execute(self.__append, rule)
+
+    def insert(self, rule, position=0):
+        """ Inserts a baleful rule into its chain. """
+        self.execute(self.__insert, rule, position)
+
+    def delete(self, rule):
+        """ Deletes a baleful rule from its chain. """
+        self.execute(self.__delete, rule)
+
+    def delete_at(self, ipv=4, table="FILTER", chain="OUTPUT", position=0):
+        """ Deletes the rule at a (0-based) position in a chain. """
+        self.execute(self.__delete_at, ipv, table, chain, position)
+
+    def create_chain(self, ipv=4, table="FILTER", chain="OUTPUT"):
+        """ Creates a user-defined chain, unless it exists. """
+        self.execute(self.__create_chain, ipv, table, chain)
+
+    def flush(self, ipv=4, table="FILTER", chain="OUTPUT"):
+        """ Flushes all rules from a chain. """
+        self.execute(self.__flush, ipv, table, chain)
+
+    def zero(self, ipv=4, table="FILTER", chain="OUTPUT"):
+        """ Zeroes the packet and byte counters of a chain. """
+        self.execute(self.__zero, ipv, table, chain)
+
+    def delete_chain(self, ipv=4, table="FILTER", chain="OUTPUT"):
+        """ Deletes a user-defined chain. """
+        self.execute(self.__delete_chain, ipv, table, chain)
+
+    def set_policy(self, ipv=4, table="FILTER", chain="OUTPUT",
+                   policy="ACCEPT"):
+        """ Sets the policy of a built-in chain. """
+        self.execute(self.__set_policy, ipv, table, chain, policy)
+
+    def __append(self, rule):
+        iptc_rule = rule.iptc()
+        iptc_rule.chain.append_rule(iptc_rule)
+
+    def __insert(self, rule, position):
+        iptc_rule = rule.iptc()
+        iptc_rule.chain.insert_rule(iptc_rule, position)
+
+    def __delete(self, rule):
+        iptc_rule = rule.iptc()
+        iptc_rule.chain.delete_rule(iptc_rule)
+
+    def __delete_at(self, ipv, table, chain, position):
+        # By rule number, as deleting by content removes the first matching
+        # rule, e.g. a copy of it inserted earlier in the chain
+        tableObj = self.table(ipv, table)
+        if hasattr(tableObj, 'delete_num_entry'):
+            tableObj.delete_num_entry(chain, position)
+            return
+
+        # python-iptables only deletes by content, so call libiptc
+        rv = tableObj._iptc.iptc_delete_num_entry(
+            chain.encode(), position, tableObj._handle)
+        if rv != 1:
+            error = (iptc.ip4tc.IPTCError if ipv == 4
+                     else iptc.ip6tc.IPTCError)
+            raise(error("can't delete entry from chain {}: {}".format(
+                chain, tableObj.strerror())))
+        if tableObj.autocommit:
+            tableObj.refresh()
+
+    def __create_chain(self, ipv, table, chain):
+        if not self.table(ipv, table, read=True).is_chain(chain):
+            self.table(ipv, table).create_chain(chain)
+
+    def __flush(self, ipv, table, chain):
+        self.chain(ipv, table, chain).flush()
+
+    def __zero(self, ipv, table, chain):
+        self.chain(ipv, table, chain).zero_counters()
+
+    def __delete_chain(self, ipv, table, chain):
+        self.chain(ipv, table, chain).delete()
+
+    def __set_policy(self, ipv, table, chain, policy):
+        self.chain(ipv, table, chain).set_policy(policy)
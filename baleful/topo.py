@@ -4,6 +4,8 @@ import baleful.rule
 
 RuleArray = baleful.rule.RuleArray
 Rule = baleful.rule.Rule
+FrozenRule = baleful.rule.FrozenRule
+RuleView = baleful.rule.RuleView
 
 
 class Topology:
@@ -26,6 +28,27 @@ class Topology:
         return Topology(self.forward.copy(),
                         self.reverse.copy())
 
+    def lazy(self):
+        """ Returns a Topology of lazy views, see RuleView.
+        Combinations with it are computed on iteration. """
+        return Topology(self.forward.lazy(),
+                        self.reverse.lazy())
+
+    def materialize(self):
+        """ Returns a Topology of RuleArrays. """
+        return Topology(RuleArray(*self.forward),
+                        RuleArray(*self.reverse))
+
+    def freeze(self):
+        """ Returns a Topology of FrozenRules, see Rule.freeze. """
+        return Topology(self.forward.freeze(),
+                        self.reverse.freeze())
+
+    def thaw(self):
+        """ Returns a Topology of mutable Rules. """
+        return Topology(self.forward.thaw(),
+                        self.reverse.thaw())
+
     @staticmethod
     def combine(x, y):
         """ Combines two topologies together.
@@ -37,20 +60,17 @@ class Topology:
         yforward = y.forward
         yreverse = y.reverse
 
-        yforward_flipped = y.forward.copy()
-        yreverse_flipped = y.reverse.copy()
-
-        for i in yforward_flipped + yreverse_flipped:
-            i.flip()
+        yforward_flipped = yforward.flipped()
+        yreverse_flipped = yreverse.flipped()
 
         return Topology(
             forward=xforward * yforward + xforward * yreverse_flipped,
             reverse=xreverse * yforward_flipped + xreverse * yreverse)
 
     def __mul__(self, other):
-        if isinstance(other, Rule):
+        if isinstance(other, (Rule, FrozenRule)):
             y = Topology(RuleArray(other))
-        elif isinstance(other, RuleArray):
+        elif isinstance(other, (RuleArray, RuleView)):
             y = Topology(other)
         elif isinstance(other, Topology):
             y = other
@@ -60,9 +80,9 @@ class Topology:
         return self.combine(self, y)
 
     def __rmul__(self, other):
-        if isinstance(other, Rule):
+        if isinstance(other, (Rule, FrozenRule)):
             y = Topology(RuleArray(other))
-        elif isinstance(other, RuleArray):
+        elif isinstance(other, (RuleArray, RuleView)):
             y = Topology(other)
         elif isinstance(other, Topology):
             y = other
@@ -83,8 +103,29 @@ class Topology:
 
     def __getitem__(self, key: int):
         """ Returns rule item from Topology,
-        ordered thru self.forward, then self.reverse. """
-        return (self.forward + self.reverse)[key]
+        ordered thru self.forward, then self.reverse.
+        Slices return a RuleArray. """
+        if isinstance(key, slice):
+            return RuleArray(*[self[i]
+                               for i in range(*key.indices(len(self)))])
+        if not isinstance(key, int):
+            raise(TypeError(
+                "Topology indices must be integers or slices."))
+
+        length = len(self)
+        if key < 0:
+            key += length
+        if not 0 <= key < length:
+            raise(IndexError("Topology index out of range"))
+
+        forward = len(self.forward)
+        if key < forward:
+            return self.forward[key]
+        return self.reverse[key - forward]
+
+    def views(self):
+        """ Returns the (forward, reverse) rules, without copying. """
+        return self.forward, self.reverse
 
     def __len__(self):
         """ Returns the length of the Topology. """
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+"""Compares linear evaluation with DecisionTree lookups of random rulesets.
+Rules match a protocol, a destination port and (mostly) a source network.
+
+python3 -m bench.bench_classify [-r rules ...] [-p packets] [-n repeats]
+"""
+
+import argparse
+import timeit
+import numpy
+from baleful.node import Node
+from baleful.rule import Rule
+from baleful.classify import Classifier, Packets
+
+
+def ruleset(count, rng):
+    """ Returns a Node with count random INPUT rules. """
+    rules = list()
+    for i in range(count):
+        proto = ['tcp', 'udp'][rng.randint(2)]
+        params = {'protocol': proto}
+        if rng.rand() < 0.9:
+            params['src'] = '10.{}.{}.0/24'.format(
+                rng.randint(256), rng.randint(256))
+        rules.append(Rule(chain="INPUT",
+                          target=['ACCEPT', 'DROP'][rng.randint(2)],
+                          params=params,
+                          **{proto: {'dport': rng.randint(1, 1024)}}))
+    return Node("bench", rules=rules, policy={4: {"INPUT": "DROP"}})
+
+
+def packets(count, rng):
+    """ Returns count random packets. """
+    return Packets(4, 'INPUT',
+                   src=(10 << 24) + rng.randint(0, 1 << 24, count),
+                   protocol=rng.choice([6, 17], count),
+                   dport=rng.randint(1, 1024, count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-r', '--rules', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('-p', '--packets', type=int, default=100000)
+    parser.add_argument('-n', '--repeat', type=int, default=3)
+    parser.add_argument('--no-linear', dest='linear', action='store_false',
+                        help='only time decision trees')
+    args = parser.parse_args()
+
+    rng = numpy.random.RandomState(0)
+    batch = packets(args.packets, rng)
+
+    for count in args.rules:
+        node = ruleset(count, rng)
+        modes = [True, False] if args.linear else [True]
+        for tree in modes:
+            start = timeit.default_timer()
+            classifier = Classifier(node, tree=tree)
+            build = timeit.default_timer() - start
+
+            best = min(timeit.repeat(
+                lambda: classifier.classify(batch),
+                number=1, repeat=args.repeat))
+            print('{:6} {:8d} rules {:8.2f} s build {:8.4f} s '
+                  '{:10.3f} us/packet'.format(
+                      'tree' if tree else 'linear', count, build, best,
+                      1e6 * best / len(batch)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+"""Compares RuleArray.read (python-iptables) with RuleArray.read_save
+(iptables-save parsing) on the rules loaded on this host.
+Root privileges are required.
+
+python3 -m bench.bench_read [-n repeats] [-t table] [-6]
+"""
+
+import argparse
+import timeit
+from baleful.rule import RuleArray
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--repeat', type=int, default=3)
+    parser.add_argument('-t', '--table', default=None)
+    parser.add_argument('-6', dest='ipv', action='store_const',
+                        const=6, default=4)
+    args = parser.parse_args()
+
+    readers = {'iptc': RuleArray.read,
+               'save': RuleArray.read_save}
+
+    for name, reader in readers.items():
+        rules = reader(table=args.table, ipv=args.ipv)
+        best = min(timeit.repeat(
+            lambda: reader(table=args.table, ipv=args.ipv),
+            number=1, repeat=args.repeat))
+        print('{:5} {:8d} rules {:10.4f} s {:10.1f} us/rule'.format(
+            name, len(rules), best,
+            1e6 * best / len(rules) if rules else 0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+"""Times rule generation, rendering, comparison and apply on synthetic
+workloads: interfaces x baleful.app services x Topology products, at
+increasing numbers of interfaces. Apply paths run against the in-memory
+backend (baleful.memory), so no root privileges are required.
+
+Results are written as JSON, to be compared between commits:
+python3 -m bench.bench_suite [-i interfaces ...] [-n repeats] [-o out.json]
+python3 -m bench.bench_suite --compare old.json new.json [-t threshold]
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import timeit
+import baleful.app
+from baleful.memory import Backend
+from baleful.node import Node
+from baleful.rule import Rule, RuleArray
+from baleful.topo import Topology
+
+
+class Workload:
+    """ Synthetic rules for a number of interfaces.
+    Each interface is a client Topology (OUTPUT out of, INPUT into the
+    interface, for a /16 subnet), multiplied by every baleful.app service. """
+
+    def __init__(self, interfaces):
+        self.interfaces = interfaces
+        self.services = [v for k, v in sorted(vars(baleful.app).items())
+                         if isinstance(v, (RuleArray, Topology))]
+        self.topos = [self.topology(i) for i in range(interfaces)]
+
+        self.app_rules = RuleArray()
+        for service in self.services:
+            self.app_rules += RuleArray(*service)
+
+        self.rules = RuleArray()
+        for topo in self.topos:
+            for service in self.services:
+                self.rules += RuleArray(*(topo * service))
+
+    @staticmethod
+    def topology(index):
+        """ Returns the client Topology of an interface. """
+        iface = 'eth{}'.format(index)
+        net = '10.{}.0.0/16'.format(index % 256)
+        return Topology(
+            RuleArray(Rule(chain="OUTPUT", target="ACCEPT",
+                           params={'out_interface': iface, 'dst': net})),
+            RuleArray(Rule(chain="INPUT", target="ACCEPT",
+                           params={'in_interface': iface, 'src': net})))
+
+    def node(self):
+        return Node("bench", rules=[r.copy() for r in self.rules])
+
+
+# Each case is (setup, run): setup(workload) returns the state for one
+# timed run(state), which returns the number of operations timed.
+
+def setup_copies(work):
+    return [r.copy() for r in work.rules]
+
+
+def run_combine(work):
+    routes = [r for topo in work.topos for r in topo]
+    for x in routes:
+        for y in work.app_rules:
+            Rule.combine(x, y)
+    return len(routes) * len(work.app_rules)
+
+
+def run_rulearray_mul(work):
+    routes = RuleArray(*[r for topo in work.topos for r in topo])
+    return len(routes * work.app_rules)
+
+
+def run_topology_combine(work):
+    count = 0
+    for topo in work.topos:
+        for service in work.services:
+            if isinstance(service, RuleArray):
+                service = Topology(service)
+            count += len(Topology.combine(topo, service))
+    return count
+
+
+def setup_pairs(work):
+    return setup_copies(work), setup_copies(work)
+
+
+def run_eq(pairs):
+    for x, y in zip(*pairs):
+        x == y
+    return len(pairs[0])
+
+
+def run_contains(rules):
+    general = Rule(target="ACCEPT")
+    for rule in rules:
+        rule in general
+    return len(rules)
+
+
+def run_str(rules):
+    for rule in rules:
+        str(rule)
+    return len(rules)
+
+
+def setup_backend(work):
+    backend = Backend()
+    node = work.node()
+    with backend.install():
+        node.start()
+    return backend, node
+
+
+def run_from_iptc(state):
+    backend, node = state
+    with backend.install():
+        iptc_rules = [r for v, t, c in node.chains()
+                      for r in Rule.POOL.chain(v, t, c).rules]
+        for rule in iptc_rules:
+            Rule.from_iptc(rule)
+    return len(iptc_rules)
+
+
+def run_read(state):
+    backend, node = state
+    with backend.install():
+        return len(RuleArray.read(table="FILTER", ipv=4))
+
+
+def setup_node(work):
+    return Backend(), work.node()
+
+
+def run_start(state):
+    backend, node = state
+    with backend.install():
+        node.start()
+    return len(node.rules)
+
+
+def run_status(state):
+    backend, node = state
+    with backend.install():
+        return len(node.status())
+
+
+def run_stop(state):
+    backend, node = state
+    with backend.install():
+        node.stop()
+    return len(node.rules)
+
+
+CASES = [('rule.combine', lambda work: work, run_combine),
+         ('rulearray.mul', lambda work: work, run_rulearray_mul),
+         ('topology.combine', lambda work: work, run_topology_combine),
+         ('rule.eq', setup_pairs, run_eq),
+         ('rule.contains', setup_copies, run_contains),
+         ('rule.str', setup_copies, run_str),
+         ('rule.from_iptc', setup_backend, run_from_iptc),
+         ('rulearray.read', setup_backend, run_read),
+         ('node.start', setup_node, run_start),
+         ('node.status', setup_backend, run_status),
+         ('node.stop', setup_backend, run_stop)]
+
+
+def measure(setup, run, work, repeat):
+    """ Returns (operations, [seconds per run]), with a fresh setup for
+    each run. """
+    times = list()
+    for i in range(repeat):
+        state = setup(work)
+        start = timeit.default_timer()
+        ops = run(state)
+        times.append(timeit.default_timer() - start)
+    return ops, times
+
+
+def commit():
+    """ Returns the current git commit, if any. """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench(interfaces, repeat, cases=None):
+    """ Returns the benchmark results, as a JSON-able dict. """
+    results = list()
+    for count in interfaces:
+        work = Workload(count)
+        for name, setup, run in CASES:
+            if cases and name not in cases:
+                continue
+            ops, times = measure(setup, run, work, repeat)
+            best = min(times)
+            results.append({'case': name,
+                            'interfaces': count,
+                            'rules': len(work.rules),
+                            'ops': ops,
+                            'best': best,
+                            'mean': sum(times) / len(times),
+                            'us_per_op': 1e6 * best / ops if ops else 0})
+            print('{:18} {:4d} ifaces {:7d} rules {:8d} ops {:9.4f} s '
+                  '{:10.2f} us/op'.format(
+                      name, count, len(work.rules), ops, best,
+                      results[-1]['us_per_op']), file=sys.stderr)
+
+    return {'commit': commit(),
+            'python': platform.python_version(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'repeat': repeat,
+            'results': results}
+
+
+def compare(old, new, threshold):
+    """ Prints the change in us/op of each result between two runs.
+    Returns the number of regressions, slower than 1 + threshold. """
+    before = {(r['case'], r['interfaces']): r for r in old['results']}
+    regressions = 0
+    print('{} -> {}'.format(old.get('commit'), new.get('commit')))
+    for result in new['results']:
+        key = (result['case'], result['interfaces'])
+        if key not in before or not before[key]['us_per_op']:
+            continue
+        ratio = result['us_per_op'] / before[key]['us_per_op']
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions += 1
+            flag = 'REGRESSION'
+        print('{:18} {:4d} ifaces {:10.2f} -> {:10.2f} us/op {:6.2f}x '
+              '{}'.format(key[0], key[1], before[key]['us_per_op'],
+                          result['us_per_op'], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-i', '--interfaces', type=int, nargs='+',
+                        default=[1, 4, 16])
+    parser.add_argument('-n', '--repeat', type=int, default=3)
+    parser.add_argument('-c', '--case', dest='cases', nargs='+',
+                        choices=[name for name, setup, run in CASES])
+    parser.add_argument('-o', '--output', default='-',
+                        help='JSON output file (default stdout)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two JSON outputs')
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                        help='relative slowdown reported as a regression')
+    args = parser.parse_args()
+
+    if args.compare:
+        runs = list()
+        for path in args.compare:
+            with open(path) as fp:
+                runs.append(json.load(fp))
+        sys.exit(1 if compare(*runs, args.threshold) else 0)
+
+    results = bench(args.interfaces, args.repeat, args.cases)
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import unittest
+import baleful.rule as R
+import baleful.analyze as A
+
+
+class Test_Analysis(unittest.TestCase):
+    """ Tests for shadowed, redundant and correlated rules. """
+
+    def testCovers(self):
+        """ Tests containment of prefixes and port ranges. """
+        wide = A.Region(R.Rule(params={'protocol': 'tcp',
+                                       'src': '10.0.0.0/8'},
+                               tcp={'dport': '1:1024'}))
+        narrow = A.Region(R.Rule(params={'protocol': 'tcp',
+                                         'src': '10.1.2.0/24'},
+                                 tcp={'dport': 22}))
+        other = A.Region(R.Rule(params={'protocol': 'tcp',
+                                        'src': '!10.0.0.0/8'},
+                                tcp={'dport': '!22'}))
+
+        self.assertTrue(wide.covers(narrow))
+        self.assertFalse(narrow.covers(wide))
+        self.assertTrue(wide.overlaps(narrow))
+        self.assertFalse(other.overlaps(narrow))
+        self.assertTrue(other.overlaps(
+            A.Region(R.Rule(params={'protocol': 'tcp'}))))
+
+    def testAnalysis(self):
+        """ Tests anomalies are found per chain. """
+        rules = R.RuleArray(
+            R.Rule(chain="INPUT", target="ACCEPT",
+                   params={'protocol': 'tcp', 'src': '10.0.0.0/8'},
+                   tcp={'dport': '1:1024'}),
+            R.Rule(chain="INPUT", target="DROP",
+                   params={'protocol': 'tcp', 'src': '10.1.2.0/24'},
+                   tcp={'dport': 22}),
+            R.Rule(chain="INPUT", target="ACCEPT",
+                   params={'protocol': '6', 'src': '10.1.0.0/16'},
+                   tcp={'dport': '80'}),
+            R.Rule(chain="INPUT", target="DROP",
+                   params={'protocol': 'tcp'},
+                   tcp={'dport': '1000:2000'}),
+            R.Rule(chain="INPUT", target="ACCEPT",
+                   params={'protocol': 'udp', 'src': '10.0.0.1'},
+                   udp={'dport': 53}),
+            R.Rule(chain="OUTPUT", target="DROP",
+                   params={'protocol': 'tcp', 'src': '10.1.2.0/24'},
+                   tcp={'dport': 22}),
+            R.Rule(chain="INPUT", target="ACCEPT",
+                   params={'in_interface': 'eth+'}),
+            R.Rule(chain="INPUT", target="DROP",
+                   params={'in_interface': 'eth0',
+                           'protocol': 'udp'}))
+
+        analysis = A.Analysis(rules)
+        self.assertEqual(analysis.shadowed, [(1, 0), (7, 6)])
+        self.assertEqual(analysis.redundant, [(2, 0)])
+        self.assertEqual(analysis.correlated, [(3, 0), (6, 1), (6, 3)])
+        self.assertIn('shadowed: 2 rules', str(analysis))
+
+    def testScale(self):
+        """ Tests distinct rules are not compared pairwise. """
+        rules = R.RuleArray(*[
+            R.Rule(chain="INPUT", target="ACCEPT",
+                   params={'protocol': 'tcp',
+                           'src': '10.{}.{}.0/24'.format(i // 256, i % 256)},
+                   tcp={'dport': 1 + i % 1000})
+            for i in range(5000)])
+        rules.append(R.Rule(chain="INPUT", target="DROP",
+                            params={'protocol': 'tcp',
+                                    'src': '10.0.1.0/24'},
+                            tcp={'dport': 2}))
+
+        analysis = A.Analysis(rules)
+        self.assertEqual(analysis.shadowed, [(5000, 1)])
+        self.assertEqual(analysis.correlated, [])
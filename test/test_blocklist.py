@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import unittest
+import io
+import baleful.blocklist as B
+
+
+class Test_Blocklist(unittest.TestCase):
+    """ Tests for blocklist ipsets. """
+
+    def setUp(self):
+        self.blocklist = B.Blocklist('drop4')
+
+    def testLoad(self):
+        """ Tests blocklists are parsed, collapsed and swapped in. """
+        fp = io.StringIO(
+            '# comment\n'
+            '10.0.0.0/25\n'
+            '10.0.0.128/25 ; adjacent\n'
+            '10.0.0.1\n'
+            '\n'
+            'not a network\n'
+            'fd00::/8\n'
+            '192.168.1.1/24 extra\n')
+
+        lines = self.blocklist.load(fp).splitlines()
+        self.assertEqual(self.blocklist.skipped, 2)
+        self.assertEqual(
+            lines,
+            ['create drop4-swap hash:net family inet maxelem 2097152 -exist',
+             'flush drop4-swap',
+             'add drop4-swap 10.0.0.0/24',
+             'add drop4-swap 192.168.1.0/24',
+             'create drop4 hash:net family inet maxelem 2097152 -exist',
+             'swap drop4-swap drop4',
+             'destroy drop4-swap'])
+
+    def testUpdate(self):
+        """ Tests updates are applied as deltas. """
+        self.blocklist.load(io.StringIO('10.0.0.0/24\n10.1.0.0/24\n'))
+        delta = self.blocklist.update(
+            io.StringIO('10.0.0.0/24\n10.0.1.0/24\n10.2.0.0/16\n'))
+
+        self.assertEqual(
+            delta.splitlines(),
+            ['add drop4 10.0.0.0/23 -exist',
+             'add drop4 10.2.0.0/16 -exist',
+             'del drop4 10.0.0.0/24 -exist',
+             'del drop4 10.1.0.0/24 -exist'])
+        self.assertEqual(self.blocklist.update(
+            io.StringIO('10.2.0.0/16\n10.0.0.0/23\n')), '')
+
+    def testRule(self):
+        """ Tests the early drop rule. """
+        self.assertEqual(
+            self.blocklist.rule().restore(),
+            '-A PREROUTING -m set --match-set drop4 src -j DROP')
+        self.assertEqual(self.blocklist.rule().key()[1], 'RAW')
+
+        with self.assertRaises(ValueError):
+            B.Blocklist('a-much-too-long-blocklist-name')
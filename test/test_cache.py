@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import unittest
+import ipaddress
+import os
+import tempfile
+import baleful.app as app
+from baleful.cache import Cache
+from baleful.fleet import Fleet, Host, Service
+from baleful.node import Node
+from baleful.rule import Rule, RuleArray
+from baleful.topo import Topology
+
+
+class Test_Cache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = Cache(self.tmp.name)
+        self.topo = Topology(
+            RuleArray(Rule(chain="OUTPUT", target="ACCEPT",
+                           params={'out_interface': 'eth0'})),
+            RuleArray(Rule(chain="INPUT", target="ACCEPT",
+                           params={'in_interface': 'eth0'})))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def testKey(self):
+        """ Tests keys are equal for equal inputs only. """
+        key = Cache.key(self.topo, app.ssh, {'eth0': ['10.0.0.2/24']})
+        self.assertEqual(
+            key,
+            Cache.key(self.topo.freeze(), app.ssh.freeze(),
+                      {'eth0': ['10.0.0.2/24']}))
+        self.assertEqual(
+            Cache.key(Rule(params={'protocol': 'tcp'}, tcp={'dport': 22})),
+            Cache.key(Rule(params={'protocol': 6}, tcp={'dport': '22'})))
+        self.assertNotEqual(
+            key, Cache.key(self.topo, app.ssh, {'eth0': ['10.0.0.3/24']}))
+        self.assertNotEqual(
+            key, Cache.key(self.topo, app.http, {'eth0': ['10.0.0.2/24']}))
+        self.assertEqual(Cache.key({'a': 1, 'b': 2}),
+                         Cache.key({'b': 2, 'a': 1}))
+
+        # Lazily cached attributes don't change the key
+        network = ipaddress.ip_network('10.0.0.0/8')
+        key = Cache.key(network)
+        network.broadcast_address
+        self.assertEqual(Cache.key(network), key)
+        self.assertEqual(Cache.key(ipaddress.ip_network('10.0.0.0/8')), key)
+        self.assertNotEqual(Cache.key(ipaddress.ip_network('10.0.0.0/16')),
+                            key)
+
+        with self.assertRaises(ValueError):
+            Cache.key(object())
+
+    def testCompile(self):
+        """ Tests a miss compiles and a hit loads the rules. """
+        calls = list()
+
+        def compile():
+            calls.append(1)
+            return {'rules': Node(rules=list(self.topo * app.ssh)).restore()}
+
+        entry = self.cache.compile([self.topo, app.ssh], compile)
+        self.assertEqual(entry, self.cache.compile([self.topo, app.ssh],
+                                                   compile))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(Cache.rules(entry), RuleArray(*(self.topo * app.ssh)))
+        self.assertEqual([p for p in os.listdir(self.tmp.name)
+                          if p.endswith('.tmp')], [])
+
+    def testEvict(self):
+        """ Tests the least recently used entries are evicted. """
+        cache = Cache(self.tmp.name, max_bytes=350)
+        text = 'x' * 100
+        for i, key in enumerate(['a', 'b', 'c']):
+            cache.put(key, {'text': text})
+            os.utime(cache.path(key), (i, i))
+        self.assertIsNotNone(cache.get('a'))
+        cache.put('d', {'text': text})
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertIsNotNone(cache.get('d'))
+
+    def testCorrupt(self):
+        """ Tests an unreadable entry is a miss. """
+        with open(self.cache.path('a'), 'w') as fp:
+            fp.write('{"rules": ')
+        self.assertIsNone(self.cache.get('a'))
+
+    def testFleet(self):
+        """ Tests fleet builds are cached per host. """
+        hosts = [Host('web{}'.format(i),
+                      interfaces={'eth0': ['10.0.{}.2/24'.format(i)]},
+                      services=[Service('ssh', 'server'), Service('dns')])
+                 for i in range(3)]
+        first = Fleet(hosts, cache=self.cache).compile(workers=1)
+        self.assertFalse(any(b.cached for b in first))
+
+        hosts[1].interfaces['eth0'] = ['10.0.9.2/24']
+        second = Fleet(hosts, cache=self.cache).compile(workers=1)
+        self.assertEqual([b.cached for b in second], [True, False, True])
+        self.assertEqual(first[0].artifacts, second[0].artifacts)
+        self.assertEqual(first[2].rules, second[2].rules)
+        self.assertIn('10.0.9.2', second[1].artifacts['rules'])
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import unittest
+import numpy
+from baleful.node import Node
+from baleful.rule import Rule
+from baleful.ipset import IpSet
+import baleful.classify as C
+
+
+class Test_Classifier(unittest.TestCase):
+    """ Tests for offline packet classification. """
+
+    tree = False
+
+    def setUp(self):
+        self.blocked = IpSet('blocked', ['192.0.2.0/24', '198.51.100.7'])
+        self.node = Node(
+            "ponos",
+            rules=[
+                Rule(chain="INPUT", target="ACCEPT",
+                     state={'state': 'ESTABLISHED,RELATED'}),
+                Rule(chain="INPUT", target="DROP",
+                     set={'match_set': ('blocked', 'src')}),
+                Rule(chain="INPUT", target="SERVICES",
+                     params={'in_interface': 'eth+'}),
+                Rule(chain="SERVICES", target="RETURN",
+                     params={'src': '10.0.0.0/8'}),
+                Rule(chain="SERVICES", target="ACCEPT",
+                     params={'protocol': 'tcp'},
+                     tcp={'dport': '!22'}),
+                Rule(chain="INPUT", target="ACCEPT",
+                     params={'protocol': 'icmp'},
+                     icmp={'icmp_type': 'echo-request'}),
+                Rule(chain="OUTPUT", target="ACCEPT", ipv=6,
+                     params={'protocol': 'udp', 'dst': 'fd00::/8'},
+                     udp={'dport': '53'})],
+            policy={4: {"INPUT": "DROP"}, 6: {"OUTPUT": "REJECT"}},
+            ipsets=[self.blocked])
+        self.classifier = C.Classifier(self.node, tree=self.tree)
+
+    def testClassify(self):
+        """ Tests verdicts follow jumps, returns and policies. """
+        packets = C.Packets(
+            4, 'INPUT',
+            src=['203.0.113.1', '192.0.2.9', '203.0.113.1',
+                 '10.1.1.1', '203.0.113.1', '203.0.113.1', '10.1.1.1'],
+            dst='203.0.113.254',
+            protocol=['tcp', 'tcp', 'tcp', 'tcp', 'tcp', 'icmp', 'icmp'],
+            dport=[22, 80, 80, 80, 22, 0, 0],
+            icmp_type=[-1, -1, -1, -1, -1, 8, 0],
+            state=['ESTABLISHED', 'NEW', 'NEW', 'NEW', 'NEW', 'NEW', 'NEW'],
+            in_interface='eth0')
+
+        verdicts, indices = self.classifier.classify(packets)
+        self.assertEqual(list(verdicts),
+                         ['ACCEPT', 'DROP', 'ACCEPT', 'DROP', 'DROP',
+                          'ACCEPT', 'DROP'])
+        self.assertEqual(list(indices), [0, 1, 4, -1, -1, 5, -1])
+
+    def testOne(self):
+        """ Tests single packets and ipv6 addresses. """
+        self.assertEqual(
+            self.classifier.classify_one(
+                6, 'OUTPUT', dst='fd00::53', protocol='udp', dport=53),
+            ('ACCEPT', 6))
+        self.assertEqual(
+            self.classifier.classify_one(
+                6, 'OUTPUT', dst='fe80::53', protocol='udp', dport=53),
+            ('REJECT', -1))
+
+    def testVectorized(self):
+        """ Tests integer address arrays are accepted. """
+        src = numpy.arange(0xC0000200, 0xC0000300, dtype=numpy.uint32)
+        packets = C.Packets(4, 'INPUT', src=src, protocol=6, dport=80,
+                            state='NEW', in_interface='lo')
+        verdicts, indices = self.classifier.classify(packets)
+        self.assertTrue((verdicts == 'DROP').all())
+        self.assertTrue((indices == 1).all())
+
+    def testUnsupported(self):
+        """ Tests matches which can not be evaluated are refused. """
+        with self.assertRaises(ValueError):
+            C.Classifier(Node("ponos", rules=[
+                Rule(chain="INPUT", target="ACCEPT",
+                     owner={'uid_owner': 0})]))
+
+
+class Test_TreeClassifier(Test_Classifier):
+    """ Tests classification with decision trees. """
+
+    tree = True
+
+
+class Test_DecisionTree(unittest.TestCase):
+    """ Tests for the decision tree matcher. """
+
+    def testFirstMatch(self):
+        """ Tests lookups agree with a linear scan. """
+        rng = numpy.random.RandomState(0)
+        rules = list()
+        for i in range(300):
+            params = {'protocol': ['tcp', 'udp'][i % 2]}
+            if i % 3:
+                params['src'] = '10.{}.0.0/16'.format(rng.randint(4))
+            if i % 7 == 0:
+                params['dst'] = '!10.0.0.0/8'
+            port = rng.randint(20)
+            rules.append(Rule(chain="INPUT", target=['ACCEPT', 'DROP'][i % 2],
+                              params=params,
+                              **{params['protocol']: {
+                                  'dport': port if i % 5 else
+                                  '!{}:{}'.format(port, port + 3)}}))
+        rules.append(Rule(chain="INPUT", target="ACCEPT",
+                          params={'in_interface': 'lo'}))
+
+        n = 2000
+        packets = C.Packets(
+            4, 'INPUT',
+            src=(10 << 24) + rng.randint(0, 1 << 18, n),
+            dst=numpy.where(rng.rand(n) < 0.5, 10 << 24, 11 << 24),
+            protocol=rng.choice([6, 17, 1], n),
+            dport=rng.randint(0, 25, n),
+            in_interface=rng.choice(['lo', 'eth0'], n))
+
+        tree = C.DecisionTree(rules)
+        matches = C.Matches()
+        expected = numpy.full(n, -1)
+        for position in reversed(range(len(rules))):
+            hit = matches.compile(rules[position])(packets, numpy.arange(n))
+            expected[hit] = position
+
+        self.assertEqual(list(tree.first(packets)), list(expected))
+        self.assertLess(len(tree), 2000)
+
+        # Lookups continue from a position
+        start = numpy.maximum(expected + 1, 0)
+        later = tree.first(packets, start=start)
+        self.assertTrue(((later > expected) | (later == -1)).all())
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import unittest
+import os
+import pickle
+import tempfile
+from baleful.fleet import Build, Fleet, Host, Service
+from baleful.rule import Rule, RuleArray
+from baleful.topo import Topology
+
+
+class Test_Fleet(unittest.TestCase):
+
+    LAN = Topology(RuleArray(Rule(target="ACCEPT",
+                                  params={'dst': '10.0.0.0/8'})))
+
+    def hosts(self, count):
+        return [Host('web{:02d}'.format(i),
+                     interfaces={'eth0': ['10.0.{}.2/24'.format(i),
+                                          '2001:db8::{:x}/64'.format(i + 1)],
+                                 'eth1': ['192.168.{}.2/24'.format(i)]},
+                     services=[Service('ssh', 'server', 'lan', 'eth0'),
+                               Service('dns'),
+                               Service('https', 'server')],
+                     final_rules=[Rule(chain="INPUT", target="DROP")])
+                for i in range(count)]
+
+    def testPickle(self):
+        """ Tests frozen rules survive pickling for the workers. """
+        rule = Rule(chain="INPUT", target="ACCEPT",
+                    params={'protocol': 'tcp', 'src': '10.0.0.0/8'},
+                    tcp={'dport': '22'}).freeze()
+        self.assertEqual(pickle.loads(pickle.dumps(rule)), rule)
+        self.assertEqual(pickle.loads(pickle.dumps(rule)).restore(),
+                         rule.restore())
+
+    def testRoles(self):
+        """ Tests clients and servers of a fleet topology. """
+        host = Host('ponos', interfaces={'eth0': ['10.0.0.2/24']},
+                    services=[Service('ssh', 'server', 'lan'),
+                              Service('ssh', 'client', 'lan')])
+        build, = Fleet([host], topologies={'lan': self.LAN}).compile()
+        self.assertEqual(
+            build.artifacts['rules'],
+            "*filter\n"
+            "-A INPUT -s 10.0.0.0/8 -d 10.0.0.2/32 -i eth0 "
+            "-p tcp -m tcp --dport 22 -j ACCEPT\n"
+            "-A OUTPUT -s 10.0.0.2/32 -d 10.0.0.0/8 -o eth0 "
+            "-p tcp -m tcp --sport 22 -j ACCEPT\n"
+            "-A OUTPUT -s 10.0.0.2/32 -d 10.0.0.0/8 -o eth0 "
+            "-p tcp -m tcp --dport 22 -j ACCEPT\n"
+            "-A INPUT -s 10.0.0.0/8 -d 10.0.0.2/32 -i eth0 "
+            "-p tcp -m tcp --sport 22 -j ACCEPT\n"
+            "COMMIT\n")
+        self.assertEqual(build.artifacts['rules6'], '')
+
+    def testDeterministic(self):
+        """ Tests parallel builds match serial builds. """
+        hosts = self.hosts(6)
+        hosts.append(Host('bad', services=[Service('nope')]))
+        fleet = Fleet(list(reversed(hosts)), topologies={'lan': self.LAN},
+                      formats=['restore', 'nft'])
+
+        seen = list()
+        serial = fleet.compile(workers=1)
+        parallel = fleet.compile(
+            workers=3, progress=lambda done, total, build: seen.append(
+                (done, total, build.hostname)))
+
+        self.assertEqual([b.hostname for b in serial],
+                         ['bad'] + ['web{:02d}'.format(i) for i in range(6)])
+        self.assertEqual([(b.hostname, b.artifacts, b.rules, b.error)
+                          for b in serial],
+                         [(b.hostname, b.artifacts, b.rules, b.error)
+                          for b in parallel])
+        self.assertEqual([(d, t) for d, t, h in seen],
+                         [(i, 7) for i in range(1, 8)])
+        self.assertEqual(sorted(h for d, t, h in seen),
+                         [b.hostname for b in serial])
+
+        self.assertEqual(serial[0].error, "Unknown app: nope")
+        self.assertIn('-A INPUT -d 2001:db8::1/128 -i eth0 -p tcp -m tcp '
+                      '--dport 443 -j ACCEPT', serial[1].artifacts['rules6'])
+        self.assertIn('ip6 daddr 2001:db8::1', serial[1].artifacts['nft'])
+        self.assertNotIn('--dport 22', serial[1].artifacts['rules6'])
+
+        with tempfile.TemporaryDirectory() as directory:
+            paths = Fleet.write(serial, directory)
+            self.assertEqual(len(paths), 18)
+            with open(os.path.join(directory, 'web03.rules')) as fp:
+                self.assertEqual(fp.read(), serial[4].artifacts['rules'])
+
+    def testErrors(self):
+        with self.assertRaises(ValueError):
+            Service('ssh', 'peer')
+        with self.assertRaises(ValueError):
+            Fleet([Host('a'), Host('a')])
+        with self.assertRaises(ValueError):
+            Fleet([Host('a')], formats=['pf'])
+        build, = Fleet([Host('a', services=[Service('ssh', interface='eth9')])
+                        ]).compile()
+        self.assertEqual(build.error, "Unknown interface: eth9")
+        self.assertIsInstance(build, Build)
+
+        # Other errors fail only their host
+        hosts = self.hosts(3)
+        hosts[1].interfaces['eth1'] = None
+        for workers in [1, 2]:
+            builds = Fleet(hosts, topologies={'lan': self.LAN}).compile(
+                workers=workers)
+            self.assertEqual([b.error for b in builds],
+                             [None, "TypeError: 'NoneType' object is not "
+                              "iterable", None])
+            self.assertIn('--dport 443', builds[2].artifacts['rules'])
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+import unittest
+import iptc
+from baleful.memory import Backend, Chain
+from baleful.node import Node
+from baleful.rule import Rule, RuleArray
+
+
+class Test_Backend(unittest.TestCase):
+    """ Tests node operations against the in-memory backend. """
+
+    def setUp(self):
+        self.backend = Backend()
+        self.node = Node(
+            "ponos",
+            rules=[Rule(chain="INPUT", target="ACCEPT",
+                        params={'protocol': 'tcp'},
+                        tcp={'dport': 22}, lock=True),
+                   Rule(chain="INPUT", target="ACCEPT",
+                        params={'src': '!10.0.0.0/8'},
+                        multiport={'dports': [80, 443]}),
+                   Rule(chain="LOGDROP", target="DROP"),
+                   Rule(chain="INPUT", ipv=6, target="ACCEPT",
+                        params={'src': '2001:db8::/32'})],
+            final_rules=[Rule(chain="INPUT", target="LOGDROP")])
+
+    def keys(self, **kwargs):
+        return [r.key() for r in RuleArray.read(**kwargs)]
+
+    def testInstall(self):
+        """ Tests the backend is restored after use. """
+        table = Rule.IPTABLES[4]['table']
+        with self.backend.install():
+            self.assertIs(Rule.IPTABLES[4]['table'],
+                          self.backend.iptables[4]['table'])
+            self.assertIs(Rule.IPTABLES[6]['rule'],
+                          self.backend.iptables[6]['rule'])
+        self.assertIs(Rule.IPTABLES[4]['table'], table)
+
+    def testStart(self):
+        """ Tests rules are read back as started, one commit per table. """
+        with self.backend.install():
+            self.node.start()
+            self.assertEqual(self.backend.commits, 2)
+            for (ipv, table, chain), rules in self.node.chains().items():
+                self.assertEqual(
+                    self.keys(table=table, chain=chain, ipv=ipv),
+                    [r.key() for r in rules])
+            self.assertEqual(self.node.diff(), [])
+
+    def testTargetParam(self):
+        """ Tests rules with target parameters read back as started. """
+        node = Node(rules=[
+            Rule(chain="INPUT", target="LOG",
+                 params={'protocol': 'tcp'}, tcp={'dport': 22},
+                 target_param={'log_prefix': 'ssh:', 'log_level': 4}),
+            Rule(chain="INPUT", target="REJECT",
+                 target_param={'reject_with': 'icmp-port-unreachable'})])
+        with self.backend.install():
+            node.start()
+            self.assertEqual(self.keys(table="FILTER", chain="INPUT",
+                                       ipv=4),
+                             [r.key() for r in node.rules])
+            self.assertEqual(node.diff(), [])
+            commits = self.backend.commits
+            self.assertEqual(node.sync(), [])
+            self.assertEqual(self.backend.commits, commits)
+
+    def testSync(self):
+        """ Tests sync applies only the changes. """
+        with self.backend.install():
+            self.node.start()
+            self.node.rules.pop(0)
+            self.node.rules.append(Rule(chain="INPUT", target="DROP",
+                                        params={'protocol': 'udp'}))
+            plan = self.node.sync()
+            self.assertEqual([(a, p) for a, p, r in plan],
+                             [('delete', 0), ('insert', 1)])
+            self.assertEqual(self.node.diff(), [])
+
+    def testMove(self):
+        """ Tests sync moves rules, and deletes repeated rules by position.
+        """
+        ports = [Rule(chain="INPUT", target="ACCEPT",
+                      params={'protocol': 'tcp'}, tcp={'dport': port})
+                 for port in range(4)]
+        with self.backend.install():
+            for order in [[0, 1, 2, 3], [0, 2, 1, 3],
+                          [0, 1, 0], [0, 0, 1], [1, 0, 0, 1], [1]]:
+                node = Node(rules=[ports[i] for i in order])
+                node.sync()
+                self.assertEqual(self.keys(table="FILTER", chain="INPUT",
+                                           ipv=4),
+                                 [ports[i].key() for i in order])
+                self.assertEqual(node.diff(), [])
+
+    def testReorder(self):
+        """ Tests reorder applies the new order to the live chain. """
+        rules = [Rule(chain="INPUT", target="ACCEPT",
+                      params={'protocol': 'tcp'}, tcp={'dport': 22}),
+                 Rule(chain="INPUT", target="ACCEPT",
+                      params={'protocol': 'udp'}, udp={'dport': 53})]
+        node = Node(rules=list(rules),
+                    final_rules=[Rule(chain="INPUT", target="DROP")])
+        with self.backend.install():
+            node.start()
+            self.backend.count(4, "FILTER", "INPUT", 1, packets=100)
+            plan = node.reorder(apply=True)
+
+            self.assertEqual(len(plan), 2)
+            self.assertEqual(node.rules, rules[::-1])
+            self.assertEqual(self.keys(table="FILTER", chain="INPUT",
+                                       ipv=4),
+                             [r.key() for r in node.rules + node.final_rules])
+            self.assertEqual(node.diff(), [])
+
+    def testFresh(self):
+        """ Tests diff and sync on a host without the node's chains. """
+        with self.backend.install():
+            plan = self.node.diff()
+            self.assertEqual([(a, p) for a, p, r in plan],
+                             [('insert', i) for i in range(3)] +
+                             [('insert', 0), ('insert', 0)])
+            self.assertEqual(self.node.sync(), plan)
+            self.assertEqual(self.node.diff(), [])
+            self.assertEqual(self.keys(table="FILTER", chain="LOGDROP",
+                                       ipv=4),
+                             [Rule(chain="LOGDROP", target="DROP").key()])
+
+    def testStatus(self):
+        """ Tests counters are kept across commits, and zeroed. """
+        with self.backend.install():
+            self.node.start()
+            self.backend.count(4, "FILTER", "INPUT", 0,
+                               packets=5, nbytes=300)
+            self.node.sync()
+            self.assertEqual(self.node.status(zero=True)[:2],
+                             [(True, (5, 300)), (True, (0, 0))])
+            self.assertEqual(self.node.status()[0], (True, (0, 0)))
+
+            self.node.stop()
+            self.assertEqual(self.node.status()[0], (False, (0, 0)))
+
+    def testReadOnly(self):
+        """ Tests reading tables commits nothing. """
+        with self.backend.install():
+            self.node.start()
+            commits = self.backend.commits
+            self.node.status()
+            RuleArray.read(table="FILTER", ipv=4)
+            self.assertEqual(self.node.diff(), [])
+            self.assertEqual(self.node.sync(), [])
+            self.assertEqual(self.backend.commits, commits)
+
+    def testConflict(self):
+        """ Tests a transaction is replayed after another commit. """
+        with self.backend.install():
+            with Rule.POOL.transaction() as pool:
+                pool.append(Rule(chain="OUTPUT", target="DROP"))
+
+                # Another writer commits first
+                chain = Chain(self.backend.iptables[4]['table']("filter"),
+                              "FORWARD")
+                rule = self.backend.iptables[4]['rule'](chain=chain)
+                rule.create_target("DROP")
+                chain.append_rule(rule)
+
+            self.assertEqual(len(self.keys(table="FILTER", ipv=4)), 2)
+
+    def testSyncConflict(self):
+        """ Tests sync recomputes its plan after another commit. """
+        with self.backend.install():
+            self.node.start()
+            self.node.rules[:2] = reversed(self.node.rules[:2])
+
+            # Another writer commits after the first diff
+            diff = self.node.diff
+            plans = list()
+
+            def conflict():
+                plans.append(diff())
+                if len(plans) == 1:
+                    chain = Chain(
+                        self.backend.iptables[4]['table']("filter"),
+                        "INPUT")
+                    rule = self.backend.iptables[4]['rule'](chain=chain)
+                    rule.create_target("DROP")
+                    chain.insert_rule(rule, 0)
+                return plans[-1]
+            self.node.diff = conflict
+
+            plan = self.node.sync()
+            self.assertEqual(len(plans), 2)
+            self.assertEqual(plan, plans[1])
+            self.assertIn(('delete', "DROP"),
+                          [(a, r.target) for a, p, r in plan])
+            self.assertEqual(
+                self.keys(table="FILTER", chain="INPUT", ipv=4),
+                [r.key() for r in self.node.chains()[(4, "FILTER", "INPUT")]])
+
+    def testLock(self):
+        """ Tests lock down keeps only lock and final rules. """
+        with self.backend.install():
+            self.node.start()
+            self.node.lock()
+
+            self.assertEqual(
+                self.keys(table="FILTER", ipv=4),
+                [self.node.rules[0].key(), self.node.final_rules[0].key()])
+            state = self.backend.state(4, "FILTER")
+            self.assertEqual(state['chains']['INPUT']['policy'], "DROP")
+
+            with self.assertRaises(iptc.ip4tc.IPTCError):
+                Rule.POOL.delete_chain(4, "FILTER", "INPUT")
+
+    def testLatency(self):
+        """ Tests commit latency is proportional to table size. """
+        backend = Backend(latency=1e-4, overhead=1e-3)
+        with backend.install():
+            self.node.start()
+        self.assertAlmostEqual(backend.elapsed, 2e-3 + 5e-4)
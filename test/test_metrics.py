@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+import unittest
+import os
+import tempfile
+from baleful.memory import Backend
+from baleful.node import Node
+from baleful.rule import Rule, RuleArray
+import baleful.metrics as M
+
+
+class Test_Exporter(unittest.TestCase):
+    """ Tests for the per-rule metrics exporter, against the in-memory
+    backend. """
+
+    def setUp(self):
+        self.backend = Backend()
+        install = self.backend.install()
+        install.__enter__()
+        self.addCleanup(install.__exit__, None, None, None)
+
+        self.ssh = RuleArray(Rule(chain="INPUT", target="ACCEPT",
+                                  params={'protocol': 'tcp'},
+                                  tcp={'dport': 22}))
+        self.node = Node("ponos",
+                         rules=list(self.ssh),
+                         final_rules=[Rule(chain="INPUT", target="DROP")])
+        # Only the ssh rule is live
+        Node("live", rules=list(self.ssh)).start()
+        self.count(0, 10, 1000)
+
+        self.snapshots = 0
+        snapshot = self.node.snapshot
+
+        def counted(zero=False):
+            self.snapshots += 1
+            return snapshot(zero=zero)
+        self.node.snapshot = counted
+        self.exporter = M.Exporter(self.node, apps={'ssh': self.ssh})
+
+    def count(self, position, packets, nbytes):
+        self.backend.count(4, "FILTER", "INPUT", position,
+                           packets=packets, nbytes=nbytes)
+
+    def testRender(self):
+        """ Tests counters are labelled per rule, from one snapshot. """
+        commits = self.backend.commits
+        text = self.exporter.render(now=100)
+        rid = M.Exporter.rule_id(self.ssh[0])
+
+        self.assertIn(
+            'baleful_rule_packets_total{{id="{}",ipv="4",table="filter",'
+            'chain="INPUT",target="ACCEPT",app="ssh"}} 10\n'.format(rid),
+            text)
+        self.assertIn('baleful_rule_exists{{id="{}",'.format(rid), text)
+        self.assertIn('target="DROP",app=""} 0\n', text)
+        self.assertIn('# TYPE baleful_rule_bytes_total counter\n', text)
+        self.assertNotIn('baleful_rule_packets_rate{', text)
+        self.assertEqual(self.snapshots, 1)
+        self.assertEqual(self.backend.commits, commits)
+
+    def testRate(self):
+        """ Tests rates are derived from the previous scrape. """
+        self.exporter.collect(now=100)
+        Node("drop", rules=[Rule(chain="INPUT", target="DROP")]).start()
+        self.count(0, 30, 600)
+        self.count(1, 5, 500)
+        metrics = self.exporter.collect(now=110)
+
+        self.assertEqual([v for l, v in metrics['packets_rate']],
+                         [3.0, 0.5])
+        self.assertEqual([v for l, v in metrics['bytes_rate']],
+                         [60.0, 50.0])
+        self.assertEqual([v for l, v in metrics['exists']], [1, 1])
+
+        # A reset counts from zero
+        self.node.status(zero=True)
+        self.count(0, 20, 100)
+        metrics = self.exporter.collect(now=120)
+        self.assertEqual([v for l, v in metrics['packets_rate']],
+                         [2.0, 0.0])
+        self.assertEqual(self.snapshots, 4)
+
+    def testRepeated(self):
+        """ Tests repeated rules are exported as separate series, and labels
+        are cached across scrapes. """
+        self.node.final_rules = [self.ssh[0].copy()]
+        self.node.start()
+        rid = M.Exporter.rule_id(self.ssh[0])
+
+        for now in [100, 110]:
+            metrics = self.exporter.collect(now=now)
+            labels = [l for l, v in metrics['packets_total']]
+            self.assertTrue(labels[0].startswith('id="{}",'.format(rid)))
+            self.assertTrue(labels[1].startswith('id="{}-2",'.format(rid)))
+            self.assertEqual([v for l, v in metrics['packets_total']],
+                             [10, 0])
+        self.assertEqual(len(self.exporter.labels), 1)
+        self.assertEqual(self.snapshots, 2)
+
+    def testWrite(self):
+        """ Tests the textfile is replaced, or left as it was on failure. """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'baleful.prom')
+            self.exporter.write(path)
+            with open(path) as fp:
+                text = fp.read()
+            self.assertIn('baleful_rule_packets_total{', text)
+
+            def fail(now=None):
+                raise(ValueError("render failed"))
+            self.exporter.render = fail
+            with self.assertRaises(ValueError):
+                self.exporter.write(path)
+            self.assertEqual(os.listdir(directory), ['baleful.prom'])
+            with open(path) as fp:
+                self.assertEqual(fp.read(), text)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import unittest
+import os
+import baleful.app as app
+from baleful.ipset import IpSet
+from baleful.nft import NftRule, Ruleset
+from baleful.node import Node
+from baleful.rule import Rule, RuleArray
+from baleful.topo import Topology
+
+GOLDEN = os.path.join(os.path.dirname(__file__), 'golden')
+
+
+class Test_Nft(unittest.TestCase):
+    """ Tests nftables rendering against golden files.
+    After an intended change, review the new output and replace the file,
+    e.g. with node.nft(). """
+
+    def golden(self, name, text):
+        with open(os.path.join(GOLDEN, name)) as fp:
+            self.assertEqual(text, fp.read())
+
+    def testRule(self):
+        """ Tests single rule translation. """
+        self.assertEqual(
+            Rule(chain="INPUT", target="ACCEPT",
+                 params={'protocol': 'tcp', 'src': '10.0.0.1'},
+                 tcp={'dport': '!22'}).nft(),
+            "ip saddr 10.0.0.1 tcp dport != 22 counter accept")
+        self.assertEqual(
+            Rule(ipv=6, target="DROP",
+                 params={'protocol': 'udp', 'dst': '2001:db8::/32'},
+                 udp={'sport': '1:1024'}).freeze().nft(),
+            "ip6 daddr 2001:db8::/32 udp sport 1-1024 counter drop")
+        self.assertEqual(
+            Rule(params={'protocol': 'tcp', 'in_interface': 'tun+'},
+                 multiport={'dports': [80, 443]},
+                 target="LOGDROP").nft(),
+            'iifname "tun*" tcp dport { 80, 443 } counter jump LOGDROP')
+
+        with self.assertRaises(ValueError):
+            NftRule(Rule(target="NFQUEUE").key())
+        with self.assertRaises(ValueError):
+            NftRule(Rule(recent={'name': 'ssh'}).key())
+
+    def testNode(self):
+        """ Tests inet merging, sets, verdict maps, tables and policies. """
+        trusted = IpSet('trusted4', ['10.0.0.0/8', '192.168.0.0/24'])
+        node = Node(
+            "ponos",
+            rules=[Rule(chain="INPUT", target="ACCEPT",
+                        params={'protocol': 'tcp'}, tcp={'dport': 22}),
+                   Rule(chain="INPUT", target="ACCEPT", ipv=6,
+                        params={'protocol': 'tcp'}, tcp={'dport': 22}),
+                   Rule(chain="INPUT", target="ACCEPT",
+                        params={'protocol': 'tcp',
+                                'src': '192.168.1.0/24'},
+                        multiport={'dports': [80, 443]}),
+                   Rule(chain="INPUT", target="ACCEPT",
+                        params={'protocol': 'tcp',
+                                'src': '192.168.2.0/24'},
+                        multiport={'dports': [80, 443]}),
+                   Rule(chain="INPUT", target="ACCEPT",
+                        state={'state': 'ESTABLISHED,RELATED'}),
+                   Rule(chain="INPUT", target="ACCEPT", ipv=6,
+                        state={'state': 'ESTABLISHED,RELATED'}),
+                   Rule(chain="INPUT", target="ACCEPT", ipv=6,
+                        params={'protocol': 'ipv6-icmp'}),
+                   Rule(chain="INPUT", target="ACCEPT",
+                        **trusted.match('src')),
+                   Rule(chain="INPUT", target="TCP-IN",
+                        params={'protocol': 'tcp'},
+                        tcp={'dport': '1000:2000'}),
+                   Rule(chain="INPUT", target="DROP",
+                        params={'protocol': 'tcp'}, tcp={'dport': 3000}),
+                   Rule(chain="INPUT", target="TCP-IN",
+                        params={'protocol': 'tcp'}, tcp={'dport': 4000}),
+                   Rule(chain="TCP-IN", target="LOGDROP",
+                        params={'src': '!10.0.0.0/8'}),
+                   Rule(chain="LOGDROP", target="LOG",
+                        target_param={'log_prefix': 'drop'},
+                        comment={'comment': 'logged drops'}),
+                   Rule(chain="LOGDROP", target="DROP"),
+                   Rule(chain="PREROUTING", table="RAW", target="NOTRACK",
+                        params={'protocol': 'udp'}, udp={'dport': 53}),
+                   Rule(chain="POSTROUTING", table="NAT",
+                        target="MASQUERADE",
+                        params={'out_interface': 'wan0'}),
+                   Rule(chain="PREROUTING", table="NAT", target="DNAT",
+                        params={'protocol': 'tcp'}, tcp={'dport': 8080},
+                        target_param={'to_destination': '10.0.0.2:80'})],
+            final_rules=[Rule(chain="INPUT", target="REJECT",
+                              params={'protocol': 'tcp'},
+                              target_param={'reject_with': 'tcp-reset'}),
+                         Rule(chain="INPUT", target="REJECT"),
+                         Rule(chain="INPUT", target="REJECT", ipv=6)],
+            policy={4: {"INPUT": "DROP", "OUTPUT": "ACCEPT",
+                        "FORWARD": "DROP"},
+                    6: {"INPUT": "DROP", "OUTPUT": "ACCEPT",
+                        "FORWARD": "ACCEPT"}},
+            ipsets=[trusted])
+
+        self.golden('node.nft', node.nft())
+
+    def testApps(self):
+        """ Tests a client topology of applications, without merging. """
+        client = Topology(
+            RuleArray(Rule(chain="OUTPUT", target="ACCEPT",
+                           params={'out_interface': 'eth0'})),
+            RuleArray(Rule(chain="INPUT", target="ACCEPT",
+                           params={'in_interface': 'eth0'})))
+        rules = list()
+        for ipv in [4, 6]:
+            for service in [app.ssh, app.dns, app.http, app.https]:
+                rules += [Rule(ipv=ipv) * rule for rule in client * service]
+        node = Node("client", rules=rules)
+
+        self.golden('apps.nft', node.nft(name='client'))
+        self.golden('apps-unmerged.nft',
+                    Ruleset(node, name='client', merge=False).script())
+
+    def testNonTerminal(self):
+        """ Tests overlapping rules are only merged for terminal verdicts,
+        a packet would hit each of them otherwise. """
+        def rule(target, src, **kwargs):
+            return Rule(chain="INPUT", target=target, params={'src': src},
+                        **kwargs)
+        log = {'target_param': {'log_prefix': 'in'}}
+        node = Node("ponos",
+                    rules=[rule("LOG", '10.0.0.0/8', **log),
+                           rule("LOG", '10.1.0.0/16', **log),
+                           rule("CNT", '10.0.0.0/8'),
+                           rule("CNT", '10.1.0.0/16'),
+                           rule("CNT", '192.168.0.0/24'),
+                           rule("CNT", '192.168.1.0/24'),
+                           rule("ACCEPT", '10.0.0.0/8'),
+                           rule("ACCEPT", '10.1.0.0/16'),
+                           Rule(chain="CNT", target="RETURN")])
+
+        self.golden('nonterminal.nft', node.nft())
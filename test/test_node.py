@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
 
 import unittest
+import unittest.mock
+import io
+import subprocess
+from baleful.ipset import IpSet
+from baleful.memory import Backend
 from baleful.node import Node
+from baleful.rule import Rule
 
 
 class Test_Node(unittest.TestCase):
@@ -17,3 +23,146 @@ class Test_Node(unittest.TestCase):
         """ Tests set policy method. """
         n = Node("ponos")
         n.set_policy()
+
+    def test_restore(self):
+        """ Tests rendering of iptables-restore input. """
+        n = Node("ponos",
+                 rules=[Rule(chain="INPUT", target="ACCEPT",
+                             params={'protocol': 'tcp'},
+                             tcp={'dport': 22}),
+                        Rule(chain="PREROUTING", table="RAW",
+                             target="NOTRACK"),
+                        Rule(chain="LOGDROP", target="DROP"),
+                        Rule(chain="INPUT", ipv=6, target="ACCEPT")],
+                 final_rules=[Rule(chain="INPUT", target="LOGDROP")])
+
+        self.assertEqual(n.restore(ipv=4),
+                         "*filter\n"
+                         ":LOGDROP - [0:0]\n"
+                         "-A INPUT -p tcp -m tcp --dport 22 -j ACCEPT\n"
+                         "-A LOGDROP -j DROP\n"
+                         "-A INPUT -j LOGDROP\n"
+                         "COMMIT\n"
+                         "*raw\n"
+                         "-A PREROUTING -j NOTRACK\n"
+                         "COMMIT\n")
+
+        self.assertEqual(n.restore(ipv=6, position=0),
+                         "*filter\n"
+                         "-I INPUT 1 -j ACCEPT\n"
+                         "COMMIT\n")
+
+    def test_edit(self):
+        """ Tests the edit script used by sync. """
+        source = list("abcdefg")
+        target = list("abxdefgh")
+
+        edit = Node.edit(source, target)
+        self.assertEqual(edit, [('insert', 2, 2),
+                                ('delete', 3, 2),
+                                ('insert', 7, 7)])
+
+        # Apply the edit script
+        result = source.copy()
+        for action, position, index in edit:
+            if action == 'delete':
+                self.assertEqual(result.pop(position), source[index])
+            else:
+                result.insert(position, target[index])
+        self.assertEqual(result, target)
+
+        self.assertEqual(Node.edit(source, source), [])
+
+        # A large chain, with changes at both ends
+        source = list(range(20000))
+        target = [-1] + source[:-1]
+        self.assertEqual(Node.edit(source, target),
+                         [('insert', 0, 0), ('delete', 20000, 19999)])
+        self.assertEqual(len(Node.edit([], target)), len(target))
+        self.assertEqual(len(Node.edit(source, [])), len(source))
+
+    def test_prune_ipset(self):
+        """ Tests only ipsets the node replaced are destroyed after start.
+        """
+        old = IpSet.named(['10.0.0.1'])
+        busy = IpSet.named(['10.0.0.3'])
+        current = IpSet.named(['10.0.0.1', '10.0.0.2'])
+        other = IpSet.named(['10.0.0.4'])
+        in_use = {busy.name}
+        calls = list()
+
+        def run(args, **kwargs):
+            calls.append(args)
+            if args[:2] == ['ipset', 'destroy'] and args[2] in in_use:
+                return subprocess.CompletedProcess(args, 1)
+            return subprocess.CompletedProcess(args, 0)
+
+        def node(ipsets):
+            return Node("ponos",
+                        rules=[Rule(chain="INPUT", target="ACCEPT",
+                                    **ipset.match('src'))
+                               for ipset in ipsets],
+                        ipsets=ipsets)
+
+        with unittest.mock.patch('subprocess.run', run):
+            with Backend().install():
+                # Nodes without ipsets don't run ipset
+                Node("plain", rules=[Rule(chain="INPUT")]).start()
+                self.assertEqual(calls, [])
+
+                n = node([old, busy])
+                n.start()
+                node([other]).start()
+                n.ipsets = [current]
+                n.start()
+                self.assertEqual(
+                    sorted(args[2] for args in calls
+                           if args[:2] == ['ipset', 'destroy']),
+                    sorted([old.name, busy.name]))
+                self.assertEqual(n.loaded_ipsets, {current.name, busy.name})
+
+                # A set still in use is pruned later
+                in_use.clear()
+                self.assertEqual(n.prune_ipset(), [busy.name])
+                self.assertEqual(n.loaded_ipsets, {current.name})
+
+    def test_dump(self):
+        """ Tests streaming the node's rules. """
+        n = Node("ponos",
+                 rules=[Rule(chain="INPUT", target="ACCEPT")],
+                 final_rules=[Rule(chain="INPUT", target="DROP")])
+        out = io.StringIO()
+        n.dump(out)
+        self.assertEqual(out.getvalue(), str(n))
+        self.assertEqual(str(n),
+                         "iptables -A INPUT --protocol ip -j ACCEPT\n"
+                         "iptables -A INPUT --protocol ip -j DROP\n")
+
+    def test_status(self):
+        """ Tests status is answered from one read-only snapshot, by rule
+        key. """
+        accept = Rule(chain="INPUT", target="ACCEPT",
+                      params={'protocol': 'tcp'}, tcp={'dport': 22})
+        n = Node("ponos",
+                 rules=[accept, accept.copy()],
+                 final_rules=[Rule(chain="INPUT", target="DROP")])
+
+        live = Rule(chain="INPUT", target="ACCEPT",
+                    params={'protocol': '6'}, tcp={'dport': '22'})
+        backend = Backend()
+        with backend.install():
+            Node("live", rules=[live]).start()
+            backend.count(4, "FILTER", "INPUT", 0, packets=10, nbytes=1000)
+            commits = backend.commits
+
+            for i in range(2):
+                self.assertEqual(n.status(),
+                                 [(True, (10, 1000)),
+                                  (False, (0, 0)),
+                                  (False, (0, 0))])
+            self.assertEqual(backend.commits, commits)
+
+            # Zeroing the counters is the only write
+            self.assertEqual(n.status(zero=True)[0], (True, (10, 1000)))
+            self.assertEqual(backend.commits, commits + 1)
+            self.assertEqual(n.status()[0], (True, (0, 0)))
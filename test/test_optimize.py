@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+import unittest
+import baleful.rule as R
+import baleful.topo as T
+import baleful.app as A
+import baleful.optimize as O
+from baleful.memory import Backend
+from baleful.node import Node
+
+
+class Test_Multiport(unittest.TestCase):
+    """ Tests for the multiport optimization pass. """
+
+    def setUp(self):
+        self.topo = T.Topology(
+            R.RuleArray(R.Rule(chain="OUTPUT", target="ACCEPT")),
+            R.RuleArray(R.Rule(chain="INPUT", target="ACCEPT")))
+
+    def testMerge(self):
+        """ Tests rules are merged per chain and protocol. """
+        opt = O.Multiport(self.topo * A.nfs)
+
+        self.assertEqual((opt.before, opt.after), (16, 4))
+        self.assertEqual(str(opt), 'multiport: 16 -> 4 rules')
+        self.assertEqual(
+            opt.rules[0].restore(),
+            '-A OUTPUT -p tcp -m multiport '
+            '--dports 111,2049,51378:51379,55461 -j ACCEPT')
+        self.assertEqual(
+            opt.rules[3].restore(),
+            '-A INPUT -p udp -m multiport '
+            '--sports 111,2049,51378:51379,55461 -j ACCEPT')
+
+        frozen = O.Multiport((self.topo * A.nfs).freeze())
+        self.assertEqual(list(frozen.rules), list(opt.rules))
+        self.assertIsInstance(frozen.rules[0], R.FrozenRule)
+
+    def testPortLimit(self):
+        """ Tests merged rules respect the 15 port limit. """
+        rules = R.RuleArray(*[
+            R.Rule(chain="INPUT", target="ACCEPT",
+                   params={'protocol': 'tcp'},
+                   tcp={'dport': port})
+            for port in range(1000, 1020)])
+        rules.append(R.Rule(chain="INPUT", target="ACCEPT",
+                            params={'protocol': 'tcp'},
+                            tcp={'dport': '2000:2010'}))
+
+        opt = O.Multiport(rules)
+        self.assertEqual(opt.after, 2)
+        self.assertEqual(
+            opt.rules[0].kwargs['multiport']['dports'],
+            ','.join(str(p) for p in range(1000, 1015)))
+        self.assertEqual(
+            opt.rules[1].kwargs['multiport']['dports'],
+            '1015,1016,1017,1018,1019,2000:2010')
+
+    def testOrder(self):
+        """ Tests rules are not moved past rules they do not commute with. """
+        rules = R.RuleArray(
+            R.Rule(chain="INPUT", target="ACCEPT",
+                   params={'protocol': 'tcp'}, tcp={'dport': 22}),
+            R.Rule(chain="INPUT", target="ACCEPT",
+                   params={'protocol': 'udp'}, udp={'dport': 53}),
+            R.Rule(chain="INPUT", target="DROP",
+                   params={'protocol': 'tcp', 'src': '10.0.0.0/8'}),
+            R.Rule(chain="INPUT", target="ACCEPT",
+                   params={'protocol': 'tcp'}, tcp={'dport': 80}),
+            R.Rule(chain="INPUT", target="ACCEPT",
+                   params={'protocol': 'udp'}, udp={'dport': 123}))
+
+        opt = O.Multiport(rules)
+
+        # udp rules commute with the tcp DROP, tcp rules do not
+        self.assertEqual(opt.after, 4)
+        self.assertEqual(opt.rules[0], rules[0])
+        self.assertEqual(opt.rules[1].kwargs['multiport']['dports'],
+                         '53,123')
+        self.assertEqual(opt.rules[2], rules[2])
+        self.assertEqual(opt.rules[3], rules[3])
+
+
+class Test_IpSets(unittest.TestCase):
+    """ Tests for the ipset optimization pass. """
+
+    def testMerge(self):
+        """ Tests rules differing only in an address share one ipset. """
+        rules = R.RuleArray(*[
+            R.Rule(chain="INPUT", target="ACCEPT",
+                   params={'protocol': 'tcp', 'src': src},
+                   tcp={'dport': 22})
+            for src in ['10.0.0.1', '10.0.0.2', '192.168.0.0/24']])
+        rules.append(R.Rule(chain="INPUT", target="ACCEPT",
+                            params={'protocol': 'tcp',
+                                    'src': '!10.0.0.3'},
+                            tcp={'dport': 22}))
+
+        opt = O.IpSets(rules)
+        self.assertEqual((opt.before, opt.after), (4, 2))
+        self.assertEqual(len(opt.sets), 1)
+
+        ipset = list(opt.sets.values())[0]
+        self.assertEqual(ipset.settype, 'hash:net')
+        self.assertEqual(
+            opt.rules[0].restore(),
+            '-A INPUT -p tcp -m tcp --dport 22 '
+            '-m set --match-set {} src -j ACCEPT'.format(ipset.name))
+        self.assertEqual(opt.rules[1], rules[3])
+        self.assertEqual(
+            opt.restore().splitlines(),
+            ['create {} hash:net family inet -exist'.format(ipset.name),
+             'add {} 10.0.0.1/32 -exist'.format(ipset.name),
+             'add {} 10.0.0.2/32 -exist'.format(ipset.name),
+             'add {} 192.168.0.0/24 -exist'.format(ipset.name)])
+
+        # Set names depend only on content
+        again = O.IpSets(R.RuleArray(*reversed(rules[:3])))
+        self.assertEqual(list(again.sets), list(opt.sets))
+
+    def testDestination(self):
+        """ Tests ipv6 hosts are merged by destination. """
+        rules = R.RuleArray(*[
+            R.Rule(chain="OUTPUT", target="ACCEPT", ipv=6,
+                   params={'dst': dst})
+            for dst in ['fd00::1', 'fd00::2']])
+
+        opt = O.IpSets(rules, prefix='test')
+        ipset = list(opt.sets.values())[0]
+        self.assertTrue(ipset.name.startswith('test6-'))
+        self.assertEqual(ipset.settype, 'hash:ip')
+        self.assertEqual(opt.rules[0].kwargs['set']['match_set'],
+                         (ipset.name, 'dst'))
+        self.assertIn('add {} fd00::1 -exist'.format(ipset.name),
+                      opt.restore())
+
+
+class Test_ChainTree(unittest.TestCase):
+    """ Tests for the chain tree pass. """
+
+    def setUp(self):
+        self.rules = R.RuleArray()
+        for iface in ['eth0', 'eth1']:
+            for proto in ['tcp', 'udp']:
+                for port in range(100, 104):
+                    self.rules.append(R.Rule(
+                        chain="INPUT", target="ACCEPT",
+                        params={'in_interface': iface,
+                                'protocol': proto},
+                        **{proto: {'dport': port}}))
+
+    def testSplit(self):
+        """ Tests rules branch on interface and protocol. """
+        opt = O.ChainTree(self.rules)
+        chains = set(r.key()[2] for r in opt.rules)
+
+        self.assertEqual(chains, {'INPUT', 'BALEFUL-IN-eth0',
+                                  'BALEFUL-IN-eth1',
+                                  'BALEFUL-IN-eth0-tcp',
+                                  'BALEFUL-IN-eth0-udp',
+                                  'BALEFUL-IN-eth1-tcp',
+                                  'BALEFUL-IN-eth1-udp'})
+        self.assertEqual(
+            opt.rules[-1].restore(),
+            '-A INPUT -i eth1 -j BALEFUL-IN-eth1')
+        self.assertEqual(opt.after, 16 + 6)
+        self.assertEqual(opt.depth[(4, 'FILTER', 'INPUT')], (8.5, 5.5))
+
+    def testOrder(self):
+        """ Tests rules do not move past rules matching the same packets. """
+        self.rules.insert(4, R.Rule(chain="INPUT", target="DROP",
+                                    params={'protocol': 'tcp'}))
+        opt = O.ChainTree(self.rules)
+
+        # The tcp DROP is a barrier for every interface
+        inputs = [r for r in opt.rules if r.key()[2] == 'INPUT']
+        self.assertEqual([r.target for r in inputs],
+                         ['BALEFUL-IN-eth0', 'DROP',
+                          'BALEFUL-IN-eth0-2', 'BALEFUL-IN-eth1'])
+
+        # Subchains hold the rules in order
+        eth0 = [r for r in opt.rules if r.key()[2] == 'BALEFUL-IN-eth0']
+        self.assertEqual([r.kwargs['tcp']['dport'] for r in eth0],
+                         [100, 101, 102, 103])
+
+    def testLock(self):
+        """ Tests lock rules stay reachable through their jumps. """
+        self.rules[1].lock = True
+        opt = O.ChainTree(self.rules)
+        jumps = dict((r.target, r.lock) for r in opt.rules
+                     if r.target.startswith('BALEFUL-'))
+        self.assertEqual(jumps, {'BALEFUL-IN-eth0': True,
+                                 'BALEFUL-IN-eth0-tcp': True,
+                                 'BALEFUL-IN-eth0-udp': False,
+                                 'BALEFUL-IN-eth1': False,
+                                 'BALEFUL-IN-eth1-tcp': False,
+                                 'BALEFUL-IN-eth1-udp': False})
+
+        backend = Backend()
+        with backend.install():
+            Node(rules=list(opt.rules)).lock()
+            self.assertEqual(
+                [r.target.name for r in backend.rules(4, "FILTER", "INPUT")],
+                ['BALEFUL-IN-eth0'])
+            self.assertEqual(
+                [r.target.name for r in backend.rules(
+                    4, "FILTER", "BALEFUL-IN-eth0")],
+                ['BALEFUL-IN-eth0-tcp'])
+            self.assertEqual(
+                len(backend.rules(4, "FILTER", "BALEFUL-IN-eth0-tcp")), 1)
+
+
+class Test_Reorder(unittest.TestCase):
+    """ Tests for the counter driven reorder pass. """
+
+    def testReorder(self):
+        """ Tests hot rules only move past rules they commute with. """
+        rules = R.RuleArray(
+            R.Rule(chain="INPUT", target="ACCEPT",
+                   params={'protocol': 'tcp'}, tcp={'dport': 22}),
+            R.Rule(chain="INPUT", target="DROP",
+                   params={'protocol': 'tcp', 'src': '10.0.0.0/8'}),
+            R.Rule(chain="INPUT", target="ACCEPT",
+                   params={'protocol': 'udp'}, udp={'dport': 53}),
+            R.Rule(chain="INPUT", target="ACCEPT",
+                   params={'protocol': 'tcp'}, tcp={'dport': 80}),
+            R.Rule(chain="INPUT", target="ACCEPT",
+                   params={'protocol': 'tcp', 'in_interface': 'eth1'},
+                   tcp={'dport': 443}))
+
+        opt = O.Reorder(rules, [1, 5, 100, 1000, 10])
+
+        # udp passes the tcp DROP, tcp 80 does not
+        self.assertEqual(opt.order, [2, 0, 1, 3, 4])
+        self.assertEqual(list(opt.rules), [rules[i] for i in opt.order])
+
+        # interfaces are disjoint
+        self.assertTrue(O.Pass.commutes(
+            rules[4], R.Rule(chain="INPUT", target="DROP",
+                             params={'in_interface': 'eth0'})))
+        self.assertFalse(O.Pass.commutes(
+            rules[4], R.Rule(chain="INPUT", target="DROP",
+                             params={'in_interface': 'eth+'})))
+
+        with self.assertRaises(ValueError):
+            O.Reorder(rules, [1])
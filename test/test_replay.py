@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import unittest
+import ipaddress
+import os
+import struct
+import tempfile
+from baleful.node import Node
+from baleful.rule import Rule
+import baleful.replay as P
+
+
+def ethernet(src, dst, proto, sport=0, dport=0, flags=0x02):
+    """ Returns an ethernet frame with an ipv4 or ipv6 header. """
+    src = ipaddress.ip_address(src)
+    dst = ipaddress.ip_address(dst)
+    if proto in [6, 17]:
+        l4 = struct.pack('!HH', sport, dport) + bytes(8) + bytes([0, flags])
+    else:
+        l4 = bytes([8, 0, 0, 0])
+
+    if src.version == 4:
+        ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(l4), 0, 0, 64,
+                         proto, 0, src.packed, dst.packed)
+        ethertype = 0x0800
+    else:
+        ip = struct.pack('!IHBB16s16s', 6 << 28, len(l4), proto, 64,
+                         src.packed, dst.packed)
+        ethertype = 0x86DD
+    return bytes(12) + struct.pack('!H', ethertype) + ip + l4
+
+
+class Test_Replay(unittest.TestCase):
+    """ Tests for replaying captures against nodes. """
+
+    def setUp(self):
+        ssh = Rule(chain="INPUT", target="ACCEPT",
+                   params={'protocol': 'tcp'}, tcp={'dport': 22})
+        web = Rule(chain="INPUT", target="ACCEPT",
+                   params={'protocol': 'tcp'}, tcp={'dport': 80})
+        established = Rule(chain="INPUT", target="ACCEPT",
+                           state={'state': 'ESTABLISHED'})
+        policy = {4: {"INPUT": "DROP"}, 6: {"INPUT": "DROP"}}
+        self.old = Node("old", rules=[ssh, web], policy=policy)
+        self.new = Node("new", rules=[established, ssh, ssh.copy()],
+                        policy=policy)
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def pcap(self, frames):
+        path = os.path.join(self.dir.name, 'test.pcap')
+        with open(path, 'wb') as fp:
+            fp.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0,
+                                 65535, 1))
+            for frame in frames:
+                fp.write(struct.pack('<IIII', 0, 0, len(frame), len(frame)))
+                fp.write(frame)
+        return path
+
+    def testPcap(self):
+        """ Tests pcap packets are parsed, and verdict changes counted. """
+        path = self.pcap([
+            ethernet('10.0.0.1', '10.0.0.2', 6, 40000, 22),
+            ethernet('10.0.0.1', '10.0.0.2', 6, 40000, 80),
+            ethernet('10.0.0.1', '10.0.0.2', 6, 40000, 80, flags=0x10),
+            ethernet('fd00::1', 'fd00::2', 6, 40000, 22),
+            ethernet('10.0.0.1', '10.0.0.2', 1),
+            bytes(14)])
+
+        reader = P.PcapReader(path, batch=4)
+        replay = P.Replay(self.old, self.new).run(reader)
+
+        self.assertEqual(reader.skipped, 1)
+        self.assertEqual(replay.packets, 5)
+        self.assertEqual(list(replay.hits[0]), [1, 2])
+        self.assertEqual(list(replay.hits[1]), [1, 1, 0])
+        self.assertEqual(replay.changes, {('ACCEPT', 'DROP'): 1})
+        self.assertEqual(
+            replay.samples[0][0],
+            'INPUT * 10.0.0.1:40000 -> 10.0.0.2:80 proto 6')
+        self.assertEqual(replay.unmatched(), [self.new.rules[2]])
+
+        report = replay.report()
+        self.assertIn('changed: 1 packets\n', report)
+        self.assertIn('never matched: 1 rules\n', report)
+
+    def testFlows(self):
+        """ Tests flow logs are weighted by their packet counts. """
+        path = os.path.join(self.dir.name, 'flows.csv')
+        with open(path, 'w') as fp:
+            fp.write('srcaddr,dstaddr,proto,srcport,dstport,packets\n'
+                     '10.0.0.1,10.0.0.2,tcp,40000,22,10\n'
+                     '10.0.0.1,10.0.0.2,6,40000,80,5\n'
+                     'fd00::1,fd00::2,udp,53,53,1\n')
+
+        replay = P.Replay(self.old, self.new).run(P.FlowReader(path))
+        self.assertEqual(replay.packets, 16)
+        self.assertEqual(replay.verdicts[0], {'ACCEPT': 15, 'DROP': 1})
+        self.assertEqual(replay.changes, {('ACCEPT', 'DROP'): 5})
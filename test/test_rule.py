@@ -4,6 +4,7 @@ import unittest
 import baleful.rule as R
 import iptc
 import ipaddress
+import io
 
 
 class Test_Rule(unittest.TestCase):
@@ -112,6 +113,81 @@ class Test_Rule(unittest.TestCase):
         self.assertEqual(
             rule_flipped.kwargs['icmp']['icmp_type'], 'echo-reply')
 
+    def testRestore(self):
+        """ Test rendering to iptables-restore format. """
+        rule = R.Rule(ipv=4, chain="INPUT",
+                      target="REJECT",
+                      params={'protocol': 'tcp',
+                              'src': '10.0.0.0/8',
+                              'in_interface': '!eth0'},
+                      tcp={'dport': 22},
+                      comment={'comment': 'ssh in'},
+                      target_param={'reject_with': 'tcp-reset'})
+
+        self.assertEqual(
+            rule.restore(),
+            '-A INPUT -s 10.0.0.0/8 ! -i eth0 -p tcp -m tcp --dport 22 '
+            '-m comment --comment "ssh in" -j REJECT --reject-with tcp-reset')
+
+        self.assertEqual(R.Rule(target="ACCEPT").restore(position=3),
+                         '-I OUTPUT 3 -j ACCEPT')
+
+    def testFromSave(self):
+        """ Test rule conversion from iptables-save lines. """
+        rule = R.Rule.from_save(
+            '[3:180] -A INPUT -s 10.0.0.0/8 ! -i eth0 -p tcp '
+            '-m tcp ! --dport 80 -m comment --comment "no http" '
+            '-j REJECT --reject-with tcp-reset', table="filter")
+
+        self.assertEqual(rule.chain, "INPUT")
+        self.assertEqual(rule.table, "FILTER")
+        self.assertEqual(rule.target, "REJECT")
+        self.assertEqual(rule.params['src'],
+                         ipaddress.ip_network('10.0.0.0/8'))
+        self.assertEqual(rule.params['in_interface'], '!eth0')
+        self.assertEqual(rule.params['protocol'], 'tcp')
+        self.assertEqual(rule.kwargs['tcp']['dport'], '!80')
+        self.assertEqual(rule.kwargs['comment']['comment'], 'no http')
+        self.assertEqual(rule.kwargs['target_param']['reject-with'],
+                         'tcp-reset')
+
+        self.assertEqual(
+            R.Rule.from_save('-A OUTPUT ! -d 127.0.0.0/8 -f -j DROP',
+                             table="filter").restore(),
+            '-A OUTPUT ! -d 127.0.0.0/8 -f -j DROP')
+
+        with self.assertRaises(ValueError):
+            R.Rule.from_save(':INPUT ACCEPT [0:0]')
+
+    def testStr(self):
+        """ Test cached string rendering. """
+        rule = R.Rule(ipv=4, chain="OUTPUT", table="FILTER",
+                      target="ACCEPT",
+                      params={'protocol': 'tcp',
+                              'src': '127.0.0.1'},
+                      tcp={'dport': 22})
+
+        string = ('iptables -t FILTER -A OUTPUT --protocol tcp '
+                  '--src 127.0.0.1/32 -m tcp --dport 22 -j ACCEPT')
+        self.assertEqual(str(rule), string)
+        self.assertIs(str(rule), str(rule))
+        self.assertEqual(str(rule.freeze()), string)
+
+        rule.flip()
+        self.assertEqual(str(rule),
+                         'iptables -t FILTER -A INPUT --dst 127.0.0.1/32 '
+                         '--protocol tcp -m tcp --sport 22 -j ACCEPT')
+
+        rule.kwargs['tcp']['sport'] = 80
+        rule.invalidate()
+        self.assertIn('--sport 80', str(rule))
+        self.assertIn('--sport 80', rule.restore())
+
+        out = io.StringIO()
+        R.RuleArray(rule, R.Rule(target="DROP")).dump(out)
+        self.assertEqual(out.getvalue(),
+                         str(rule) + '\niptables --protocol ip -j DROP\n')
+
     def testRuleAddition(self):
         """ Test rule addition. """
 
@@ -165,6 +241,28 @@ class Test_Rule(unittest.TestCase):
         with self.assertRaises(TypeError):
             http_client * list()
 
+    def testRuleAdditionVersions(self):
+        """ Test combined rules have the wildcards of their inet version. """
+        app = R.Rule(params={'protocol': 'tcp'}, tcp={'dport': 22})
+        route = R.Rule(ipv=6, chain="INPUT", target="ACCEPT",
+                       params={'in_interface': 'eth0'})
+        wild = ipaddress.ip_network('::/0')
+
+        for rule in [app * route, route * app]:
+            self.assertEqual(rule.ipv, 6)
+            self.assertEqual(rule.params['src'], wild)
+            self.assertEqual(rule.params['dst'], wild)
+            self.assertEqual(rule.restore(),
+                             "-A INPUT -i eth0 -p tcp -m tcp --dport 22 "
+                             "-j ACCEPT")
+            self.assertNotIn('0.0.0.0', str(rule))
+
+        host = R.Rule(ipv=6, params={'src': '2001:db8::1'})
+        self.assertEqual((app * host).params['src'],
+                         ipaddress.ip_network('2001:db8::1'))
+        self.assertEqual((host * app).params['src'],
+                         ipaddress.ip_network('2001:db8::1'))
+
     def testRuleSubtraction(self):
         """ Test rule subtraction. """
         rule_ssh_client_1 = R.Rule(chain="OUTPUT",
@@ -198,6 +296,91 @@ class Test_Rule(unittest.TestCase):
         self.assertEqual(ssh_client, ssh_client2)
         self.assertNotEqual(ssh_client, http_client)
 
+    def testKey(self):
+        """ Tests canonical rule keys and hashing. """
+
+        config = R.Rule(ipv=4, chain="INPUT", table="FILTER",
+                        target="ACCEPT",
+                        params={'protocol': 'tcp',
+                                'src': '10.1.2.3/8'},
+                        tcp={'dport': 22},
+                        icmp={'icmp_type': 'echo-request'})
+
+        live = R.Rule(ipv=4, chain="INPUT", table="filter",
+                      target="ACCEPT",
+                      params={'protocol': '6',
+                              'src': '10.0.0.0/255.0.0.0',
+                              'dst': '0.0.0.0/0.0.0.0',
+                              'in_interface': None},
+                      tcp={'dport': '22:22'},
+                      icmp={'icmp-type': 'echo-request'})
+
+        self.assertEqual(config.key(), live.key())
+        self.assertEqual(hash(config), hash(live))
+        self.assertEqual(config, live)
+
+        self.assertEqual(R.Rule(tcp={'dport': '!,80'}),
+                         R.Rule(tcp={'dport': '! 80'}))
+        self.assertNotEqual(R.Rule(tcp={'dport': '!80'}),
+                            R.Rule(tcp={'dport': '80'}))
+        self.assertEqual(R.Rule(ipv=6, params={'src': '::/0'}),
+                         R.Rule(ipv=6))
+
+        # Cached keys are invalidated on mutation
+        key = config.key()
+        config.flip()
+        self.assertNotEqual(config.key(), key)
+        config.target = "DROP"
+        self.assertEqual(config.key()[3], "DROP")
+
+    def testFreeze(self):
+        """ Tests frozen rules. """
+        rule = R.Rule(ipv=4, chain="INPUT", target="ACCEPT",
+                      params={'protocol': 'tcp',
+                              'src': '10.0.0.0/8'},
+                      tcp={'dport': 22})
+
+        frozen = rule.freeze()
+        self.assertEqual(frozen, rule)
+        self.assertEqual(rule, frozen)
+        self.assertEqual(hash(frozen), hash(rule))
+        self.assertEqual(str(frozen), str(rule))
+        self.assertEqual(frozen.thaw().dict(), rule.dict())
+
+        with self.assertRaises(AttributeError):
+            frozen.target = "DROP"
+
+        # Values are shared between frozen rules
+        other = R.Rule(ipv=4, chain="OUTPUT", params={'protocol': 'tcp'},
+                       tcp={'dport': 22}).freeze()
+        self.assertIs(frozen.kwargs, other.kwargs)
+
+        # Combination of frozen rules
+        combo = frozen * R.Rule(target="DROP", udp={'dport': 53})
+        self.assertIsInstance(combo, R.FrozenRule)
+        self.assertEqual(combo.target, "ACCEPT")
+        self.assertEqual(dict(combo.kwargs)['udp'], (('dport', 53),))
+        self.assertIsInstance(R.Rule() * frozen, R.FrozenRule)
+        self.assertEqual(R.Rule() * frozen, frozen)
+
+        flipped = frozen.flipped()
+        self.assertEqual(flipped.chain, "OUTPUT")
+        self.assertEqual(frozen.chain, "INPUT")
+
+        rarr = R.RuleArray(rule, rule.copy()).freeze()
+        self.assertEqual(len(rarr.dedupe()), 1)
+        self.assertIsInstance(rarr.thaw()[0], R.Rule)
+
+        # Shared values are bounded
+        size = R.FrozenRule.INTERN_SIZE
+        R.FrozenRule.INTERN_SIZE = 10
+        try:
+            for port in range(100):
+                R.Rule(tcp={'dport': port}).freeze()
+            self.assertLessEqual(len(R.FrozenRule._FrozenRule__INTERN), 10)
+        finally:
+            R.FrozenRule.INTERN_SIZE = size
+
     def testMembership(self):
         """ Tests membership methods. """
 
@@ -351,6 +534,37 @@ class Test_RuleArray(unittest.TestCase):
         for rule in rule_list:
             self.assertIn(rule, rarr)
 
+    def testReadSave(self):
+        """ Tests RuleArray reading iptables-save output. """
+        save = io.StringIO(
+            "# Generated by iptables-save\n"
+            "*raw\n"
+            ":PREROUTING ACCEPT [0:0]\n"
+            "-A PREROUTING -i eth0 -j NOTRACK\n"
+            "COMMIT\n"
+            "*filter\n"
+            ":INPUT ACCEPT [0:0]\n"
+            ":OUTPUT ACCEPT [0:0]\n"
+            "-A INPUT -p tcp -m tcp --dport 22 -j ACCEPT\n"
+            "-A OUTPUT -p tcp -m tcp --sport 22 -j ACCEPT\n"
+            "COMMIT\n")
+
+        rarr = R.RuleArray.read_save(fp=save)
+        self.assertEqual(len(rarr), 3)
+        self.assertEqual(rarr[0].table, "RAW")
+        self.assertEqual(
+            rarr[1],
+            R.Rule(ipv=4, chain="INPUT", table="FILTER", target="ACCEPT",
+                   params={'protocol': 'tcp'},
+                   tcp={'dport': 22}))
+
+        save.seek(0)
+        rarr = R.RuleArray.read_save(fp=save, table="FILTER",
+                                     chain="OUTPUT", ipv=6)
+        self.assertEqual(len(rarr), 1)
+        self.assertEqual(rarr[0].chain, "OUTPUT")
+        self.assertEqual(rarr[0].ipv, 6)
+
     def testRead(self):
         """ Tests RuleArray Reading iptables. """
         try:
@@ -361,3 +575,62 @@ class Test_RuleArray(unittest.TestCase):
 
         except iptc.ip4tc.IPTCError as e:
             raise unittest.SkipTest(e)
+
+    def testSetOperations(self):
+        """ Tests hash based RuleArray set operations. """
+        ssh = R.Rule(ipv=4, chain="OUTPUT", tcp={'dport': 22})
+        ssh2 = R.Rule(ipv=4, chain="OUTPUT", tcp={'dport': '22'})
+        http = R.Rule(ipv=4, chain="OUTPUT", tcp={'dport': 80})
+        dns = R.Rule(ipv=4, chain="OUTPUT", udp={'dport': 53})
+
+        rarr = R.RuleArray(ssh, http, ssh2, dns)
+        other = R.RuleArray(dns, ssh)
+
+        self.assertEqual(rarr.dedupe(), R.RuleArray(ssh, http, dns))
+        self.assertEqual(rarr.difference(other), R.RuleArray(http))
+        self.assertEqual(rarr - other, R.RuleArray(http))
+        self.assertEqual(rarr.intersection(other),
+                         R.RuleArray(ssh, ssh2, dns))
+        self.assertEqual(other.union(rarr), R.RuleArray(dns, ssh, http))
+
+    def testLazyProduct(self):
+        """ Tests lazy RuleArray products. """
+        routes = R.RuleArray(
+            R.Rule(params={'src': '10.0.0.1'}),
+            R.Rule(params={'src': '10.0.0.2'}),
+            R.Rule(params={'src': '10.0.0.3'}))
+        apps = R.RuleArray(
+            R.Rule(tcp={'dport': 22}),
+            R.Rule(tcp={'dport': 80}))
+        chain = R.Rule(chain="OUTPUT", target="ACCEPT")
+
+        eager = routes * apps * chain
+        lazy = routes.lazy() * apps * chain
+
+        self.assertIsInstance(lazy, R.RuleView)
+        self.assertEqual(len(lazy), 6)
+        self.assertEqual(list(lazy), list(eager))
+        self.assertEqual([lazy[i] for i in range(-6, 6)],
+                         list(eager) + list(eager))
+        self.assertEqual(lazy[1:5], eager[1:5])
+        self.assertIn(eager[3], lazy)
+        self.assertEqual(lazy.materialize(), eager)
+
+        both = lazy + apps
+        self.assertIsInstance(both, R.RuleView)
+        self.assertEqual(list(both), list(eager + apps))
+        self.assertEqual(list(apps + lazy), list(apps + eager))
+        self.assertEqual(list(chain * lazy), list(chain * eager))
+
+        with self.assertRaises(IndexError):
+            lazy[6]
+        with self.assertRaises(TypeError):
+            lazy['string']
+
+        # Incomplete views fail on construction
+        class Partial(R.RuleView):
+            def __len__(self):
+                return 0
+
+        with self.assertRaises(TypeError):
+            Partial()
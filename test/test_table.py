@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import unittest
+import errno
+import os
+import iptc
+import baleful.table as T
+
+
+class FakeTable:
+    """ Counts handle operations, in place of an iptc table. """
+    FILTER = "filter"
+    ALL = ["filter"]
+    conflicts = 0
+
+    def __init__(self, name, autocommit=True):
+        self.name = name
+        self.autocommit = autocommit
+        self.refreshes = 0
+        self.commits = 0
+        self.entries = list()
+        self.pending = list()
+
+    def refresh(self):
+        self.refreshes += 1
+        self.pending = list(self.entries)
+
+    def commit(self):
+        if FakeTable.conflicts:
+            FakeTable.conflicts -= 1
+            raise iptc.ip4tc.IPTCError(
+                "can't commit: " + os.strerror(errno.EAGAIN))
+        self.commits += 1
+        self.entries = list(self.pending)
+
+
+class Test_TablePool(unittest.TestCase):
+    """ Tests for the shared table handle pool. """
+
+    def setUp(self):
+        self.pool = T.TablePool({4: {'table': FakeTable}})
+        FakeTable.conflicts = 0
+
+    def testHandleReuse(self):
+        """ Tests handles are shared, and refreshed once per transaction. """
+        table = self.pool.table(4, "filter")
+        self.assertIs(self.pool.table(4, "FILTER"), table)
+        self.assertTrue(table.autocommit)
+
+        with self.pool.transaction():
+            for i in range(10):
+                self.assertFalse(self.pool.table(4, "FILTER").autocommit)
+
+        # Tables which are only read are not committed
+        self.assertEqual(table.refreshes, 1)
+        self.assertEqual(table.commits, 0)
+        self.assertTrue(table.autocommit)
+
+        with self.pool.transaction() as pool:
+            pool.table()
+            pool.execute(lambda: pool.table().pending.append(1))
+            pool.table()
+
+        self.assertEqual(table.refreshes, 3)
+        self.assertEqual(table.commits, 1)
+        self.assertTrue(table.autocommit)
+
+    def testRollback(self):
+        """ Tests failed transactions discard pending changes. """
+        def add(entry):
+            self.pool.table().pending.append(entry)
+
+        with self.assertRaises(ValueError):
+            with self.pool.transaction() as pool:
+                pool.execute(add, 1)
+                raise ValueError()
+
+        self.assertEqual(self.pool.table().entries, [])
+        self.assertEqual(self.pool.ops, [])
+
+    def testReplay(self):
+        """ Tests operations are replayed after a commit conflict. """
+        def add(entry):
+            self.pool.table().pending.append(entry)
+
+        FakeTable.conflicts = 1
+        with self.pool.transaction() as pool:
+            pool.execute(add, 1)
+            pool.execute(add, 2)
+
+        self.assertEqual(self.pool.table().entries, [1, 2])
+
+        FakeTable.conflicts = 10
+        with self.assertRaises(iptc.ip4tc.IPTCError):
+            with self.pool.transaction() as pool:
+                pool.execute(add, 3)
+        self.assertEqual(self.pool.table().entries, [1, 2])
@@ -106,3 +106,51 @@ class Test_Topo(unittest.TestCase):
 
         with self.assertRaises(TypeError):
             topo['string']
+
+        self.assertEqual(topo[-1], rule_flip[0])
+        self.assertEqual(topo[-2], rule[0])
+        self.assertEqual(topo[0:2], R.RuleArray(rule[0], rule_flip[0]))
+        self.assertEqual(topo[::-1], R.RuleArray(rule_flip[0], rule[0]))
+
+        with self.assertRaises(IndexError):
+            topo[-3]
+
+        forward, reverse = topo.views()
+        self.assertIs(forward, rule)
+        self.assertIs(reverse, rule_flip)
+
+    def testFreeze(self):
+        """ Tests topologies of frozen rules. """
+        topo = T.Topology(R.RuleArray(R.Rule(chain="OUTPUT")),
+                          R.RuleArray(R.Rule(chain="INPUT")))
+        app = R.RuleArray(R.Rule(params={'protocol': 'tcp'},
+                                 tcp={'dport': 22}))
+
+        frozen = topo.freeze() * app.freeze()
+        mutable = topo * app
+
+        self.assertEqual(len(frozen), len(mutable))
+        for f, m in zip(frozen, mutable):
+            self.assertIsInstance(f, R.FrozenRule)
+            self.assertEqual(f, m)
+        self.assertIsInstance(frozen.thaw()[0], R.Rule)
+
+    def testLazy(self):
+        """ Tests lazy topology combination. """
+        topo = T.Topology(R.RuleArray(R.Rule(chain="OUTPUT")),
+                          R.RuleArray(R.Rule(chain="INPUT")))
+        scanner = T.Topology(
+            R.RuleArray(R.Rule(params={'protocol': 'tcp'},
+                               tcp={'dport': 54921})),
+            R.RuleArray(R.Rule(params={'protocol': 'udp'},
+                               udp={'dport': 54925})))
+        routes = R.RuleArray(R.Rule(params={'src': '10.0.0.1'}),
+                             R.Rule(params={'src': '10.0.0.2'}))
+
+        eager = topo * scanner * routes
+        lazy = topo.lazy() * scanner * routes
+
+        self.assertIsInstance(lazy.forward, R.RuleView)
+        self.assertEqual(len(lazy), len(eager))
+        self.assertEqual(list(lazy), list(eager))
+        self.assertEqual(list(lazy.materialize()), list(eager))